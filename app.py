@@ -1,12 +1,11 @@
 import startup
-import asyncio
 import time
-import flask
-from flask import Flask
 from kink import di
 from app_config import Configuration
 from telebot.async_telebot import AsyncTeleBot
-from telebot import TeleBot, types
+from telebot import TeleBot
+from services import BackgroundLoop
+from webhook import create_app
 from async_bot import async_bot_functions
 from sync_bot import sync_bot_functions
 
@@ -22,12 +21,12 @@ else:
     sync_bot_functions(di["bot_instance"])
 
 if isinstance(di["bot_instance"], AsyncTeleBot):
-    asyncio.run(di["bot_instance"].delete_webhook(drop_pending_updates=True))
+    di[BackgroundLoop].run(di["bot_instance"].delete_webhook(drop_pending_updates=True))
     time.sleep(0.5)
     if di[Configuration]["update_mode"] == "polling":
-        asyncio.run(di["bot_instance"].infinity_polling(skip_pending=True))
+        di[BackgroundLoop].run(di["bot_instance"].infinity_polling(skip_pending=True))
     elif di[Configuration]["update_mode"] == "webhook":
-        asyncio.run(
+        di[BackgroundLoop].run(
             di["bot_instance"].set_webhook(url=WEBHOOK_URL_BASE + WEBHOOK_URL_PATH)
         )
 elif isinstance(di["bot_instance"], TeleBot):
@@ -39,21 +38,9 @@ elif isinstance(di["bot_instance"], TeleBot):
         di["bot_instance"].set_webhook(url=WEBHOOK_URL_BASE + WEBHOOK_URL_PATH)
 
 
-app = Flask(__name__)
-
-
-@app.route(WEBHOOK_URL_PATH, methods=["POST"])
-def receive_updates():
-    if flask.request.headers.get("content-type") == "application/json":
-        json_string = flask.request.get_data().decode("utf-8")
-        update = types.Update.de_json(json_string)
-        if isinstance(di["bot_instance"], AsyncTeleBot):
-            asyncio.run(di["bot_instance"].process_new_updates([update]))
-        elif isinstance(di["bot_instance"], TeleBot):
-            di["bot_instance"].process_new_updates([update])
-        return ""
-    else:
-        flask.abort(403)
+app = create_app(
+    di["bot_instance"], WEBHOOK_URL_PATH, metrics_token=di[Configuration]["secret"]
+)
 
 
 if __name__ == "__main__":
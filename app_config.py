@@ -23,7 +23,48 @@ class Configuration:
             "credentials_json": {},
             "worksheet_id": "",
             "webhook_base_url": "",
+            "telegram_api_url": "",
             "run_async": True,
+            "upload_flush_interval": 2.0,
+            "upload_max_batch_size": 50,
+            "worksheet_cache_ttl": 300.0,
+            "sheets_pool_size": 4,
+            "sheets_queue_limit": 32,
+            "sheets_timeout": 30.0,
+            "sheets_backend": "gspread",
+            "sheets_api_url": "https://sheets.googleapis.com",
+            "drive_api_url": "https://www.googleapis.com",
+            "catalog_refresh_interval": 300.0,
+            "catalog_snapshot_path": "catalog_snapshot.json",
+            "journal_path": "transactions_journal.db",
+            "journal_lease": 120.0,
+            "journal_retention": 604800.0,
+            "sheets_write_lock": "sheets_write.lock",
+            "sheets_max_attempts": 5,
+            "sheets_backoff_base": 0.5,
+            "sheets_backoff_max": 32.0,
+            "sheets_breaker_threshold": 5,
+            "sheets_breaker_reset": 30.0,
+            "sheets_quota_per_minute": 60,
+            "sheets_background_reserve": 10,
+            "update_queue_size": 100,
+            "update_workers": 4,
+            "update_drain_timeout": 10.0,
+            "session_max_count": 1000,
+            "session_idle_timeout": 3600.0,
+            "state_storage": "memory",
+            "state_db_path": "bot_state.db",
+            "shard_workers": 2,
+            "shard_queue_size": 100,
+            "outbound_global_rate": 30.0,
+            "outbound_chat_rate": 1.0,
+            "outbound_chat_burst": 5,
+            "profile_sample_rate": 0.0,
+            "profile_dir": "profiles",
+            "import_columns": {},
+            "import_date_format": "",
+            "import_chunk_size": 500,
+            "import_progress_every": 200,
         }
 
         ON_HEROKU = os.getenv("ON_HEROKU", "False").lower() in ("true", "1")
@@ -55,10 +96,109 @@ class Configuration:
                 base64.b64decode(os.environ.get("CREDENTIALS", ""))
             )
             config["worksheet_id"] = os.environ.get("WORKSHEET_ID", "")
+            config["telegram_api_url"] = os.environ.get("TELEGRAM_API_URL", "")
             config["run_async"] = os.getenv("RUN_ASYNC", "False").lower() in (
                 "true",
                 "1",
             )
+            config["upload_flush_interval"] = float(
+                os.environ.get("UPLOAD_FLUSH_INTERVAL", "2")
+            )
+            config["upload_max_batch_size"] = int(
+                os.environ.get("UPLOAD_MAX_BATCH_SIZE", "50")
+            )
+            config["worksheet_cache_ttl"] = float(
+                os.environ.get("WORKSHEET_CACHE_TTL", "300")
+            )
+            config["sheets_pool_size"] = int(os.environ.get("SHEETS_POOL_SIZE", "4"))
+            config["sheets_queue_limit"] = int(
+                os.environ.get("SHEETS_QUEUE_LIMIT", "32")
+            )
+            config["sheets_timeout"] = float(os.environ.get("SHEETS_TIMEOUT", "30"))
+            config["sheets_backend"] = os.environ.get("SHEETS_BACKEND", "gspread")
+            config["sheets_api_url"] = os.environ.get(
+                "SHEETS_API_URL", config["sheets_api_url"]
+            )
+            config["drive_api_url"] = os.environ.get(
+                "DRIVE_API_URL", config["drive_api_url"]
+            )
+            config["catalog_refresh_interval"] = float(
+                os.environ.get("CATALOG_REFRESH_INTERVAL", "300")
+            )
+            config["catalog_snapshot_path"] = os.environ.get(
+                "CATALOG_SNAPSHOT_PATH", config["catalog_snapshot_path"]
+            )
+            config["journal_path"] = os.environ.get(
+                "JOURNAL_PATH", config["journal_path"]
+            )
+            config["journal_lease"] = float(os.environ.get("JOURNAL_LEASE", "120"))
+            config["journal_retention"] = float(
+                os.environ.get("JOURNAL_RETENTION", "604800")
+            )
+            config["sheets_write_lock"] = os.environ.get(
+                "SHEETS_WRITE_LOCK", config["sheets_write_lock"]
+            )
+            config["sheets_max_attempts"] = int(
+                os.environ.get("SHEETS_MAX_ATTEMPTS", "5")
+            )
+            config["sheets_backoff_base"] = float(
+                os.environ.get("SHEETS_BACKOFF_BASE", "0.5")
+            )
+            config["sheets_backoff_max"] = float(
+                os.environ.get("SHEETS_BACKOFF_MAX", "32.0")
+            )
+            config["sheets_breaker_threshold"] = int(
+                os.environ.get("SHEETS_BREAKER_THRESHOLD", "5")
+            )
+            config["sheets_breaker_reset"] = float(
+                os.environ.get("SHEETS_BREAKER_RESET", "30.0")
+            )
+            config["sheets_quota_per_minute"] = int(
+                os.environ.get("SHEETS_QUOTA_PER_MINUTE", "60")
+            )
+            config["sheets_background_reserve"] = int(
+                os.environ.get("SHEETS_BACKGROUND_RESERVE", "10")
+            )
+            config["update_queue_size"] = int(
+                os.environ.get("UPDATE_QUEUE_SIZE", "100")
+            )
+            config["update_workers"] = int(os.environ.get("UPDATE_WORKERS", "4"))
+            config["update_drain_timeout"] = float(
+                os.environ.get("UPDATE_DRAIN_TIMEOUT", "10")
+            )
+            config["session_max_count"] = int(
+                os.environ.get("SESSION_MAX_COUNT", "1000")
+            )
+            config["session_idle_timeout"] = float(
+                os.environ.get("SESSION_IDLE_TIMEOUT", "3600")
+            )
+            config["state_storage"] = os.environ.get("STATE_STORAGE", "memory")
+            config["state_db_path"] = os.environ.get("STATE_DB_PATH", "bot_state.db")
+            config["shard_workers"] = int(os.environ.get("SHARD_WORKERS", "2"))
+            config["shard_queue_size"] = int(os.environ.get("SHARD_QUEUE_SIZE", "100"))
+            config["outbound_global_rate"] = float(
+                os.environ.get("OUTBOUND_GLOBAL_RATE", "30.0")
+            )
+            config["outbound_chat_rate"] = float(
+                os.environ.get("OUTBOUND_CHAT_RATE", "1.0")
+            )
+            config["outbound_chat_burst"] = int(
+                os.environ.get("OUTBOUND_CHAT_BURST", "5")
+            )
+            config["profile_sample_rate"] = float(
+                os.environ.get("PROFILE_SAMPLE_RATE", "0")
+            )
+            config["profile_dir"] = os.environ.get("PROFILE_DIR", "profiles")
+            config["import_columns"] = json.loads(
+                os.environ.get("IMPORT_COLUMNS", "{}")
+            )
+            config["import_date_format"] = os.environ.get("IMPORT_DATE_FORMAT", "")
+            config["import_chunk_size"] = int(
+                os.environ.get("IMPORT_CHUNK_SIZE", "500")
+            )
+            config["import_progress_every"] = int(
+                os.environ.get("IMPORT_PROGRESS_EVERY", "200")
+            )
         else:
             file_config = toml.load("config.toml")
             config["currency"] = file_config["currency"]
@@ -69,11 +209,173 @@ class Configuration:
             config["app_name"] = file_config["app"]["app_name"]
             config["restrict_access"] = file_config["telegram"]["restrict_access"]
             config["list_of_users"] = file_config["telegram"]["list_of_users"]
+            config["telegram_api_url"] = file_config["telegram"].get(
+                "telegram_api_url", config["telegram_api_url"]
+            )
             config["credentials_json"] = json.loads(
                 base64.b64decode(file_config["gsheet"]["credentials_json"])
             )
             config["worksheet_id"] = file_config["gsheet"]["gsheet_worksheet_id"]
             config["run_async"] = file_config["app"]["run_async"]
+            config["upload_flush_interval"] = float(
+                file_config["gsheet"].get(
+                    "upload_flush_interval", config["upload_flush_interval"]
+                )
+            )
+            config["upload_max_batch_size"] = int(
+                file_config["gsheet"].get(
+                    "upload_max_batch_size", config["upload_max_batch_size"]
+                )
+            )
+            config["worksheet_cache_ttl"] = float(
+                file_config["gsheet"].get(
+                    "worksheet_cache_ttl", config["worksheet_cache_ttl"]
+                )
+            )
+            config["sheets_pool_size"] = int(
+                file_config["gsheet"].get(
+                    "sheets_pool_size", config["sheets_pool_size"]
+                )
+            )
+            config["sheets_queue_limit"] = int(
+                file_config["gsheet"].get(
+                    "sheets_queue_limit", config["sheets_queue_limit"]
+                )
+            )
+            config["sheets_timeout"] = float(
+                file_config["gsheet"].get("sheets_timeout", config["sheets_timeout"])
+            )
+            config["sheets_backend"] = file_config["gsheet"].get(
+                "sheets_backend", config["sheets_backend"]
+            )
+            config["sheets_api_url"] = file_config["gsheet"].get(
+                "sheets_api_url", config["sheets_api_url"]
+            )
+            config["drive_api_url"] = file_config["gsheet"].get(
+                "drive_api_url", config["drive_api_url"]
+            )
+            config["catalog_refresh_interval"] = float(
+                file_config["gsheet"].get(
+                    "catalog_refresh_interval", config["catalog_refresh_interval"]
+                )
+            )
+            config["catalog_snapshot_path"] = file_config["gsheet"].get(
+                "catalog_snapshot_path", config["catalog_snapshot_path"]
+            )
+            config["journal_path"] = file_config["gsheet"].get(
+                "journal_path", config["journal_path"]
+            )
+            config["journal_lease"] = float(
+                file_config["gsheet"].get("journal_lease", config["journal_lease"])
+            )
+            config["journal_retention"] = float(
+                file_config["gsheet"].get(
+                    "journal_retention", config["journal_retention"]
+                )
+            )
+            config["sheets_write_lock"] = file_config["gsheet"].get(
+                "sheets_write_lock", config["sheets_write_lock"]
+            )
+            config["sheets_max_attempts"] = int(
+                file_config["gsheet"].get(
+                    "sheets_max_attempts", config["sheets_max_attempts"]
+                )
+            )
+            config["sheets_backoff_base"] = float(
+                file_config["gsheet"].get(
+                    "sheets_backoff_base", config["sheets_backoff_base"]
+                )
+            )
+            config["sheets_backoff_max"] = float(
+                file_config["gsheet"].get(
+                    "sheets_backoff_max", config["sheets_backoff_max"]
+                )
+            )
+            config["sheets_breaker_threshold"] = int(
+                file_config["gsheet"].get(
+                    "sheets_breaker_threshold", config["sheets_breaker_threshold"]
+                )
+            )
+            config["sheets_breaker_reset"] = float(
+                file_config["gsheet"].get(
+                    "sheets_breaker_reset", config["sheets_breaker_reset"]
+                )
+            )
+            config["sheets_quota_per_minute"] = int(
+                file_config["gsheet"].get(
+                    "sheets_quota_per_minute", config["sheets_quota_per_minute"]
+                )
+            )
+            config["sheets_background_reserve"] = int(
+                file_config["gsheet"].get(
+                    "sheets_background_reserve", config["sheets_background_reserve"]
+                )
+            )
+            config["update_queue_size"] = int(
+                file_config["app"].get("update_queue_size", config["update_queue_size"])
+            )
+            config["update_workers"] = int(
+                file_config["app"].get("update_workers", config["update_workers"])
+            )
+            config["update_drain_timeout"] = float(
+                file_config["app"].get(
+                    "update_drain_timeout", config["update_drain_timeout"]
+                )
+            )
+            config["session_max_count"] = int(
+                file_config["app"].get("session_max_count", config["session_max_count"])
+            )
+            config["session_idle_timeout"] = float(
+                file_config["app"].get(
+                    "session_idle_timeout", config["session_idle_timeout"]
+                )
+            )
+            config["state_storage"] = file_config["app"].get(
+                "state_storage", config["state_storage"]
+            )
+            config["state_db_path"] = file_config["app"].get(
+                "state_db_path", config["state_db_path"]
+            )
+            config["shard_workers"] = int(
+                file_config["app"].get("shard_workers", config["shard_workers"])
+            )
+            config["shard_queue_size"] = int(
+                file_config["app"].get("shard_queue_size", config["shard_queue_size"])
+            )
+            config["outbound_global_rate"] = float(
+                file_config["app"].get(
+                    "outbound_global_rate", config["outbound_global_rate"]
+                )
+            )
+            config["outbound_chat_rate"] = float(
+                file_config["app"].get(
+                    "outbound_chat_rate", config["outbound_chat_rate"]
+                )
+            )
+            config["outbound_chat_burst"] = int(
+                file_config["app"].get(
+                    "outbound_chat_burst", config["outbound_chat_burst"]
+                )
+            )
+            config["profile_sample_rate"] = float(
+                file_config["app"].get(
+                    "profile_sample_rate", config["profile_sample_rate"]
+                )
+            )
+            config["profile_dir"] = file_config["app"].get(
+                "profile_dir", config["profile_dir"]
+            )
+            import_config = file_config.get("import", {})
+            config["import_columns"] = dict(import_config.get("columns", {}))
+            config["import_date_format"] = import_config.get(
+                "date_format", config["import_date_format"]
+            )
+            config["import_chunk_size"] = int(
+                import_config.get("chunk_size", config["import_chunk_size"])
+            )
+            config["import_progress_every"] = int(
+                import_config.get("progress_every", config["import_progress_every"])
+            )
 
         if ON_HEROKU:
             config["webhook_base_url"] = "https://%s.herokuapp.com" % (
@@ -84,6 +386,10 @@ class Configuration:
                 config["app_name"]
             )
 
+        if config["sheets_background_reserve"] >= config["sheets_quota_per_minute"]:
+            raise ValueError(
+                "sheets_background_reserve must be lower than sheets_quota_per_minute"
+            )
         return config
 
     def get_values(self):
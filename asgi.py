@@ -0,0 +1,188 @@
+import startup
+import asyncio
+import json
+from kink import di
+from logging import Logger
+from app_config import Configuration
+from telebot.async_telebot import AsyncTeleBot
+from telebot import types
+from services import BackgroundLoop
+from metrics import CONTENT_TYPE, MetricsRegistry, authorized
+from dispatcher import shard_key
+from async_bot import async_bot_functions
+from sync_bot import sync_bot_functions
+
+# inject dependencies
+startup.configure_services()
+
+WEBHOOK_URL_BASE = di["WEBHOOK_URL_BASE"]
+WEBHOOK_URL_PATH = "/%s/" % (di[Configuration]["secret"])
+
+if di[Configuration]["run_async"]:
+    async_bot_functions(di["bot_instance"])
+else:
+    sync_bot_functions(di["bot_instance"])
+
+
+class WebhookApp:
+    """
+    ASGI webhook endpoint. Updates are queued and acknowledged right away,
+    a pool of worker tasks then hands them to the bot. Each worker has its
+    own queue and every update of a user goes to the same one, so a user's
+    updates are processed one at a time and in order. /metrics is served to
+    requests with metrics_token as bearer token.
+    """
+
+    def __init__(
+        self,
+        bot_instance,
+        path: str,
+        queue_size: int = 100,
+        workers: int = 4,
+        drain_timeout: float = 10.0,
+        metrics_token: str = None,
+    ):
+        self._bot = bot_instance
+        self._path = path
+        self._metrics_token = metrics_token
+        self._queue_size = queue_size
+        self._workers = workers
+        self._drain_timeout = drain_timeout
+        self._queues: list[asyncio.Queue] = []
+        self._tasks = []
+        self._accepting = False
+        self._update_seconds = di[MetricsRegistry].histogram(
+            "bot_update_seconds", "Time to process a webhook update", ("outcome",)
+        )
+        di[MetricsRegistry].register(
+            "webhook_queue_depth", "Updates waiting for a worker", self.queue_depth
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        headers = dict(scope["headers"])
+        if scope["path"] == "/metrics" and scope["method"] == "GET":
+            if not authorized(headers.get(b"authorization"), self._metrics_token):
+                await self._respond(send, 403)
+                return
+            await self._respond(
+                send,
+                200,
+                [(b"content-type", CONTENT_TYPE.encode())],
+                di[MetricsRegistry].render().encode(),
+            )
+            return
+        if scope["path"] != self._path or scope["method"] != "POST":
+            await self._respond(send, 404)
+            return
+        if headers.get(b"content-type") != b"application/json":
+            await self._respond(send, 403)
+            return
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        if not self._accepting:
+            await self._respond(send, 503)
+            return
+        try:
+            update = json.loads(body)
+        except ValueError:
+            update = None
+        if not isinstance(update, dict):
+            await self._respond(send, 400)
+            return
+        try:
+            self._queues[shard_key(update) % len(self._queues)].put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram retries the update later
+            await self._respond(send, 503, [(b"retry-after", b"1")])
+            return
+        await self._respond(send, 200)
+
+    async def _respond(
+        self, send, status: int, headers: list = None, body: bytes = b""
+    ):
+        await send(
+            {"type": "http.response.start", "status": status, "headers": headers or []}
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    async def startup(self):
+        # queue_size is shared out between the workers
+        self._queues = [
+            asyncio.Queue(maxsize=max(1, self._queue_size // self._workers))
+            for _ in range(self._workers)
+        ]
+        self._tasks = [asyncio.create_task(self._worker(q)) for q in self._queues]
+        self._accepting = True
+        await self._run_bot(self._bot.delete_webhook, drop_pending_updates=True)
+        if di[Configuration]["update_mode"] == "webhook":
+            await self._run_bot(
+                self._bot.set_webhook, url=WEBHOOK_URL_BASE + WEBHOOK_URL_PATH
+            )
+
+    async def shutdown(self):
+        """
+        Stop accepting updates and let the workers finish the queued ones
+        """
+        self._accepting = False
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(q.join() for q in self._queues)), self._drain_timeout
+            )
+        except asyncio.TimeoutError:
+            di[Logger].error(
+                "Dropped %d queued updates on shutdown" % self.queue_depth()
+            )
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            update = await queue.get()
+            try:
+                update = types.Update.de_json(update)
+                with self._update_seconds.timer():
+                    await self._run_bot(self._bot.process_new_updates, [update])
+            except Exception as e:
+                di[Logger].error(e)
+            finally:
+                queue.task_done()
+
+    async def _run_bot(self, method, *args, **kwargs):
+        if isinstance(self._bot, AsyncTeleBot):
+            return await di[BackgroundLoop].call(method(*args, **kwargs))
+        return await asyncio.to_thread(method, *args, **kwargs)
+
+    def queue_depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+
+app = WebhookApp(
+    di["bot_instance"],
+    WEBHOOK_URL_PATH,
+    queue_size=di[Configuration]["update_queue_size"],
+    workers=di[Configuration]["update_workers"],
+    drain_timeout=di[Configuration]["update_drain_timeout"],
+    metrics_token=di[Configuration]["secret"],
+)
@@ -1,14 +1,26 @@
 from gspread import utils
 import calendar
 import datetime
+import threading
 from itertools import groupby
 from telebot import types
 
+# Worksheet the transactions are written to, by both Sheets backends
+TRANSACTIONS_SHEET = "Transactions"
 
-def get_all_categories(spreadsheet) -> dict[str, list]:
-    worksheet = spreadsheet.worksheet("Configuration")
-    values = worksheet.get("r_ConfigurationData")
 
+def trx_a1(cells: str) -> str:
+    """
+    A1 notation of cells of the Transactions sheet, for the Sheets API
+    """
+    return f"{TRANSACTIONS_SHEET}!{cells}"
+
+
+def parse_categories(values: list[list[str]], category: list[list[str]]):
+    """
+    Group categories from r_ConfigurationData, anything else listed in
+    TransactionCategories goes under Others
+    """
     # Find groups and exclude credit card payments
     groups = [i[1] for i in values if i[0] == "✦" and "Credit Card" not in i[1]]
 
@@ -21,8 +33,7 @@ def get_all_categories(spreadsheet) -> dict[str, list]:
 
     grouped_cats = dict(zip(groups, categories_titles))
     # Add missing options
-    category = worksheet.get("TransactionCategories")
-    grouped_cats["Others"] = list(
+    grouped_cats["Others"] = sorted(
         set([i for j in category for i in j])
         ^ set([i for j in categories_titles for i in j])
     )
@@ -30,32 +41,258 @@ def get_all_categories(spreadsheet) -> dict[str, list]:
     return grouped_cats
 
 
+def get_all_categories(spreadsheet) -> dict[str, list]:
+    worksheet = spreadsheet.worksheet("Configuration")
+    values = worksheet.get("r_ConfigurationData")
+    category = worksheet.get("TransactionCategories")
+    return parse_categories(values, category)
+
+
 def get_accounts(spreadsheet):
     worksheet = spreadsheet.worksheet("Configuration")
     accounts = worksheet.get("cfg_Accounts")
     return accounts
 
 
-def append_trx(spreadsheet, data: list[str]):
-    worksheet = spreadsheet.worksheet("Transactions")
-    next_row = next(n for n in worksheet.range("trx_Dates") if n.value == "")
-    rowRange = next_row.address + ":H" + str(next_row.row)
-    worksheet.append_row(
-        values=data,
-        table_range=rowRange,
-        value_input_option=utils.ValueInputOption.user_entered,
-        insert_data_option=0,
+CATALOG_RANGES = ["r_ConfigurationData", "TransactionCategories", "cfg_Accounts"]
+
+
+def parse_catalog(response: dict) -> tuple[dict[str, list], list[str]]:
+    """
+    Categories and accounts from a values_batch_get of CATALOG_RANGES
+    """
+    values, category, accounts = [r.get("values", []) for r in response["valueRanges"]]
+    return parse_categories(values, category), [i for s in accounts for i in s]
+
+
+def get_catalog(spreadsheet) -> tuple[dict[str, list], list[str]]:
+    return parse_catalog(spreadsheet.values_batch_get(CATALOG_RANGES))
+
+
+async def async_get_catalog(client) -> tuple[dict[str, list], list[str]]:
+    return parse_catalog(await client.values_batch_get(CATALOG_RANGES))
+
+
+class RowCursor:
+    """
+    Next free row of the trx_Dates named range. Found once with a full scan,
+    then advanced after every successful write.
+    """
+
+    def __init__(self):
+        self.row = None
+        self.col = None
+        self.last_row = None
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        self.row = None
+
+    def set_bounds(self, range_name: str):
+        """Column and last row of trx_Dates from its resolved A1 range"""
+        first, last = range_name.split("!")[-1].split(":")
+        start_row, self.col = utils.a1_to_rowcol(first)
+        self.last_row = utils.a1_to_rowcol(last)[0]
+        return start_row
+
+    def dates_range(self, first_row: int, last_row: int) -> str:
+        return (
+            utils.rowcol_to_a1(first_row, self.col)
+            + ":"
+            + utils.rowcol_to_a1(last_row, self.col)
+        )
+
+    def move_to_free_rows(self, dates: list[list[str]], start_row: int, count: int):
+        self.row = start_row + find_free_rows(dates, count)
+        if self.row + count - 1 > self.last_row:
+            self.invalidate()
+            raise ValueError("Not enough empty rows left in trx_Dates")
+
+
+_row_cursors: dict[str, RowCursor] = {}
+
+
+def get_row_cursor(spreadsheet) -> RowCursor:
+    return _row_cursors.setdefault(spreadsheet.id, RowCursor())
+
+
+def find_free_rows(dates: list[list[str]], count: int) -> int:
+    """
+    Index of the first run of count empty cells in a column of values.
+    Values past the end of the list are empty since the API trims them.
+    """
+    run = 0
+    for i, cell in enumerate(dates):
+        if not cell or cell[0] == "":
+            run += 1
+            if run == count:
+                return i - count + 1
+        else:
+            run = 0
+    return len(dates) - run
+
+
+def is_filled(dates: list[list[str]]) -> bool:
+    return any(cell and cell[0] != "" for cell in dates)
+
+
+def trx_range(cursor: RowCursor, rows: list[list[str]]) -> str:
+    """Exact A1 range covering rows written at the cursor"""
+    return (
+        utils.rowcol_to_a1(cursor.row, cursor.col)
+        + ":"
+        + utils.rowcol_to_a1(
+            cursor.row + len(rows) - 1, cursor.col + max(len(row) for row in rows) - 1
+        )
     )
 
 
+def scan_trx_dates(worksheet, cursor: RowCursor, count: int, from_row: int = None):
+    """
+    Point the cursor at the first free run of count rows in trx_Dates,
+    reading only the rows from from_row onwards when it is given.
+    """
+    if from_row is None or cursor.col is None:
+        dates = worksheet.get("trx_Dates")
+        start_row = cursor.set_bounds(dates.range)
+    else:
+        start_row = from_row
+        dates = worksheet.get(cursor.dates_range(start_row, cursor.last_row))
+    cursor.move_to_free_rows(dates, start_row, count)
+
+
+# Category, Account and Memo, compared as text when checking a write
+TRX_TEXT_COLUMNS = (3, 4, 5)
+
+
+def append_trx(spreadsheet, data: list[str]):
+    append_trx_batch(spreadsheet, [data])
+
+
+def append_trx_batch(
+    spreadsheet, rows: list[list[str]], attempts: int = 3, on_attempt=None
+):
+    """
+    Write several transactions to the Transactions sheet in one request.
+    The target rows come from the cached cursor, only their date cells are
+    read back to make sure nobody else filled them in the meantime.
+    on_attempt is called with the A1 range right before it is written.
+    """
+    worksheet = spreadsheet.worksheet(TRANSACTIONS_SHEET)
+    cursor = get_row_cursor(spreadsheet)
+    with cursor.lock:
+        if cursor.row is None:
+            scan_trx_dates(worksheet, cursor, len(rows))
+        for _ in range(attempts):
+            first_row = cursor.row
+            dates = worksheet.get(
+                cursor.dates_range(first_row, first_row + len(rows) - 1)
+            )
+            if is_filled(dates):
+                # Rows were added outside the bot, look further down
+                scan_trx_dates(worksheet, cursor, len(rows), from_row=first_row)
+                continue
+            target = trx_range(cursor, rows)
+            if on_attempt is not None:
+                on_attempt(target)
+            worksheet.update(
+                values=rows,
+                range_name=target,
+                value_input_option=utils.ValueInputOption.user_entered,
+            )
+            cursor.row = first_row + len(rows)
+            return
+        cursor.invalidate()
+        raise RuntimeError("Could not find empty rows in trx_Dates to write to")
+
+
+async def async_scan_trx_dates(
+    client, cursor: RowCursor, count: int, from_row: int = None
+):
+    if from_row is None or cursor.col is None:
+        response = await client.values_get("trx_Dates")
+        start_row = cursor.set_bounds(response["range"])
+    else:
+        start_row = from_row
+        response = await client.values_get(
+            trx_a1(cursor.dates_range(start_row, cursor.last_row))
+        )
+    cursor.move_to_free_rows(response.get("values", []), start_row, count)
+
+
+async def async_append_trx_batch(
+    client, rows: list[list[str]], attempts: int = 3, on_attempt=None
+):
+    """
+    Same as append_trx_batch through the aiohttp client. The cursor lock is
+    not taken since AsyncTransactionUploader serializes writes on its loop.
+    """
+    cursor = get_row_cursor(client)
+    if cursor.row is None:
+        await async_scan_trx_dates(client, cursor, len(rows))
+    for _ in range(attempts):
+        first_row = cursor.row
+        response = await client.values_get(
+            trx_a1(cursor.dates_range(first_row, first_row + len(rows) - 1))
+        )
+        if is_filled(response.get("values", [])):
+            await async_scan_trx_dates(client, cursor, len(rows), from_row=first_row)
+            continue
+        target = trx_range(cursor, rows)
+        if on_attempt is not None:
+            on_attempt(target)
+        await client.values_update(trx_a1(target), rows)
+        cursor.row = first_row + len(rows)
+        return
+    cursor.invalidate()
+    raise RuntimeError("Could not find empty rows in trx_Dates to write to")
+
+
+def is_written(values: list[list], rows: list[list]) -> bool:
+    """
+    Whether cells read back from a range already hold rows. Only the date
+    being set and the text columns are compared, amounts come back
+    formatted with the currency.
+    """
+    if len(values) < len(rows):
+        return False
+    for cells, row in zip(values, rows):
+        cells = list(cells) + [""] * (len(row) - len(cells))
+        if cells[0] == "":
+            return False
+        if any(str(cells[i]) != str(row[i]) for i in TRX_TEXT_COLUMNS):
+            return False
+    return True
+
+
+def trx_written(spreadsheet, target: str, rows: list[list]) -> bool:
+    """
+    Check a range a failed write was sent to, the request may have landed
+    before the error
+    """
+    return is_written(spreadsheet.worksheet(TRANSACTIONS_SHEET).get(target), rows)
+
+
+async def async_trx_written(client, target: str, rows: list[list]) -> bool:
+    response = await client.values_get(trx_a1(target))
+    return is_written(response.get("values", []), rows)
+
+
 def separate_callback_data(data):
     """Separate the callback data"""
     return data.split(";")
 
 
+# Single letter calendar actions keep the callback data short
+CALENDAR_IGNORE = "I"
+CALENDAR_DAY = "D"
+CALENDAR_PREV_MONTH = "P"
+CALENDAR_NEXT_MONTH = "N"
+
+
 def create_calendar_callback_data(action, year, month, day):
     """Create the callback data associated to each button"""
-    return "CALENDAR" + ";" + ";".join([action, str(year), str(month), str(day)])
+    return "cal" + ";" + ";".join([action, str(year), str(month), str(day)])
 
 
 def create_calendar(year=None, month=None):
@@ -67,7 +304,7 @@ def create_calendar(year=None, month=None):
         year = now.year
     if month is None:
         month = now.month
-    data_ignore = create_calendar_callback_data("IGNORE", year, month, 0)
+    data_ignore = create_calendar_callback_data(CALENDAR_IGNORE, year, month, 0)
     keyboard = []
     # First row - Month and Year
     row = [
@@ -93,7 +330,7 @@ def create_calendar(year=None, month=None):
                     types.InlineKeyboardButton(
                         str(day),
                         callback_data=create_calendar_callback_data(
-                            "DAY", year, month, day
+                            CALENDAR_DAY, year, month, day
                         ),
                     )
                 )
@@ -102,12 +339,16 @@ def create_calendar(year=None, month=None):
     row = [
         types.InlineKeyboardButton(
             "<",
-            callback_data=create_calendar_callback_data("PREV-MONTH", year, month, day),
+            callback_data=create_calendar_callback_data(
+                CALENDAR_PREV_MONTH, year, month, day
+            ),
         ),
         types.InlineKeyboardButton(" ", callback_data=data_ignore),
         types.InlineKeyboardButton(
             ">",
-            callback_data=create_calendar_callback_data("NEXT-MONTH", year, month, day),
+            callback_data=create_calendar_callback_data(
+                CALENDAR_NEXT_MONTH, year, month, day
+            ),
         ),
     ]
     keyboard.append(row)
@@ -115,7 +356,14 @@ def create_calendar(year=None, month=None):
     return types.InlineKeyboardMarkup(keyboard)
 
 
-async def async_process_calendar_selection(call, bot_instance):
+def calendar_markup(keyboards, year: int, month: int):
+    """Calendar from the keyboard cache when one is given"""
+    if keyboards is None:
+        return create_calendar(year, month)
+    return keyboards.calendar(year, month)
+
+
+async def async_process_calendar_selection(call, bot_instance, keyboards=None):
     """
     Process the callback_query. This method generates a new calendar if forward or
     backward is pressed. This method should be called inside a CallbackQueryHandler.
@@ -123,25 +371,25 @@ async def async_process_calendar_selection(call, bot_instance):
     ret_data = (False, None)
     (_, action, year, month, day) = separate_callback_data(call.data)
     curr = datetime.datetime(int(year), int(month), 1)
-    if action == "IGNORE":
+    if action == CALENDAR_IGNORE:
         await bot_instance.answer_callback_query(callback_query_id=call.id)
-    elif action == "DAY":
+    elif action == CALENDAR_DAY:
         ret_data = True, datetime.datetime(int(year), int(month), int(day))
-    elif action == "PREV-MONTH":
+    elif action == CALENDAR_PREV_MONTH:
         pre = curr - datetime.timedelta(days=1)
         await bot_instance.edit_message_text(
             text=call.message.text,
             chat_id=call.message.chat.id,
             message_id=call.message.id,
-            reply_markup=create_calendar(int(pre.year), int(pre.month)),
+            reply_markup=calendar_markup(keyboards, int(pre.year), int(pre.month)),
         )
-    elif action == "NEXT-MONTH":
+    elif action == CALENDAR_NEXT_MONTH:
         ne = curr + datetime.timedelta(days=31)
         await bot_instance.edit_message_text(
             text=call.message.text,
             chat_id=call.message.chat.id,
             message_id=call.message.id,
-            reply_markup=create_calendar(int(ne.year), int(ne.month)),
+            reply_markup=calendar_markup(keyboards, int(ne.year), int(ne.month)),
         )
     else:
         await bot_instance.answer_callback_query(
@@ -150,7 +398,7 @@ async def async_process_calendar_selection(call, bot_instance):
     return ret_data
 
 
-def process_calendar_selection(call, bot_instance):
+def process_calendar_selection(call, bot_instance, keyboards=None):
     """
     Process the callback_query. This method generates a new calendar if forward or
     backward is pressed. This method should be called inside a CallbackQueryHandler.
@@ -158,25 +406,25 @@ def process_calendar_selection(call, bot_instance):
     ret_data = (False, None)
     (_, action, year, month, day) = separate_callback_data(call.data)
     curr = datetime.datetime(int(year), int(month), 1)
-    if action == "IGNORE":
+    if action == CALENDAR_IGNORE:
         bot_instance.answer_callback_query(callback_query_id=call.id)
-    elif action == "DAY":
+    elif action == CALENDAR_DAY:
         ret_data = True, datetime.datetime(int(year), int(month), int(day))
-    elif action == "PREV-MONTH":
+    elif action == CALENDAR_PREV_MONTH:
         pre = curr - datetime.timedelta(days=1)
         bot_instance.edit_message_text(
             text=call.message.text,
             chat_id=call.message.chat.id,
             message_id=call.message.id,
-            reply_markup=create_calendar(int(pre.year), int(pre.month)),
+            reply_markup=calendar_markup(keyboards, int(pre.year), int(pre.month)),
         )
-    elif action == "NEXT-MONTH":
+    elif action == CALENDAR_NEXT_MONTH:
         ne = curr + datetime.timedelta(days=31)
         bot_instance.edit_message_text(
             text=call.message.text,
             chat_id=call.message.chat.id,
             message_id=call.message.id,
-            reply_markup=create_calendar(int(ne.year), int(ne.month)),
+            reply_markup=calendar_markup(keyboards, int(ne.year), int(ne.month)),
         )
     else:
         bot_instance.answer_callback_query(
@@ -189,12 +437,21 @@ def create_category_callback_data(action, selection):
     return action + ";" + selection
 
 
-def create_category_inline(options, action):
+def create_category_inline(options, action, encode=None):
+    """
+    Two column keyboard of options, encode(option) gives the callback data
+    instead of action;option when provided
+    """
     cats_keyboard = [list(options)[i : i + 2] for i in range(0, len(list(options)), 2)]
     for i, x in enumerate(cats_keyboard):
         for j, k in enumerate(x):
             cats_keyboard[i][j] = types.InlineKeyboardButton(
-                k, callback_data=create_category_callback_data(action, str(k))
+                k,
+                callback_data=(
+                    encode(k)
+                    if encode
+                    else create_category_callback_data(action, str(k))
+                ),
             )
     if action == "save":
         cats_keyboard.append(
@@ -208,11 +465,16 @@ def create_category_inline(options, action):
     return types.InlineKeyboardMarkup(cats_keyboard)
 
 
-def create_account_inline(trx_accounts, action):
+def create_account_inline(trx_accounts, action, encode=None):
     accs_keyboard = [trx_accounts[i : i + 2] for i in range(0, len(trx_accounts), 2)]
     for i, x in enumerate(accs_keyboard):
         for j, k in enumerate(x):
             accs_keyboard[i][j] = types.InlineKeyboardButton(
-                k, callback_data=create_category_callback_data(action, str(k))
+                k,
+                callback_data=(
+                    encode(k)
+                    if encode
+                    else create_category_callback_data(action, str(k))
+                ),
             )
     return types.InlineKeyboardMarkup(accs_keyboard)
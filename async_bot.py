@@ -1,46 +1,75 @@
+import asyncio
+import contextvars
 import aspire_util
-from kink.errors.service_error import ServiceError
 from kink import di
+from logging import Logger
 from app_config import Configuration
 from telebot.async_telebot import AsyncTeleBot
 from telebot.callback_data import CallbackData
-from telebot import types
-from services import Action, TextUtil, TransactionData, DateUtil, KeyboardUtil
-from gspread import Spreadsheet
+from telebot import asyncio_helper, types
+from services import Action, TextUtil, DateUtil, KeyboardUtil, Session, SessionStore
+from uploader import TransactionUploader
+from keyboards import KeyboardCache
+from router import CallbackRouter, state_name
+from catalog import GROUP, CATEGORY, ACCOUNT, StaleCallbackError, Catalog, AsyncCatalog
+from importer import CsvImporter, ImportRowError, async_download, open_csv
+from metrics import MetricsRegistry, instrument_handlers
+from profiling import HandlerProfiler
 
 
 def async_bot_functions(bot_instance: AsyncTeleBot):
-    trx_categories = di["trx_categories"]
-    trx_accounts = di["trx_accounts"]
-    groups = di["groups"]
-    categories = di["categories"]
-    accounts = di["accounts"]
+    catalog = di[Catalog]
+    keyboards = di[KeyboardCache]
+    actions_filter = di[CallbackData].filter()
+    router = CallbackRouter()
+    sessions = di[SessionStore]
+    importer = di[CsvImporter]
 
-    @bot_instance.message_handler(state="*", commands=["cancel", "q"])
-    async def async_cancel_trx(message: types.Message):
+    async def async_cancel_session(session: Session):
         """
-        Clears state and cancel current transaction
+        Clears state and cancel current transaction of a session
         """
-        di[TransactionData].reset()
-        message = di["current_trx_message"]
-        if await bot_instance.get_state(di["state"]):
-            await bot_instance.delete_state(di["state"])
+        session.trx.reset()
+        session.batch = []
+        sessions.save(session)
+        if await bot_instance.get_state(session.user_id, session.chat_id):
+            await bot_instance.delete_state(session.user_id, session.chat_id)
+        if session.message_id is None:
+            di[Logger].debug("No current transaction.")
+            return
         await bot_instance.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=message.id,
+            chat_id=session.chat_id,
+            message_id=session.message_id,
             text="Transaction cancelled.",
         )
 
+    async def async_restart_session(session: Session):
+        """
+        Cancel whatever transaction the session had before starting a new one
+        """
+        try:
+            await async_cancel_session(session)
+        except asyncio_helper.ApiTelegramException as e:
+            # e.g. the previous message was deleted or is too old to edit
+            di[Logger].error(e)
+
+    @bot_instance.message_handler(state="*", commands=["cancel", "q"])
+    async def async_cancel_trx(message: types.Message):
+        """
+        Clears state and cancel current transaction
+        """
+        await async_cancel_session(sessions.for_message(message))
+
     @bot_instance.message_handler(state=[Action.outflow, Action.inflow], is_digit=False)
     async def async_invalid_amt(message: types.Message):
         await bot_instance.reply_to(message, "Please enter a number")
 
-    async def async_upload_trx(message: types.Message):
+    async def async_upload_trx(session: Session, message: types.Message):
         """
         Clears state and upload transaction to sheets
         """
-        await bot_instance.delete_state(di["state"])
-        await async_upload(message)
+        await bot_instance.delete_state(session.user_id, session.chat_id)
+        await async_upload(session, message)
 
     @bot_instance.message_handler(
         state=[Action.outflow, Action.inflow, Action.memo], restrict=True
@@ -49,32 +78,30 @@ def async_bot_functions(bot_instance: AsyncTeleBot):
         """
         Saves user input to selected option
         """
-        current_action = await bot_instance.get_state(di["state"])
-        di[TransactionData][current_action.name.capitalize()] = message.text
-        await async_item_selected(current_action, di["current_trx_message"])
+        session = sessions.for_message(message)
+        state = await bot_instance.get_state(session.user_id, session.chat_id)
+        current_action = Action[state_name(state)]
+        session.trx[current_action.name.capitalize()] = message.text
+        sessions.save(session)
+        await async_item_selected(session, current_action)
 
-    async def async_quick_save(message: types.Message):
-        await bot_instance.set_state(di["state"], Action.quick_end)
-        di["current_trx_message"] = await bot_instance.send_message(
+    async def async_quick_save(session: Session, message: types.Message):
+        await bot_instance.set_state(session.user_id, Action.quick_end, session.chat_id)
+        trx_message = await bot_instance.send_message(
             chat_id=message.chat.id,
             text="Current Transaction:",
-            reply_markup=KeyboardUtil.create_options_keyboard(),
+            reply_markup=KeyboardUtil.create_options_keyboard(session.trx),
         )
+        session.message_id = trx_message.message_id
+        sessions.save(session)
 
-    async def async_upload(message: types.Message):
+    async def async_upload(session: Session, message: types.Message):
         """
         Upload info to aspire google sheet
         """
-        upload_data = [
-            di[TransactionData]["Date"],
-            di[TransactionData]["Outflow"],
-            di[TransactionData]["Inflow"],
-            di[TransactionData]["Category"],
-            di[TransactionData]["Account"],
-            di[TransactionData]["Memo"],
-        ]
-        aspire_util.append_trx(di[Spreadsheet], upload_data)
-        di[TransactionData].reset()
+        di[TransactionUploader].enqueue(session.trx.to_row())
+        session.trx.reset()
+        sessions.save(session)
         await bot_instance.reply_to(message, "✅ Transaction Saved\n")
 
     @bot_instance.message_handler(regexp="^(A|a)dd(I|i)nc.+$", restrict=True)
@@ -82,16 +109,8 @@ def async_bot_functions(bot_instance: AsyncTeleBot):
         """
         Add income transaction using Today's date, Inflow Amount and Memo
         """
-        try:
-            await async_cancel_trx(di["current_trx_message"])
-        except ServiceError as e:
-            print("No current transaction.")
-        except Exception as e:
-            error_msg = getattr(e, "message", repr(e))
-            if "Bad Request: message is not modified" in error_msg:
-                print("Previous transaction was already cancelled.")
-        di["state"] = message.from_user.id
-        di[TransactionData].reset()
+        session = sessions.for_message(message)
+        await async_restart_session(session)
 
         result = TextUtil.text_splitter(message.text)
         del result[0]
@@ -108,26 +127,18 @@ def async_bot_functions(bot_instance: AsyncTeleBot):
             except ValueError:
                 await async_invalid_amt(message)
             else:
-                di[TransactionData]["Date"] = DateUtil.date_today()
-                di[TransactionData]["Inflow"] = inflow
-                di[TransactionData]["Memo"] = memo
-                await async_quick_save(message)
+                session.trx["Date"] = DateUtil.date_today()
+                session.trx["Inflow"] = inflow
+                session.trx["Memo"] = memo
+                await async_quick_save(session, message)
 
     @bot_instance.message_handler(regexp="^(A|a)dd(E|e)xp.+$", restrict=True)
     async def async_expense_trx(message: types.Message):
         """
         Add expense transaction using Today's date, Outflow Amount and Memo
         """
-        try:
-            await async_cancel_trx(di["current_trx_message"])
-        except ServiceError as e:
-            print("No current transaction.")
-        except Exception as e:
-            error_msg = getattr(e, "message", repr(e))
-            if "Bad Request: message is not modified" in error_msg:
-                print("Previous transaction was already cancelled.")
-        di["state"] = message.from_user.id
-        di[TransactionData].reset()
+        session = sessions.for_message(message)
+        await async_restart_session(session)
 
         result = TextUtil.text_splitter(message.text)
         del result[0]
@@ -144,54 +155,105 @@ def async_bot_functions(bot_instance: AsyncTeleBot):
             except ValueError:
                 await async_invalid_amt(message)
             else:
-                di[TransactionData]["Date"] = DateUtil.date_today()
-                di[TransactionData]["Outflow"] = outflow
-                di[TransactionData]["Memo"] = memo
-                await async_quick_save(message)
+                session.trx["Date"] = DateUtil.date_today()
+                session.trx["Outflow"] = outflow
+                session.trx["Memo"] = memo
+                await async_quick_save(session, message)
+
+    @bot_instance.message_handler(
+        func=lambda m: TextUtil.is_quick_add_batch(m.text), restrict=True
+    )
+    async def async_batch_trx(message: types.Message):
+        """
+        Add every AddExp/AddInc line of one message as a single batch,
+        confirmed once and saved in one write
+        """
+        session = sessions.for_message(message)
+        await async_restart_session(session)
+
+        rows, errors = [], []
+        for number, line in enumerate(message.text.strip().splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                rows.append(TextUtil.parse_quick_add(line))
+            except ValueError as e:
+                errors.append(f"Line {number}: {e}")
+        if errors:
+            await bot_instance.reply_to(message, "\n".join(errors), parse_mode="")
+            return
+        session.batch = rows
+        await bot_instance.set_state(session.user_id, Action.batch_end, session.chat_id)
+        batch_message = await bot_instance.send_message(
+            message.chat.id,
+            TextUtil.format_batch(rows),
+            reply_markup=keyboards.batch(),
+            parse_mode="",
+        )
+        session.message_id = batch_message.message_id
+        sessions.save(session)
+
+    @router.route(Action.batch_end, "batch_save", restrict=True)
+    async def async_save_batch(call: types.CallbackQuery):
+        """
+        Clears state and queue the whole batch for one write to sheets
+        """
+        session = sessions.for_call(call)
+        await bot_instance.delete_state(session.user_id, session.chat_id)
+        di[TransactionUploader].enqueue_batch(session.batch)
+        count = len(session.batch)
+        session.batch = []
+        # The confirmation stays, a later cancel must not edit this message
+        session.message_id = None
+        sessions.save(session)
+        await bot_instance.edit_message_text(
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            text=f"✅ {count} Transactions Saved",
+        )
 
-    @bot_instance.callback_query_handler(
-        func=lambda c: c.data == "back;category", state=Action.category_list
+    @router.route(
+        Action.category_list, "back", check=lambda c: c.data == "back;category"
     )
     async def async_back_to_category_groups_menu(call: types.CallbackQuery):
         """
         Return to category groups selection menu
         """
-        await bot_instance.set_state(di["state"], Action.category)
-        await category_select_start(call.message)
+        session = sessions.for_call(call)
+        await bot_instance.set_state(session.user_id, Action.category, session.chat_id)
+        await category_select_start(call.message.chat.id, call.message.id)
 
-    async def category_select_start(message: types.Message):
+    async def category_select_start(chat_id: int, message_id: int):
         # Creates a keyboard, each key has a callback_data : group_sel;"group name" e.g. group_sel:"Expenses"
         await bot_instance.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=message.id,
+            chat_id=chat_id,
+            message_id=message_id,
             text="Select Group:",
-            reply_markup=aspire_util.create_category_inline(
-                trx_categories.keys(), "group_sel"
-            ),
+            reply_markup=keyboards.groups(catalog.snapshot),
         )
 
-    async def account_sel_start(message: types.Message):
+    async def account_sel_start(chat_id: int, message_id: int):
         await bot_instance.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=message.id,
+            chat_id=chat_id,
+            message_id=message_id,
             text="Select Account:",
-            reply_markup=aspire_util.create_account_inline(trx_accounts, "acc_sel"),
+            reply_markup=keyboards.accounts(catalog.snapshot),
         )
 
-    async def date_sel_start(message: types.Message):
+    async def date_sel_start(chat_id: int, message_id: int):
         await bot_instance.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=message.id,
+            chat_id=chat_id,
+            message_id=message_id,
             text="Select Date:",
-            reply_markup=aspire_util.create_calendar(),
+            reply_markup=keyboards.calendar(),
         )
 
-    async def async_item_selected(action: Action, message: types.Message):
+    async def async_item_selected(session: Session, action: Action):
         """
         Process item selected through /start command
         """
-        await bot_instance.set_state(di["state"], action)
-        data = di[TransactionData][action.name.capitalize()]
+        await bot_instance.set_state(session.user_id, action, session.chat_id)
+        data = session.trx[action.name.capitalize()]
 
         if action == Action.outflow or action == Action.inflow:
             displayData = (
@@ -201,11 +263,11 @@ def async_bot_functions(bot_instance: AsyncTeleBot):
             displayData = data if data != "" else "''"
 
         if action == Action.category:
-            await category_select_start(message)
+            await category_select_start(session.chat_id, session.message_id)
         elif action == Action.account:
-            await account_sel_start(message)
+            await account_sel_start(session.chat_id, session.message_id)
         elif action == Action.date:
-            await date_sel_start(message)
+            await date_sel_start(session.chat_id, session.message_id)
         else:
             text = (
                 f"\[Current Value: "
@@ -214,88 +276,83 @@ def async_bot_functions(bot_instance: AsyncTeleBot):
                 + f"Enter {action.name.capitalize()} : "
             )
             await bot_instance.edit_message_text(
-                chat_id=message.chat.id,
-                message_id=message.id,
+                chat_id=session.chat_id,
+                message_id=session.message_id,
                 text=text,
-                reply_markup=KeyboardUtil.create_save_keyboard("save"),
+                reply_markup=keyboards.save("save"),
             )
 
-    @bot_instance.callback_query_handler(
-        func=None,
-        config=di[CallbackData].filter(),
-        state=[Action.start, Action.quick_end],
+    @router.route(
+        [Action.start, Action.quick_end, Action.batch_end],
+        "Action",
+        check=lambda c: actions_filter.check(query=c),
         restrict=True,
     )
     async def async_actions_callback(call: types.CallbackQuery):
         """
         Read and save state of bot depending on item selected from /start command
         """
+        session = sessions.for_call(call)
         callback_data: dict = di[CallbackData].parse(callback_data=call.data)
         actionId = int(callback_data["action_id"])
         action = Action(actionId)
 
         if action == Action.cancel:
-            await async_cancel_trx(di["current_trx_message"])
+            await async_cancel_session(session)
         elif action == Action.done:
-            await async_upload_trx(call.message)
+            await async_upload_trx(session, call.message)
         else:
-            await async_item_selected(action, call.message)
+            await async_item_selected(session, action)
 
-    @bot_instance.callback_query_handler(
-        func=lambda c: c.data in categories, state=Action.category_list, restrict=True
-    )
+    @router.route(Action.category_list, CATEGORY, restrict=True)
     async def async_get_category(call: types.CallbackQuery):
         """
         Get user selection and store to Category
         """
-        action, choice = aspire_util.separate_callback_data(call.data)
-        di[TransactionData]["Category"] = choice
+        choice = catalog.snapshot.decode(call.data)
+        sessions.for_call(call).trx["Category"] = choice
         await async_save_callback(call)
 
-    @bot_instance.callback_query_handler(
-        func=lambda c: c.data in accounts, state=Action.account, restrict=True
-    )
+    @router.route(Action.account, ACCOUNT, restrict=True)
     async def async_get_account(call: types.CallbackQuery):
         """
         Read user input and store to Account
         """
-        action, choice = aspire_util.separate_callback_data(call.data)
-        di[TransactionData]["Account"] = choice
+        choice = catalog.snapshot.decode(call.data)
+        sessions.for_call(call).trx["Account"] = choice
         await async_save_callback(call)
 
-    @bot_instance.callback_query_handler(func=None, state=Action.date)
+    @router.route(Action.date, "cal")
     async def async_get_date(call: types.CallbackQuery):
         """
         Read user selection from calendar and store to Date
         """
         selected, date = await aspire_util.async_process_calendar_selection(
-            call, bot_instance
+            call, bot_instance, keyboards
         )
         if selected:
-            di[TransactionData]["Date"] = date.strftime("%m/%d/%Y")
+            sessions.for_call(call).trx["Date"] = date.strftime("%m/%d/%Y")
             await async_save_callback(call)
 
-    @bot_instance.callback_query_handler(
-        func=lambda c: c.data in groups, state=Action.category
-    )
+    @router.route(Action.category, GROUP)
     async def async_list_categories(call: types.CallbackQuery):
         """
         Show categories as InlineKeyboard
         """
-        await bot_instance.set_state(di["state"], Action.category_list)
-        action, choice = aspire_util.separate_callback_data(call.data)
+        session = sessions.for_call(call)
+        await bot_instance.set_state(
+            session.user_id, Action.category_list, session.chat_id
+        )
+        choice = catalog.snapshot.decode(call.data)
         await bot_instance.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text="Select Category:",
-            reply_markup=aspire_util.create_category_inline(
-                trx_categories[choice], "save"
-            ),
+            reply_markup=keyboards.categories(catalog.snapshot, choice),
         )
 
-    @bot_instance.callback_query_handler(
-        func=lambda c: c.data == "save",
-        state=[
+    @router.route(
+        [
             Action.outflow,
             Action.inflow,
             Action.category,
@@ -303,28 +360,31 @@ def async_bot_functions(bot_instance: AsyncTeleBot):
             Action.memo,
             Action.date,
         ],
+        "save",
+        check=lambda c: c.data == "save",
     )
     async def async_save_callback(call: types.CallbackQuery):
         """
         Return to main menu of /start command showing new saved values
         """
-        await bot_instance.set_state(di["state"], Action.start)
+        session = sessions.for_call(call)
+        sessions.save(session)
+        await bot_instance.set_state(session.user_id, Action.start, session.chat_id)
         await bot_instance.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text="Current Transaction:",
-            reply_markup=KeyboardUtil.create_options_keyboard(),
+            reply_markup=KeyboardUtil.create_options_keyboard(session.trx),
         )
 
-    @bot_instance.callback_query_handler(
-        func=lambda c: c.data == "quick_save", state=Action.quick_end
-    )
+    @router.route(Action.quick_end, "quick_save")
     async def async_savequick_callback(call: types.CallbackQuery):
         """
         Clears state and upload to sheets for quick add functions
         """
-        await bot_instance.delete_state(di["state"])
-        await async_upload(call.message)
+        session = sessions.for_call(call)
+        await bot_instance.delete_state(session.user_id, session.chat_id)
+        await async_upload(session, call.message)
 
     @bot_instance.message_handler(commands=["start", "s"], restrict=True)
     async def async_command_start(message: types.Message):
@@ -332,19 +392,131 @@ def async_bot_functions(bot_instance: AsyncTeleBot):
         Start the conversation and ask user for input.
         Initialize with options to fill in.
         """
-        try:
-            await async_cancel_trx(di["current_trx_message"])
-        except ServiceError as e:
-            print("No current transaction.")
-        except Exception as e:
-            error_msg = getattr(e, "message", repr(e))
-            if "Bad Request: message is not modified" in error_msg:
-                print("Previous transaction was already cancelled.")
-        di["state"] = message.from_user.id
-        await bot_instance.set_state(di["state"], Action.start)
-        di[TransactionData]["Date"] = DateUtil.date_today()
-        di["current_trx_message"] = await bot_instance.send_message(
+        session = sessions.for_message(message)
+        await async_restart_session(session)
+        await bot_instance.set_state(session.user_id, Action.start, session.chat_id)
+        session.trx["Date"] = DateUtil.date_today()
+        trx_message = await bot_instance.send_message(
             message.chat.id,
             "Select Option:",
-            reply_markup=KeyboardUtil.create_default_options_keyboard(),
+            reply_markup=keyboards.default_options(),
         )
+        session.message_id = trx_message.message_id
+        sessions.save(session)
+
+    @bot_instance.callback_query_handler(func=lambda c: True)
+    async def async_route_callback(call: types.CallbackQuery):
+        """
+        Look up the user's state once and hand the callback to its route
+        """
+        state = await bot_instance.get_state(call.from_user.id, call.message.chat.id)
+        handler = router.resolve(state, call)
+        if handler is None:
+            return
+        try:
+            await handler(call)
+        except StaleCallbackError:
+            await bot_instance.answer_callback_query(
+                call.id, text="This menu is out of date, please start again."
+            )
+
+    @bot_instance.message_handler(commands=["reload"], restrict=True)
+    async def async_reload_catalog(message: types.Message):
+        """
+        Download categories and accounts again without waiting for the
+        next background refresh
+        """
+        if isinstance(catalog, AsyncCatalog):
+            await catalog.refresh(force=True)
+        else:
+            await asyncio.to_thread(catalog.refresh, True)
+        snapshot = catalog.snapshot
+        await bot_instance.reply_to(
+            message,
+            f"Reloaded {len(snapshot.names[CATEGORY])} categories"
+            + f" and {len(snapshot.names[ACCOUNT])} accounts.",
+        )
+
+    @bot_instance.message_handler(commands=["import"], restrict=True)
+    async def async_import_start(message: types.Message):
+        """
+        Wait for a CSV file to import into the Transactions sheet
+        """
+        session = sessions.for_message(message)
+        await async_restart_session(session)
+        await bot_instance.set_state(
+            session.user_id, Action.import_file, session.chat_id
+        )
+        await bot_instance.reply_to(
+            message,
+            "Send the CSV file to import, columns: "
+            + ", ".join(importer.mapping.columns.values()),
+            parse_mode="",
+        )
+
+    @bot_instance.message_handler(
+        content_types=["document"], state=Action.import_file, restrict=True
+    )
+    async def async_import_file(message: types.Message):
+        await bot_instance.delete_state(message.from_user.id, message.chat.id)
+        await async_import_document(message)
+
+    @bot_instance.message_handler(
+        content_types=["document"],
+        func=lambda m: (m.caption or "").split("@")[0].strip() == "/import",
+        restrict=True,
+    )
+    async def async_import_captioned_file(message: types.Message):
+        await async_import_document(message)
+
+    # Running imports, referenced until done so they are not collected
+    import_tasks = set()
+
+    async def async_import_document(message: types.Message):
+        """
+        Start importing the uploaded CSV as a task and return, so that the
+        update is answered before the import ends
+        """
+        if not importer.claim(message.document.file_unique_id):
+            await bot_instance.reply_to(
+                message, "This file was already sent for import.", parse_mode=""
+            )
+            return
+        status = await bot_instance.reply_to(message, "Importing...")
+        # Created in an empty context, the import is not part of this
+        # handler's Sheets and Telegram waits
+        task = contextvars.Context().run(
+            asyncio.get_running_loop().create_task, async_run_import(message, status)
+        )
+        import_tasks.add(task)
+        task.add_done_callback(import_tasks.discard)
+
+    async def async_run_import(message: types.Message, status: types.Message):
+        """
+        Stream the uploaded CSV into the sheet, editing a status message
+        with the progress
+        """
+
+        async def progress(job):
+            await bot_instance.edit_message_text(
+                job.progress(), message.chat.id, status.message_id, parse_mode=""
+            )
+
+        job = importer.job(catalog.snapshot)
+        try:
+            url = await bot_instance.get_file_url(message.document.file_id)
+            with await async_download(url) as file:
+                await importer.run(job, open_csv(file), progress)
+            text = job.summary()
+        except ImportRowError as e:
+            text = f"Import failed: {e}"
+        except Exception as e:
+            di[Logger].error(e)
+            text = f"Import stopped after {job.written} transactions: {e}"
+        if not job.written:
+            importer.release(message.document.file_unique_id)
+        await bot_instance.edit_message_text(
+            text, message.chat.id, status.message_id, parse_mode=""
+        )
+
+    instrument_handlers(di[MetricsRegistry], bot_instance, router, di[HandlerProfiler])
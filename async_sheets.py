@@ -0,0 +1,187 @@
+import asyncio
+import time
+import aiohttp
+from urllib.parse import quote
+from google.auth import crypt, jwt
+from sheets_policy import SheetsPolicy, parse_retry_after, sheets_operation
+
+SHEETS_API_URL = "https://sheets.googleapis.com"
+DRIVE_API_URL = "https://www.googleapis.com"
+JWT_GRANT_TYPE = "urn:ietf:params:oauth:grant-type:jwt-bearer"
+
+
+class SheetsAPIError(Exception):
+    def __init__(self, status: int, message: str, retry_after: float = None):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+def sheets_error(e: Exception):
+    """(status, retry_after) of a failed request of the aiohttp client"""
+    if isinstance(e, SheetsAPIError):
+        return e.status, e.retry_after
+    if isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)):
+        return None, None
+    return None
+
+
+class ServiceAccountToken:
+    """
+    OAuth access token of a service account, refreshed without blocking
+    the event loop shortly before it expires
+    """
+
+    def __init__(self, info: dict, scopes: list[str], refresh_margin: float = 60):
+        self._email = info["client_email"]
+        self._token_uri = info["token_uri"]
+        self._signer = crypt.RSASigner.from_service_account_info(info)
+        self._scopes = scopes
+        self._refresh_margin = refresh_margin
+        self._token = None
+        self._expiry = 0.0
+        self._lock = None
+
+    def invalidate(self):
+        self._token = None
+
+    async def get(self, session: aiohttp.ClientSession) -> str:
+        if self._token is not None and time.time() < self._expiry:
+            return self._token
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            # Another task may have refreshed it while we waited
+            if self._token is None or time.time() >= self._expiry:
+                await self._refresh(session)
+        return self._token
+
+    async def _refresh(self, session: aiohttp.ClientSession):
+        now = int(time.time())
+        assertion = jwt.encode(
+            self._signer,
+            {
+                "iss": self._email,
+                "scope": " ".join(self._scopes),
+                "aud": self._token_uri,
+                "iat": now,
+                "exp": now + 3600,
+            },
+        )
+        async with session.post(
+            self._token_uri,
+            data={"grant_type": JWT_GRANT_TYPE, "assertion": assertion.decode()},
+        ) as response:
+            body = await response.json(content_type=None)
+            if response.status >= 400:
+                raise SheetsAPIError(response.status, str(body))
+        self._token = body["access_token"]
+        self._expiry = now + int(body.get("expires_in", 3600)) - self._refresh_margin
+
+
+class AsyncSheetsClient:
+    """
+    Google Sheets v4 values API, plus the Drive modified time of the
+    spreadsheet, over one shared keep-alive aiohttp session.
+    The session is created on first use, so the client has to be used from
+    a single event loop.
+    """
+
+    def __init__(
+        self,
+        credentials: dict,
+        spreadsheet_id: str,
+        scopes: list[str],
+        base_url: str = SHEETS_API_URL,
+        timeout: float = 30.0,
+        pool_size: int = 4,
+        drive_url: str = DRIVE_API_URL,
+        policy: SheetsPolicy = None,
+    ):
+        self.id = spreadsheet_id
+        self._token = ServiceAccountToken(credentials, scopes)
+        self._base_url = base_url.rstrip("/") + "/v4/spreadsheets/" + spreadsheet_id
+        self._drive_url = drive_url.rstrip("/") + "/drive/v3/files/" + spreadsheet_id
+        self._timeout = timeout
+        self._pool_size = pool_size
+        self._policy = policy
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self._pool_size, keepalive_timeout=60
+                ),
+                timeout=aiohttp.ClientTimeout(total=self._timeout),
+            )
+        return self._session
+
+    async def _request(self, method: str, path: str, **kwargs) -> dict:
+        return await self._request_url(method, self._base_url + path, **kwargs)
+
+    async def _request_url(self, method: str, url: str, **kwargs) -> dict:
+        if self._policy is None:
+            return await self._send(method, url, **kwargs)
+        return await self._policy.async_call(
+            lambda: self._send(method, url, **kwargs),
+            sheets_error,
+            sheets_operation(method, url),
+        )
+
+    async def _send(self, method: str, url: str, **kwargs) -> dict:
+        session = self._get_session()
+        for attempt in range(2):
+            token = await self._token.get(session)
+            async with session.request(
+                method,
+                url,
+                headers={"Authorization": "Bearer " + token},
+                **kwargs,
+            ) as response:
+                if response.status == 401 and attempt == 0:
+                    self._token.invalidate()
+                    continue
+                if response.status >= 400:
+                    # The status decides on a retry, a proxy or an overloaded
+                    # frontend may answer with a body that is not JSON
+                    try:
+                        body = await response.json(content_type=None)
+                    except ValueError:
+                        body = await response.text()
+                    error = body.get("error", {}) if isinstance(body, dict) else {}
+                    raise SheetsAPIError(
+                        response.status,
+                        error.get("message", str(body)),
+                        parse_retry_after(response.headers.get("Retry-After")),
+                    )
+                return await response.json(content_type=None)
+
+    async def values_get(self, range_name: str) -> dict:
+        return await self._request("GET", "/values/" + quote(range_name, safe=""))
+
+    async def values_batch_get(self, ranges: list[str]) -> dict:
+        return await self._request(
+            "GET", "/values:batchGet", params=[("ranges", r) for r in ranges]
+        )
+
+    async def values_update(
+        self, range_name: str, values: list[list], value_input_option="USER_ENTERED"
+    ) -> dict:
+        return await self._request(
+            "PUT",
+            "/values/" + quote(range_name, safe=""),
+            params={"valueInputOption": value_input_option},
+            json={"range": range_name, "majorDimension": "ROWS", "values": values},
+        )
+
+    async def modified_time(self) -> str:
+        response = await self._request_url(
+            "GET", self._drive_url, params={"fields": "modifiedTime"}
+        )
+        return response["modifiedTime"]
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
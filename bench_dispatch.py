@@ -0,0 +1,149 @@
+"""
+Callback dispatch cost against catalog size, telebot filters with list
+membership (one state lookup per handler) versus CallbackRouter with index
+encoded callback data:
+
+    python bench_dispatch.py --sizes 10 100 1000 5000
+"""
+
+import argparse
+import timeit
+from kink import di
+from app_config import Configuration
+from telebot import TeleBot, types
+from telebot.callback_data import CallbackData
+from services import Action, StateFilter, RestrictAccessFilter, ActionsCallbackFilter
+from catalog import GROUP, CATEGORY, ACCOUNT, CatalogSnapshot
+from router import CallbackRouter
+
+USER_ID = 1
+
+
+def noop(call):
+    pass
+
+
+def make_call(data: str) -> types.CallbackQuery:
+    return types.CallbackQuery.de_json(
+        {
+            "id": "1",
+            "from": {"id": USER_ID, "is_bot": False, "first_name": "bench"},
+            "chat_instance": "1",
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": 1700000000,
+                "chat": {"id": USER_ID, "type": "private"},
+            },
+        }
+    )
+
+
+def make_bot() -> TeleBot:
+    bot = TeleBot("1:bench", threaded=False)
+    bot.add_custom_filter(StateFilter(bot))
+    bot.add_custom_filter(RestrictAccessFilter())
+    bot.add_custom_filter(ActionsCallbackFilter())
+    return bot
+
+
+def filter_bot(snapshot: CatalogSnapshot) -> TeleBot:
+    """Handlers registered the way the bot did before the router"""
+    bot = make_bot()
+    trx_categories = snapshot.trx_categories
+    groups = ["group_sel;" + s for s in trx_categories.keys()]
+    categories = ["save;" + s for l in trx_categories.values() for s in l]
+    accounts = ["acc_sel;" + s for s in snapshot.trx_accounts]
+    bot.callback_query_handler(
+        func=lambda c: c.data == "back;category", state=Action.category_list
+    )(noop)
+    bot.callback_query_handler(
+        func=None,
+        config=di[CallbackData].filter(),
+        state=[Action.start, Action.quick_end],
+        restrict=True,
+    )(noop)
+    bot.callback_query_handler(
+        func=lambda c: c.data in categories, state=Action.category_list, restrict=True
+    )(noop)
+    bot.callback_query_handler(
+        func=lambda c: c.data in accounts, state=Action.account, restrict=True
+    )(noop)
+    bot.callback_query_handler(func=None, state=Action.date)(noop)
+    bot.callback_query_handler(func=lambda c: c.data in groups, state=Action.category)(
+        noop
+    )
+    return bot
+
+
+def router_bot(snapshot: CatalogSnapshot) -> TeleBot:
+    bot = make_bot()
+
+    def decode(call):
+        snapshot.decode(call.data)
+
+    router = CallbackRouter()
+    actions_filter = di[CallbackData].filter()
+    router.route(
+        Action.category_list, "back", check=lambda c: c.data == "back;category"
+    )(noop)
+    router.route(
+        [Action.start, Action.quick_end],
+        "Action",
+        check=lambda c: actions_filter.check(query=c),
+        restrict=True,
+    )(noop)
+    router.route(Action.category_list, CATEGORY, restrict=True)(decode)
+    router.route(Action.account, ACCOUNT, restrict=True)(decode)
+    router.route(Action.date, "cal")(noop)
+    router.route(Action.category, GROUP)(decode)
+
+    @bot.callback_query_handler(func=lambda c: True)
+    def route_callback(call):
+        handler = router.resolve(bot.get_state(USER_ID, USER_ID), call)
+        if handler is not None:
+            handler(call)
+
+    return bot
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Callback dispatch benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    di[Configuration] = {"restrict_access": True, "list_of_users": [USER_ID]}
+    di[CallbackData] = CallbackData("action_id", prefix="Action")
+
+    print(f"{'categories':>10}{'filters us':>12}{'router us':>12}{'speedup':>10}")
+    for size in args.sizes:
+        snapshot = CatalogSnapshot(
+            1,
+            "",
+            {"Group": [f"Category {i}" for i in range(size)]},
+            [f"Account {i}" for i in range(size)],
+        )
+        # The last category of the list is the worst case for a list scan
+        name = f"Category {size - 1}"
+        results = []
+        for bot, call in (
+            (filter_bot(snapshot), make_call("save;" + name)),
+            (router_bot(snapshot), make_call(snapshot.encode(CATEGORY, name))),
+        ):
+            bot.set_state(USER_ID, Action.category_list, USER_ID)
+            results.append(
+                timeit.timeit(
+                    lambda: bot.process_new_callback_query([call]), number=args.number
+                )
+                / args.number
+            )
+        before, after = results
+        print(
+            f"{size:>10}{before * 1e6:>12.1f}{after * 1e6:>12.1f}"
+            f"{before / after:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+CPU per keyboard edit, building the markup on every edit versus serving it
+from KeyboardCache:
+
+    python bench_keyboards.py --groups 8 --categories 8 --accounts 6
+"""
+
+import argparse
+import timeit
+from kink import di
+from telebot import apihelper
+from telebot.callback_data import CallbackData
+from catalog import CatalogSnapshot
+from keyboards import KeyboardCache
+import aspire_util
+from services import KeyboardUtil
+
+
+def fake_snapshot(groups: int, categories: int, accounts: int) -> CatalogSnapshot:
+    trx_categories = {
+        f"Group {g}": [f"Category {g}.{c}" for c in range(categories)]
+        for g in range(groups)
+    }
+    return CatalogSnapshot(
+        1, "", trx_categories, [f"Account {a}" for a in range(accounts)]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keyboard cache benchmark")
+    parser.add_argument("--groups", type=int, default=8)
+    parser.add_argument("--categories", type=int, default=8)
+    parser.add_argument("--accounts", type=int, default=6)
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    di[CallbackData] = CallbackData("action_id", prefix="Action")
+    snapshot = fake_snapshot(args.groups, args.categories, args.accounts)
+    group = next(iter(snapshot.trx_categories))
+    keyboards = KeyboardCache()
+
+    # The markup is serialized by apihelper right before the request
+    uncached = {
+        "calendar": lambda: aspire_util.create_calendar(2024, 2),
+        "groups": lambda: aspire_util.create_category_inline(
+            snapshot.trx_categories.keys(), "group_sel"
+        ),
+        "categories": lambda: aspire_util.create_category_inline(
+            snapshot.trx_categories[group], "save"
+        ),
+        "accounts": lambda: aspire_util.create_account_inline(
+            snapshot.trx_accounts, "acc_sel"
+        ),
+        "default_options": KeyboardUtil.create_default_options_keyboard,
+    }
+    cached = {
+        "calendar": lambda: keyboards.calendar(2024, 2),
+        "groups": lambda: keyboards.groups(snapshot),
+        "categories": lambda: keyboards.categories(snapshot, group),
+        "accounts": lambda: keyboards.accounts(snapshot),
+        "default_options": keyboards.default_options,
+    }
+
+    print(f"{'keyboard':<16}{'built us':>12}{'cached us':>12}{'speedup':>10}")
+    for kind in uncached:
+        before = timeit.timeit(
+            lambda: apihelper._convert_markup(uncached[kind]()), number=args.number
+        )
+        after = timeit.timeit(
+            lambda: apihelper._convert_markup(cached[kind]()), number=args.number
+        )
+        print(
+            f"{kind:<16}{before / args.number * 1e6:>12.1f}"
+            f"{after / args.number * 1e6:>12.1f}{before / after:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
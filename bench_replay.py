@@ -0,0 +1,548 @@
+"""
+Update throughput of both bot modes, replaying a corpus of updates from
+simulated users through the webhook app (receive_updates) and straight
+into process_new_updates. Telegram and Sheets are replaced by in-process
+stubs with a configurable latency:
+
+    python bench_replay.py --users 200 --concurrency 16 --output results.json
+    python bench_replay.py --corpus updates.jsonl --modes async --entries webhook
+
+A corpus is a file of Update JSON objects, one per line. Updates are
+grouped per user and each user's updates are replayed in order. Without
+--corpus a synthetic one walks every simulated user through /start and a
+quick add; --write-corpus saves it for later runs.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+from importlib import metadata
+import platform
+import statistics
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import telebot
+from kink import di
+from logging import Logger
+from app_config import Configuration
+from telebot import apihelper, asyncio_helper, types
+from telebot.callback_data import CallbackData
+from telebot.storage import StateMemoryStorage
+from telebot.asyncio_storage import StateMemoryStorage as AsyncStateMemoryStorage
+from services import (
+    Action,
+    BotFactory,
+    SessionStore,
+    ExceptionHandler,
+    RestrictAccessFilter,
+    StateFilter,
+    IsDigitFilter,
+    ActionsCallbackFilter,
+    AsyncRestrictAccessFilter,
+    AsyncStateFilter,
+    AsyncIsDigitFilter,
+    AsyncActionsCallbackFilter,
+    BackgroundLoop,
+)
+from catalog import GROUP, CATEGORY, ACCOUNT, Catalog, AsyncCatalog
+from keyboards import KeyboardCache
+from edits import EditTracker, TrackedTeleBot, AsyncTrackedTeleBot
+from outbound import OutboundScheduler, AsyncOutboundScheduler
+from uploader import TransactionUploader, AsyncTransactionUploader
+from importer import ImportMapping, CsvImporter, AsyncCsvImporter
+from metrics import MetricsRegistry, instrument_telegram
+from profiling import HandlerProfiler
+from sheets_policy import SheetsPolicy, gspread_error
+from sheets_executor import SheetsExecutor
+from sheets_stub import StubSpreadsheet
+from dispatcher import shard_key
+from gspread.worksheet import ValueRange
+from webhook import create_app
+from async_bot import async_bot_functions
+from sync_bot import sync_bot_functions
+import aspire_util
+
+FIRST_USER_ID = 10000
+WEBHOOK_PATH = "/bench/"
+_spreadsheet_ids = itertools.count(1)
+
+
+class StubTelegram:
+    """
+    Bot API stand-in for both telebot helpers. Every method answers after
+    latency seconds, sends and edits with the message they produce.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.requests = 0
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _result(self, method_name: str, params: dict):
+        with self._lock:
+            self.requests += 1
+        if method_name in ("sendMessage", "editMessageText"):
+            return {
+                "message_id": params.get("message_id") or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        return True
+
+    def make_request(self, token, method_name, method="get", params=None, **kwargs):
+        time.sleep(self.latency)
+        return self._result(method_name, params or {})
+
+    async def process_request(
+        self, token, url, method="get", params=None, files=None, **kwargs
+    ):
+        await asyncio.sleep(self.latency)
+        return self._result(url, params or {})
+
+    def install(self):
+        apihelper._make_request = self.make_request
+        asyncio_helper._process_request = self.process_request
+
+
+class StubWorksheet:
+    def __init__(self, sheets: "StubSheets", title: str):
+        self._sheets = sheets
+        self._title = title
+
+    def _range(self, range_name: str) -> str:
+        if range_name in self._sheets.spreadsheet.named_ranges:
+            return range_name
+        return f"{self._title}!{range_name}"
+
+    def get(self, range_name: str) -> ValueRange:
+        return self._sheets.request(
+            "values.get",
+            lambda: ValueRange.from_json(
+                self._sheets.spreadsheet.read(self._range(range_name))
+            ),
+        )
+
+    def update(self, values: list, range_name: str, **kwargs):
+        return self._sheets.request(
+            "values.update",
+            lambda: self._sheets.spreadsheet.write(self._range(range_name), values),
+        )
+
+
+class StubSheets:
+    """
+    gspread Spreadsheet stand-in over the sheets_stub grid, every request
+    goes through the SheetsPolicy and takes latency seconds
+    """
+
+    def __init__(self, latency: float, policy: SheetsPolicy):
+        # A new id per run, row cursors are kept per spreadsheet id
+        self.id = "bench-%d" % next(_spreadsheet_ids)
+        self.spreadsheet = StubSpreadsheet()
+        self._latency = latency
+        self._policy = policy
+
+    def request(self, operation: str, fn):
+        def call():
+            time.sleep(self._latency)
+            return fn()
+
+        return self._policy.call(call, gspread_error, operation)
+
+    def worksheet(self, title: str) -> StubWorksheet:
+        return StubWorksheet(self, title)
+
+    def get_lastUpdateTime(self) -> str:
+        return self.request("drive.get", lambda: self.spreadsheet.modified_time)
+
+    def values_batch_get(self, ranges: list[str]) -> dict:
+        return self.request(
+            "values.batchGet",
+            lambda: {"valueRanges": [self.spreadsheet.read(r) for r in ranges]},
+        )
+
+
+class AsyncStubSheets(StubSheets):
+    """
+    AsyncSheetsClient stand-in over the sheets_stub grid
+    """
+
+    async def async_request(self, operation: str, fn):
+        async def call():
+            await asyncio.sleep(self._latency)
+            return fn()
+
+        return await self._policy.async_call(call, gspread_error, operation)
+
+    async def values_get(self, range_name: str) -> dict:
+        return await self.async_request(
+            "values.get", lambda: self.spreadsheet.read(range_name)
+        )
+
+    async def values_batch_get(self, ranges: list[str]) -> dict:
+        return await self.async_request(
+            "values.batchGet",
+            lambda: {"valueRanges": [self.spreadsheet.read(r) for r in ranges]},
+        )
+
+    async def values_update(self, range_name: str, values: list[list], **kwargs):
+        return await self.async_request(
+            "values.update", lambda: self.spreadsheet.write(range_name, values)
+        )
+
+    async def modified_time(self) -> str:
+        return await self.async_request(
+            "drive.get", lambda: self.spreadsheet.modified_time
+        )
+
+
+class CountingExceptionHandler(ExceptionHandler):
+    def __init__(self):
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def handle(self, exception):
+        with self._lock:
+            self.errors += 1
+        return super().handle(exception)
+
+
+class BenchServices:
+    """
+    The services startup.configure_services sets up, over the stubs
+    """
+
+    def __init__(self, mode: str, args):
+        self.mode = mode
+        self.errors = CountingExceptionHandler()
+        self.loop = None
+        self.executor = None
+        # main allows the users of the corpus once it is built
+        di[Configuration] = {
+            "currency": "$",
+            "restrict_access": True,
+            "list_of_users": set(),
+        }
+        di[MetricsRegistry] = MetricsRegistry()
+        di[HandlerProfiler] = HandlerProfiler()
+        di[EditTracker] = EditTracker()
+        di[SessionStore] = SessionStore(max_sessions=max(1000, args.users))
+        di[CallbackData] = CallbackData("action_id", prefix="Action")
+        di[KeyboardCache] = KeyboardCache()
+        policy = SheetsPolicy(
+            quota_per_minute=1_000_000_000, metrics=di[MetricsRegistry]
+        )
+        limits = dict(
+            global_rate=args.outbound_global_rate,
+            chat_rate=args.outbound_chat_rate,
+            chat_burst=args.outbound_chat_burst,
+        )
+
+        if mode == "async":
+            self.loop = BackgroundLoop("bench-loop")
+            self.loop.start()
+            di[BackgroundLoop] = self.loop
+            bot_instance = AsyncTrackedTeleBot(
+                token="1:bench",
+                parse_mode="MARKDOWN",
+                exception_handler=self.errors,
+                edit_tracker=di[EditTracker],
+                outbound=AsyncOutboundScheduler(**limits),
+                state_storage=AsyncStateMemoryStorage(),
+            )
+            self.bot = BotFactory(
+                bot_instance=bot_instance,
+                restrict_access_filter=AsyncRestrictAccessFilter(),
+                state_filter=AsyncStateFilter(bot_instance),
+                is_digit_filter=AsyncIsDigitFilter(),
+                actions_callback_filter=AsyncActionsCallbackFilter(),
+            ).create_bot()
+            sheets = AsyncStubSheets(args.sheets_latency, policy)
+            self.catalog = AsyncCatalog(sheets, self.loop)
+            self.loop.run(self.catalog.refresh(force=True))
+            self.uploader = AsyncTransactionUploader(sheets, self.loop)
+            importer = AsyncCsvImporter(ImportMapping(), self.uploader.write)
+        else:
+            bot_instance = TrackedTeleBot(
+                token="1:bench",
+                parse_mode="MARKDOWN",
+                exception_handler=self.errors,
+                edit_tracker=di[EditTracker],
+                outbound=OutboundScheduler(**limits),
+                threaded=False,
+                state_storage=StateMemoryStorage(),
+            )
+            self.bot = BotFactory(
+                bot_instance=bot_instance,
+                restrict_access_filter=RestrictAccessFilter(),
+                state_filter=StateFilter(bot_instance),
+                is_digit_filter=IsDigitFilter(),
+                actions_callback_filter=ActionsCallbackFilter(),
+            ).create_bot()
+            self.executor = SheetsExecutor(max_workers=4, queue_limit=10000)
+            sheets = StubSheets(args.sheets_latency, policy)
+            self.catalog = Catalog(sheets, executor=self.executor)
+            self.catalog.refresh(force=True)
+            self.uploader = TransactionUploader(sheets, executor=self.executor)
+            importer = CsvImporter(ImportMapping(), self.uploader.write)
+
+        di[Catalog] = self.catalog
+        di[TransactionUploader] = self.uploader
+        di[CsvImporter] = importer
+        self.uploader.start()
+        if mode == "async":
+            async_bot_functions(self.bot)
+        else:
+            sync_bot_functions(self.bot)
+        self.app = create_app(self.bot, WEBHOOK_PATH)
+
+    def process(self, update: types.Update):
+        if self.mode == "async":
+            self.loop.run(self.bot.process_new_updates([update]))
+        else:
+            self.bot.process_new_updates([update])
+
+    def close(self):
+        self.uploader.stop()
+        if self.loop is not None:
+            self.loop.stop()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def synthetic_corpus(users: int, rounds: int, snapshot) -> list[dict]:
+    """
+    Every user fills a transaction through /start, browsing the category,
+    account and calendar keyboards, then saves a quick add, rounds times
+    """
+    update_ids = itertools.count(1)
+    group = snapshot.names[GROUP][0]
+    category = snapshot.trx_categories[group][0]
+    account = snapshot.names[ACCOUNT][0]
+    today = time.localtime()
+    previous = (today.tm_year - (today.tm_mon == 1), (today.tm_mon - 2) % 12 + 1)
+    action = di[CallbackData].new
+    script = [
+        "/start",
+        ("cb", action(action_id=int(Action.outflow))),
+        "12",
+        ("cb", "save"),
+        ("cb", action(action_id=int(Action.category))),
+        ("cb", snapshot.encode(GROUP, group)),
+        ("cb", snapshot.encode(CATEGORY, category)),
+        ("cb", action(action_id=int(Action.account))),
+        ("cb", snapshot.encode(ACCOUNT, account)),
+        ("cb", action(action_id=int(Action.date))),
+        (
+            "cb",
+            aspire_util.create_calendar_callback_data(
+                aspire_util.CALENDAR_PREV_MONTH, today.tm_year, today.tm_mon, 1
+            ),
+        ),
+        (
+            "cb",
+            aspire_util.create_calendar_callback_data(
+                aspire_util.CALENDAR_DAY, *previous, 15
+            ),
+        ),
+        ("cb", action(action_id=int(Action.done))),
+        "AddExp 4.50 Coffee",
+        ("cb", "quick_save"),
+    ]
+    corpus = []
+    for _ in range(rounds):
+        for step in script:
+            for user_id in range(FIRST_USER_ID, FIRST_USER_ID + users):
+                sender = {"id": user_id, "is_bot": False, "first_name": "bench"}
+                message = {
+                    "message_id": 1,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "text": "Select Option:",
+                }
+                update_id = next(update_ids)
+                if isinstance(step, str):
+                    entities = (
+                        [{"type": "bot_command", "offset": 0, "length": len(step)}]
+                        if step.startswith("/")
+                        else []
+                    )
+                    corpus.append(
+                        {
+                            "update_id": update_id,
+                            "message": dict(
+                                message,
+                                message_id=update_id,
+                                text=step,
+                                entities=entities,
+                                **{"from": sender},
+                            ),
+                        }
+                    )
+                else:
+                    corpus.append(
+                        {
+                            "update_id": update_id,
+                            "callback_query": {
+                                "id": str(update_id),
+                                "from": sender,
+                                "chat_instance": str(user_id),
+                                "data": step[1],
+                                "message": message,
+                            },
+                        }
+                    )
+    return corpus
+
+
+def load_corpus(path: str) -> list[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def replay(services: BenchServices, entry: str, corpus: list[dict], concurrency: int):
+    """
+    Replay each user's updates in order, up to concurrency users at once.
+    Returns the wall time and the latency of every update.
+    """
+    sequences: dict[int, list] = {}
+    for update in corpus:
+        if entry == "webhook":
+            item = json.dumps(update)
+        else:
+            item = types.Update.de_json(update)
+        sequences.setdefault(shard_key(update), []).append(item)
+
+    def run_user(updates: list) -> list[float]:
+        client = services.app.test_client()
+        latencies = []
+        for item in updates:
+            start = time.perf_counter()
+            if entry == "webhook":
+                client.post(WEBHOOK_PATH, data=item, content_type="application/json")
+            else:
+                try:
+                    services.process(item)
+                except Exception:
+                    # Already counted by the exception handler
+                    pass
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency, thread_name_prefix="bench-user") as pool:
+        latencies = [
+            latency
+            for user in pool.map(run_user, sequences.values())
+            for latency in user
+        ]
+    return time.perf_counter() - start, latencies
+
+
+def percentile(values: list[float], p: float) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[int(p) - 1]
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Update replay benchmark")
+    parser.add_argument("--modes", nargs="+", default=["sync", "async"])
+    parser.add_argument("--entries", nargs="+", default=["webhook", "direct"])
+    parser.add_argument("--corpus", help="file of Update JSON objects, one per line")
+    parser.add_argument("--write-corpus", help="save the synthetic corpus here")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--sheets-latency", type=float, default=0.1)
+    # Unpaced by default, the outbound limits would cap the throughput
+    parser.add_argument("--outbound-global-rate", type=float, default=1e9)
+    parser.add_argument("--outbound-chat-rate", type=float, default=1e9)
+    parser.add_argument("--outbound-chat-burst", type=int, default=1_000_000)
+    parser.add_argument("--output", help="write the results as JSON here")
+    args = parser.parse_args()
+
+    di[Logger] = telebot.logger
+    telegram = StubTelegram(args.telegram_latency)
+    results = []
+    print(
+        f"{'mode':>6}{'entry':>9}{'updates':>9}{'errors':>8}"
+        f"{'upd/s':>10}{'p50 ms':>9}{'p99 ms':>9}"
+    )
+    for mode in args.modes:
+        for entry in args.entries:
+            services = BenchServices(mode, args)
+            telegram.install()
+            instrument_telegram(di[MetricsRegistry])
+            if args.corpus:
+                corpus = load_corpus(args.corpus)
+            else:
+                corpus = synthetic_corpus(
+                    args.users, args.rounds, services.catalog.snapshot
+                )
+                if args.write_corpus:
+                    with open(args.write_corpus, "w") as f:
+                        f.writelines(json.dumps(u) + "\n" for u in corpus)
+            di[Configuration]["list_of_users"] = {shard_key(u) for u in corpus}
+            requests_before = telegram.requests
+            try:
+                elapsed, latencies = replay(services, entry, corpus, args.concurrency)
+            finally:
+                services.close()
+            result = {
+                "mode": mode,
+                "entry": entry,
+                "updates": len(latencies),
+                "errors": services.errors.errors,
+                "seconds": elapsed,
+                "updates_per_second": len(latencies) / elapsed,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "telegram_requests": telegram.requests - requests_before,
+                "pending_transactions": services.uploader.pending(),
+            }
+            results.append(result)
+            print(
+                f"{mode:>6}{entry:>9}{result['updates']:>9}{result['errors']:>8}"
+                f"{result['updates_per_second']:>10.1f}"
+                f"{result['p50_ms']:>9.1f}{result['p99_ms']:>9.1f}"
+            )
+
+    if args.output:
+        options = vars(args)
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "revision": git_revision(),
+                    "python": platform.python_version(),
+                    "telebot": metadata.version("pyTelegramBotAPI"),
+                    "options": options,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import aspire_util
+from concurrent.futures import Future
+from kink import di
+from logging import Logger
+from services import BackgroundLoop
+from sheets_executor import SheetsExecutor
+from sheets_policy import background
+
+GROUP = "g"
+CATEGORY = "c"
+ACCOUNT = "a"
+# Seconds between checks of the snapshot file when following another process
+FOLLOW_INTERVAL = 5.0
+
+
+class StaleCallbackError(LookupError):
+    """
+    Callback data encoded against another version of the catalog
+    """
+
+
+class CatalogSnapshot:
+    """
+    Categories and accounts of one spreadsheet revision, never modified
+    once built. Callback data refers to groups, categories and accounts by
+    their index, as kind;tag;index where tag is a digest of the content.
+    """
+
+    __slots__ = (
+        "version",
+        "modified",
+        "tag",
+        "trx_categories",
+        "trx_accounts",
+        "names",
+        "_ids",
+    )
+
+    def __init__(
+        self,
+        version: int,
+        modified: str,
+        trx_categories: dict[str, list],
+        trx_accounts: list[str],
+    ):
+        self.version = version
+        self.modified = modified
+        self.trx_categories = trx_categories
+        self.trx_accounts = trx_accounts
+        self.tag = hashlib.blake2b(
+            json.dumps([trx_categories, trx_accounts]).encode(), digest_size=3
+        ).hexdigest()
+        self.names = {
+            GROUP: list(trx_categories.keys()),
+            CATEGORY: list(
+                dict.fromkeys(s for l in trx_categories.values() for s in l)
+            ),
+            ACCOUNT: list(trx_accounts),
+        }
+        self._ids = {
+            kind: {name: i for i, name in enumerate(names)}
+            for kind, names in self.names.items()
+        }
+
+    def contains(self, kind: str, name: str) -> bool:
+        return name in self._ids[kind]
+
+    def encode(self, kind: str, name: str) -> str:
+        return f"{kind};{self.tag};{self._ids[kind][name]}"
+
+    def decode(self, data: str) -> str:
+        """
+        Name a callback data refers to, raises StaleCallbackError when it
+        was encoded against another catalog
+        """
+        kind, tag, index = data.split(";")
+        if tag != self.tag:
+            raise StaleCallbackError(data)
+        return self.names[kind][int(index)]
+
+
+class Catalog:
+    """
+    Categories and accounts refreshed in the background. The spreadsheet is
+    only downloaded again when its modified time changed, concurrent
+    refreshes share one download and readers see the new snapshot at once.
+    Every snapshot is also saved to snapshot_path so the next start can use
+    it before the spreadsheet is checked. With follow, the spreadsheet is
+    not polled, the snapshot another process saves is loaded instead.
+    """
+
+    def __init__(
+        self,
+        spreadsheet,
+        refresh_interval: float = 300,
+        executor: SheetsExecutor = None,
+        snapshot_path: str = None,
+        follow: bool = False,
+    ):
+        self.snapshot: CatalogSnapshot = None
+        self._spreadsheet = spreadsheet
+        self._refresh_interval = refresh_interval
+        self._executor = executor
+        self._snapshot_path = snapshot_path
+        self._follow = follow and bool(snapshot_path)
+        self._snapshot_mtime = None
+        self._revalidate = False
+        self._lock = threading.Lock()
+        self._inflight: Future = None
+        self._inflight_forced = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="catalog-refresh", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def load_snapshot(self) -> bool:
+        """
+        Use the snapshot saved by a previous run, the first background
+        refresh then checks it against the spreadsheet right away
+        """
+        if not self._snapshot_path:
+            return False
+        try:
+            mtime = os.stat(self._snapshot_path).st_mtime
+            with open(self._snapshot_path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        self._snapshot_mtime = mtime
+        if saved.get("spreadsheet_id") != self._spreadsheet.id:
+            return False
+        self.snapshot = CatalogSnapshot(
+            saved["version"],
+            saved["modified"],
+            saved["trx_categories"],
+            saved["trx_accounts"],
+        )
+        self._revalidate = True
+        return True
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Download the catalog if the spreadsheet changed, or always when
+        forced. Returns whether categories or accounts changed. A forced
+        call arriving during a normal refresh, which may skip the download,
+        starts its own once that one is done.
+        """
+        while True:
+            with self._lock:
+                future = self._inflight
+                if future is None:
+                    future = self._inflight = Future()
+                    self._inflight_forced = force
+                    break
+                joined = self._inflight_forced or not force
+            if joined:
+                return future.result()
+            try:
+                future.result()
+            except Exception:
+                pass
+        try:
+            changed = self._call(self._refresh, force)
+            future.set_result(changed)
+            return changed
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight = None
+
+    def _call(self, fn, *args):
+        if self._executor is None:
+            return fn(*args)
+        return self._executor.call(fn, *args)
+
+    def _refresh(self, force: bool) -> bool:
+        # Only a forced refresh, e.g. /reload, competes with user writes for
+        # the Sheets quota
+        with background(not force):
+            modified = self._spreadsheet.get_lastUpdateTime()
+            if not force and self.snapshot and self.snapshot.modified == modified:
+                return False
+            trx_categories, trx_accounts = aspire_util.get_catalog(self._spreadsheet)
+        return self._install(modified, trx_categories, trx_accounts)
+
+    def _install(self, modified: str, trx_categories, trx_accounts) -> bool:
+        """
+        Keep the version when categories and accounts are unchanged, the
+        bot's own transaction writes change the modified time as well
+        """
+        current = self.snapshot
+        changed = current is None or (
+            (current.trx_categories, current.trx_accounts)
+            != (trx_categories, trx_accounts)
+        )
+        version = current.version if current else 0
+        if changed:
+            version += 1
+        self.snapshot = CatalogSnapshot(version, modified, trx_categories, trx_accounts)
+        self._save_snapshot()
+        return changed
+
+    def _save_snapshot(self):
+        if not self._snapshot_path:
+            return
+        snapshot = self.snapshot
+        saved = {
+            "spreadsheet_id": self._spreadsheet.id,
+            "version": snapshot.version,
+            "modified": snapshot.modified,
+            "trx_categories": snapshot.trx_categories,
+            "trx_accounts": snapshot.trx_accounts,
+        }
+        try:
+            with open(self._snapshot_path + ".tmp", "w") as f:
+                json.dump(saved, f)
+            os.replace(self._snapshot_path + ".tmp", self._snapshot_path)
+            self._snapshot_mtime = os.stat(self._snapshot_path).st_mtime
+        except OSError as e:
+            di[Logger].error(e)
+
+    def follow_snapshot(self):
+        """Load the snapshot file again when another process saved it"""
+        try:
+            mtime = os.stat(self._snapshot_path).st_mtime
+        except OSError:
+            return
+        if mtime != self._snapshot_mtime:
+            self.load_snapshot()
+
+    def _run(self):
+        if self._follow:
+            while not self._stopped.wait(FOLLOW_INTERVAL):
+                self.follow_snapshot()
+            return
+        if not self._revalidate:
+            self._stopped.wait(self._refresh_interval)
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                di[Logger].error(e)
+            self._stopped.wait(self._refresh_interval)
+
+
+class AsyncCatalog(Catalog):
+    """
+    Catalog refreshed by a task on a background event loop through the
+    aiohttp Sheets client
+    """
+
+    def __init__(
+        self,
+        client,
+        loop: BackgroundLoop,
+        refresh_interval: float = 300,
+        snapshot_path: str = None,
+        follow: bool = False,
+    ):
+        super().__init__(
+            client, refresh_interval, snapshot_path=snapshot_path, follow=follow
+        )
+        self._loop = loop
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = self._loop.submit(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def refresh(self, force: bool = False) -> bool:
+        while True:
+            inflight = self._inflight
+            if inflight is None or inflight.done():
+                inflight = self._inflight = asyncio.ensure_future(self._refresh(force))
+                self._inflight_forced = force
+                inflight.add_done_callback(self._refresh_done)
+                break
+            if self._inflight_forced or not force:
+                break
+            await asyncio.wait([inflight])
+        return await asyncio.shield(inflight)
+
+    def _refresh_done(self, task: asyncio.Task):
+        if self._inflight is task:
+            self._inflight = None
+
+    async def _refresh(self, force: bool) -> bool:
+        with background(not force):
+            modified = await self._spreadsheet.modified_time()
+            if not force and self.snapshot and self.snapshot.modified == modified:
+                return False
+            trx_categories, trx_accounts = await aspire_util.async_get_catalog(
+                self._spreadsheet
+            )
+        return self._install(modified, trx_categories, trx_accounts)
+
+    async def _run(self):
+        if self._follow:
+            while True:
+                await asyncio.sleep(FOLLOW_INTERVAL)
+                self.follow_snapshot()
+        if not self._revalidate:
+            await asyncio.sleep(self._refresh_interval)
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                di[Logger].error(e)
+            await asyncio.sleep(self._refresh_interval)
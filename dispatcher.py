@@ -0,0 +1,413 @@
+"""
+Front dispatcher that spreads updates over several bot processes:
+
+    python dispatcher.py
+    gunicorn --workers 1 --threads 8 --bind :$PORT 'dispatcher:create_app()'
+
+Updates are sharded by a consistent hash of the user id, so each user's
+updates are handled in order by one process while different users run in
+parallel. When a shard process dies its users move to the other shards
+until a replacement is ready. With more than one shard, state_storage
+must be "sqlite" so the moved conversations keep their state. The shards
+split the Sheets quota, and only the first one polls the catalog.
+"""
+
+import atexit
+import bisect
+import collections
+import hashlib
+import json
+import multiprocessing
+import queue
+import threading
+import time
+import flask
+import startup
+import telebot
+from flask import Flask
+from kink import di
+from logging import Logger
+from app_config import Configuration
+from telebot import apihelper, types
+from telebot.async_telebot import AsyncTeleBot
+from services import BackgroundLoop
+from metrics import CONTENT_TYPE, MetricsRegistry, authorized
+from async_bot import async_bot_functions
+from sync_bot import sync_bot_functions
+
+
+def shard_key(update: dict) -> int:
+    """
+    User id of an update, the chat id when there is no user
+    """
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if user:
+            return user["id"]
+        chat = value.get("chat") or value.get("message", {}).get("chat")
+        if chat:
+            return chat["id"]
+    return 0
+
+
+class HashRing:
+    """
+    Consistent hash ring, removing a node only moves the keys it owned
+    """
+
+    def __init__(self, replicas: int = 64):
+        self._replicas = replicas
+        self._hashes: list[int] = []
+        self._nodes: dict[int, int] = {}
+
+    def __len__(self):
+        return len(set(self._nodes.values()))
+
+    def __contains__(self, node: int):
+        return node in self._nodes.values()
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(
+            hashlib.blake2b(key.encode(), digest_size=8).digest(), "big"
+        )
+
+    def add(self, node: int):
+        for i in range(self._replicas):
+            h = self._hash(f"{node}:{i}")
+            bisect.insort(self._hashes, h)
+            self._nodes[h] = node
+
+    def remove(self, node: int):
+        self._hashes = [h for h in self._hashes if self._nodes[h] != node]
+        self._nodes = {h: self._nodes[h] for h in self._hashes}
+
+    def node_for(self, key) -> int:
+        if not self._hashes:
+            raise LookupError("No shard available")
+        i = bisect.bisect(self._hashes, self._hash(str(key))) % len(self._hashes)
+        return self._nodes[self._hashes[i]]
+
+
+def run_shard(index: int, updates, ready, taken, handled, shards: int):
+    """
+    Entry point of a shard process, handles its updates one at a time and
+    counts those it took from the queue and those it is done with
+    """
+    startup.configure_services(index, shards)
+    bot_instance = di["bot_instance"]
+    if di[Configuration]["run_async"]:
+        async_bot_functions(bot_instance)
+    else:
+        sync_bot_functions(bot_instance)
+    ready.set()
+
+    while True:
+        body = updates.get()
+        if body is None:
+            return
+        taken.value += 1
+        try:
+            update = types.Update.de_json(body)
+            if isinstance(bot_instance, AsyncTeleBot):
+                di[BackgroundLoop].run(bot_instance.process_new_updates([update]))
+            else:
+                bot_instance.process_new_updates([update])
+        except Exception as e:
+            di[Logger].error("Shard %d: %s" % (index, e))
+        finally:
+            handled.value += 1
+
+
+class Shard:
+    __slots__ = (
+        "index",
+        "process",
+        "updates",
+        "ready",
+        "taken",
+        "handled",
+        "unhandled",
+        "dispatched",
+        "restarts",
+    )
+
+    def __init__(
+        self, index: int, process, updates, ready, taken, handled, restarts: int
+    ):
+        self.index = index
+        self.process = process
+        self.updates = updates
+        self.ready = ready
+        self.taken = taken
+        self.handled = handled
+        # Sequence number and body of the updates not taken yet, the queue
+        # of a dead shard can not be read back safely
+        self.unhandled: collections.deque[tuple[int, str]] = collections.deque()
+        self.dispatched = 0
+        self.restarts = restarts
+
+    def done(self, sequence: int) -> bool:
+        """Whether the shard handled its first sequence updates"""
+        return self.handled.value >= sequence
+
+    def pending(self) -> list[str]:
+        """Updates the shard has not taken from its queue yet"""
+        taken = self.taken.value
+        while self.unhandled and self.unhandled[0][0] <= taken:
+            self.unhandled.popleft()
+        return [body for _, body in self.unhandled]
+
+
+class UpdateDispatcher:
+    """
+    Routes raw updates to shard processes. A monitor thread replaces dead
+    shards and adds shards to the ring once they are ready. When the ring
+    changes, a user stays on their previous shard until it has handled
+    their queued updates, so they are never handled out of order.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        queue_size: int,
+        check_interval: float = 1.0,
+        target=run_shard,
+    ):
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = workers
+        self._queue_size = queue_size
+        self._check_interval = check_interval
+        self._target = target
+        self._shards: dict[int, Shard] = {}
+        self._ring = HashRing()
+        # Shard and sequence number of each user's last queued update
+        self._last: dict[int, tuple[Shard, int]] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._monitor = None
+
+    def start(self):
+        with self._lock:
+            for index in range(self._workers):
+                self._spawn(index, 0)
+        self._monitor = threading.Thread(
+            target=self._watch, name="shard-monitor", daemon=True
+        )
+        self._monitor.start()
+
+    def stop(self, timeout: float = 10.0):
+        self._stopped.set()
+        if self._monitor is not None:
+            self._monitor.join()
+        for shard in self._shards.values():
+            shard.updates.put(None)
+        for shard in self._shards.values():
+            shard.process.join(timeout)
+            if shard.process.is_alive():
+                shard.process.terminate()
+
+    def dispatch(self, body: str) -> int:
+        """
+        Queue an update on its shard, raises queue.Full when the shard is
+        backed up and LookupError while no shard is ready
+        """
+        with self._lock:
+            return self._put(shard_key(json.loads(body)), body).index
+
+    def _put(self, key: int, body: str) -> Shard:
+        shard = self._shard_for(key)
+        shard.updates.put_nowait(body)
+        shard.dispatched += 1
+        shard.unhandled.append((shard.dispatched, body))
+        self._last[key] = (shard, shard.dispatched)
+        return shard
+
+    def _shard_for(self, key: int) -> Shard:
+        """
+        Shard of the user on the ring, unless another live shard still has
+        updates of theirs to handle
+        """
+        if key in self._last:
+            shard, sequence = self._last[key]
+            if self._shards.get(shard.index) is shard and not shard.done(sequence):
+                return shard
+        return self._shards[self._ring.node_for(key)]
+
+    def _forget_done(self):
+        """Drop users whose last queued update was handled or lost"""
+        self._last = {
+            key: (shard, sequence)
+            for key, (shard, sequence) in self._last.items()
+            if self._shards.get(shard.index) is shard and not shard.done(sequence)
+        }
+
+    def metrics(self) -> list[dict]:
+        with self._lock:
+            return [
+                {
+                    "shard": shard.index,
+                    "pid": shard.process.pid,
+                    "alive": shard.process.is_alive(),
+                    "ready": shard.index in self._ring,
+                    "queue_depth": shard.updates.qsize(),
+                    "dispatched": shard.dispatched,
+                    "restarts": shard.restarts,
+                }
+                for _, shard in sorted(self._shards.items())
+            ]
+
+    def _spawn(self, index: int, restarts: int):
+        updates = self._context.Queue(self._queue_size)
+        ready = self._context.Event()
+        taken = self._context.Value("Q", 0, lock=False)
+        handled = self._context.Value("Q", 0, lock=False)
+        process = self._context.Process(
+            target=self._target,
+            args=(index, updates, ready, taken, handled, self._workers),
+            name=f"shard-{index}",
+            daemon=True,
+        )
+        process.start()
+        self._shards[index] = Shard(
+            index, process, updates, ready, taken, handled, restarts
+        )
+
+    def _watch(self):
+        while not self._stopped.wait(self._check_interval):
+            with self._lock:
+                for shard in list(self._shards.values()):
+                    if not shard.process.is_alive():
+                        self._replace(shard)
+                    else:
+                        shard.pending()
+                        if shard.ready.is_set() and shard.index not in self._ring:
+                            self._ring.add(shard.index)
+                self._forget_done()
+
+    def _replace(self, shard: Shard):
+        """
+        Move the users of a dead shard to the others along with its queued
+        updates, then start a replacement
+        """
+        di[Logger].error(
+            "Shard %d exited with code %s, moving its users"
+            % (shard.index, shard.process.exitcode)
+        )
+        self._ring.remove(shard.index)
+        del self._shards[shard.index]
+        # Nobody reads this queue anymore, exiting must not wait to flush it
+        shard.updates.cancel_join_thread()
+        # The update it was handling is lost, the ones it had not taken yet
+        # go to the other shards
+        for body in shard.pending():
+            try:
+                self._put(shard_key(json.loads(body)), body)
+            except (LookupError, queue.Full):
+                di[Logger].error("Dropped an update of shard %d" % shard.index)
+        self._spawn(shard.index, shard.restarts + 1)
+
+
+def poll_updates(dispatcher: UpdateDispatcher, token: str):
+    """
+    Long poll Telegram and hand the raw updates to the dispatcher
+    """
+    offset = None
+    while True:
+        try:
+            updates = apihelper.get_updates(
+                token, offset=offset, timeout=25, long_polling_timeout=20
+            )
+        except Exception as e:
+            di[Logger].error(e)
+            time.sleep(1)
+            continue
+        for update in updates:
+            body = json.dumps(update)
+            while True:
+                try:
+                    dispatcher.dispatch(body)
+                    break
+                except (LookupError, queue.Full):
+                    time.sleep(0.1)
+            offset = update["update_id"] + 1
+
+
+def create_app() -> Flask:
+    di[Logger] = telebot.logger
+    config = Configuration().values
+    webhook_url_path = "/%s/" % (config["secret"])
+    if config["shard_workers"] > 1 and config["state_storage"] != "sqlite":
+        # Users move between shards, each would keep its own copy of their
+        # conversation in memory
+        raise ValueError('dispatcher.py needs state_storage = "sqlite"')
+
+    dispatcher = UpdateDispatcher(config["shard_workers"], config["shard_queue_size"])
+    dispatcher.start()
+    atexit.register(dispatcher.stop)
+    di[UpdateDispatcher] = dispatcher
+
+    apihelper.delete_webhook(config["token"], drop_pending_updates=True)
+    if config["update_mode"] == "polling":
+        threading.Thread(
+            target=poll_updates,
+            args=(dispatcher, config["token"]),
+            name="update-poller",
+            daemon=True,
+        ).start()
+    elif config["update_mode"] == "webhook":
+        apihelper.set_webhook(
+            config["token"], url=config["webhook_base_url"] + webhook_url_path
+        )
+
+    registry = MetricsRegistry()
+    for key, help, kind in (
+        ("dispatched", "Updates handed to the shard", "counter"),
+        ("restarts", "Times the shard process was replaced", "counter"),
+        ("queue_depth", "Updates waiting in the shard queue", "gauge"),
+        ("alive", "1 while the shard process is running", "gauge"),
+        ("ready", "1 while the shard takes updates", "gauge"),
+    ):
+        registry.register(
+            "shard_" + key,
+            help,
+            lambda key=key: {(m["shard"],): int(m[key]) for m in dispatcher.metrics()},
+            kind,
+            ("shard",),
+        )
+
+    app = Flask(__name__)
+
+    @app.route(webhook_url_path, methods=["POST"])
+    def receive_updates():
+        if flask.request.headers.get("content-type") != "application/json":
+            flask.abort(403)
+        try:
+            dispatcher.dispatch(flask.request.get_data().decode("utf-8"))
+        except (LookupError, queue.Full):
+            # Telegram retries the update later
+            return "", 503, {"Retry-After": "1"}
+        return ""
+
+    @app.before_request
+    def check_metrics_token():
+        if flask.request.path in ("/shards", "/metrics") and not authorized(
+            flask.request.headers.get("Authorization"), config["secret"]
+        ):
+            flask.abort(403)
+
+    @app.route("/shards", methods=["GET"])
+    def shard_metrics():
+        return flask.jsonify(dispatcher.metrics())
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return registry.render(), 200, {"Content-Type": CONTENT_TYPE}
+
+    return app
+
+
+if __name__ == "__main__":
+    create_app().run(port=Configuration().values["port"])
@@ -0,0 +1,163 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from telebot import TeleBot, apihelper, asyncio_helper, types
+from telebot.async_telebot import AsyncTeleBot
+from outbound import SUPERSEDED, OutboundScheduler, AsyncOutboundScheduler
+
+NOT_MODIFIED = "message is not modified"
+
+
+class EditTracker:
+    """
+    Digest of the text and markup each bot message currently shows, so an
+    edit that would not change anything is skipped without calling Telegram
+    """
+
+    def __init__(self, max_messages: int = 10000):
+        self._digests: OrderedDict[tuple, bytes] = OrderedDict()
+        self._max_messages = max_messages
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self._digests)
+
+    @staticmethod
+    def digest(text: str, reply_markup) -> bytes:
+        if isinstance(reply_markup, types.JsonSerializable):
+            reply_markup = reply_markup.to_json()
+        return hashlib.blake2b(
+            f"{text}\0{reply_markup or ''}".encode(), digest_size=16
+        ).digest()
+
+    def is_unchanged(self, key: tuple, digest: bytes) -> bool:
+        with self._lock:
+            if self._digests.get(key) == digest:
+                self._digests.move_to_end(key)
+                self.skipped += 1
+                return True
+            self.sent += 1
+            return False
+
+    def record(self, key: tuple, digest: bytes):
+        with self._lock:
+            self._digests[key] = digest
+            self._digests.move_to_end(key)
+            while len(self._digests) > self._max_messages:
+                self._digests.popitem(last=False)
+
+
+class TrackedTeleBot(TeleBot):
+    """
+    TeleBot that remembers what its messages show and drops edits that
+    would leave them unchanged. Sends and edits go through an
+    OutboundScheduler that keeps them under Telegram's rate limits.
+    """
+
+    def __init__(
+        self,
+        *args,
+        edit_tracker: EditTracker,
+        outbound: OutboundScheduler = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.edit_tracker = edit_tracker
+        self.outbound = outbound or OutboundScheduler()
+
+    def send_message(self, chat_id, text, *args, **kwargs) -> types.Message:
+        message = self.outbound.call(
+            chat_id, super().send_message, chat_id, text, *args, **kwargs
+        )
+        self.edit_tracker.record(
+            (message.chat.id, message.message_id),
+            self.edit_tracker.digest(text, kwargs.get("reply_markup")),
+        )
+        return message
+
+    def edit_message_text(self, text=None, chat_id=None, message_id=None, **kwargs):
+        if message_id is None:
+            return super().edit_message_text(text, chat_id, message_id, **kwargs)
+        key = (chat_id, message_id)
+        digest = self.edit_tracker.digest(text, kwargs.get("reply_markup"))
+        if self.edit_tracker.is_unchanged(key, digest):
+            return True
+        try:
+            result = self.outbound.call(
+                chat_id,
+                super().edit_message_text,
+                text,
+                chat_id,
+                message_id,
+                coalesce_key=key,
+                **kwargs,
+            )
+        except apihelper.ApiTelegramException as e:
+            if NOT_MODIFIED not in e.description:
+                raise
+            result = True
+        if result is SUPERSEDED:
+            # A newer edit of the message replaced this one in the queue
+            return True
+        self.edit_tracker.record(key, digest)
+        return result
+
+
+class AsyncTrackedTeleBot(AsyncTeleBot):
+    """
+    AsyncTeleBot that remembers what its messages show and drops edits that
+    would leave them unchanged. Sends and edits go through an
+    AsyncOutboundScheduler that keeps them under Telegram's rate limits.
+    """
+
+    def __init__(
+        self,
+        *args,
+        edit_tracker: EditTracker,
+        outbound: AsyncOutboundScheduler = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.edit_tracker = edit_tracker
+        self.outbound = outbound or AsyncOutboundScheduler()
+
+    async def send_message(self, chat_id, text, *args, **kwargs) -> types.Message:
+        message = await self.outbound.call(
+            chat_id, super().send_message, chat_id, text, *args, **kwargs
+        )
+        self.edit_tracker.record(
+            (message.chat.id, message.message_id),
+            self.edit_tracker.digest(text, kwargs.get("reply_markup")),
+        )
+        return message
+
+    async def edit_message_text(
+        self, text=None, chat_id=None, message_id=None, **kwargs
+    ):
+        if message_id is None:
+            return await super().edit_message_text(text, chat_id, message_id, **kwargs)
+        key = (chat_id, message_id)
+        digest = self.edit_tracker.digest(text, kwargs.get("reply_markup"))
+        if self.edit_tracker.is_unchanged(key, digest):
+            return True
+        try:
+            result = await self.outbound.call(
+                chat_id,
+                super().edit_message_text,
+                text,
+                chat_id,
+                message_id,
+                coalesce_key=key,
+                **kwargs,
+            )
+        except asyncio_helper.ApiTelegramException as e:
+            if NOT_MODIFIED not in e.description:
+                raise
+            result = True
+        if result is SUPERSEDED:
+            # A newer edit of the message replaced this one in the queue
+            return True
+        self.edit_tracker.record(key, digest)
+        return result
@@ -0,0 +1,76 @@
+import asyncio
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+class FileLock:
+    """
+    Exclusive lock shared by every process opening the same file. The OS
+    drops it when the process holding it exits, so a shard that dies while
+    writing does not block the others.
+    """
+
+    def __init__(self, path: str, poll_interval: float = 0.05):
+        self._path = path
+        self._poll_interval = poll_interval
+        self._file = None
+        # The file lock belongs to the open file, threads queue here first
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        self._lock.acquire()
+        try:
+            if self._file is None:
+                self._file = open(self._path, "a+b")
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+                return
+            self._file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_NBLCK, 1)
+                    return
+                except OSError:
+                    time.sleep(self._poll_interval)
+        except BaseException:
+            self._lock.release()
+            raise
+
+    def release(self):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    async def __aenter__(self):
+        # Waiting for another process must not block the event loop
+        acquiring = asyncio.ensure_future(asyncio.to_thread(self.acquire))
+        try:
+            await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            # The thread still takes the lock, give it back once it has
+            acquiring.add_done_callback(
+                lambda f: f.cancelled() or f.exception() or self.release()
+            )
+            raise
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
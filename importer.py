@@ -0,0 +1,248 @@
+import csv
+import io
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import datetime
+import aiohttp
+import requests
+from services import TransactionData
+from catalog import CATEGORY, ACCOUNT, CatalogSnapshot
+
+# Signed amount column of bank statements, negative amounts are outflows
+AMOUNT = "Amount"
+DEFAULT_COLUMNS = {column: column for column in TransactionData.columns}
+DOWNLOAD_CHUNK = 64 * 1024
+# Downloads larger than this are spooled to a temporary file
+SPOOL_SIZE = 1024 * 1024
+MAX_REPORTED_ERRORS = 5
+# Uploaded files remembered to ignore a redelivered /import
+MAX_SEEN_FILES = 1000
+
+
+class ImportRowError(ValueError):
+    """Raised for a CSV record that can not become a transaction"""
+
+
+class ImportMapping:
+    """
+    CSV header name of each Transactions column. Amount may be mapped
+    instead of Outflow and Inflow for statements with a signed amount.
+    """
+
+    def __init__(self, columns: dict[str, str] = None, date_format: str = ""):
+        self.columns = dict(columns or DEFAULT_COLUMNS)
+        unknown = set(self.columns) - set(TransactionData.columns) - {AMOUNT}
+        if unknown:
+            raise ValueError(f"Unknown import columns: {', '.join(sorted(unknown))}")
+        self.date_format = date_format
+
+    def bind(self, header: list[str]) -> dict[str, int]:
+        """
+        Position of each mapped column in the CSV header
+        """
+        header = [name.strip() for name in header]
+        missing = [name for name in self.columns.values() if name not in header]
+        if missing:
+            raise ImportRowError(f"Missing CSV columns: {', '.join(missing)}")
+        return {column: header.index(name) for column, name in self.columns.items()}
+
+    def to_row(
+        self, record: list[str], positions: dict[str, int], snapshot: CatalogSnapshot
+    ) -> list:
+        trx = TransactionData()
+        values = {
+            column: record[i].strip() if i < len(record) else ""
+            for column, i in positions.items()
+        }
+        for column, value in values.items():
+            if column in ("Outflow", "Inflow"):
+                trx[column] = parse_amount(value)
+            elif column == AMOUNT:
+                amount = parse_amount(value)
+                if amount != "":
+                    trx["Outflow" if amount < 0 else "Inflow"] = abs(amount)
+            elif column == "Date":
+                trx[column] = self.parse_date(value)
+            else:
+                trx[column] = value
+        if trx["Outflow"] == "" and trx["Inflow"] == "":
+            raise ImportRowError("no amount")
+        if trx["Category"] and not snapshot.contains(CATEGORY, trx["Category"]):
+            raise ImportRowError(f"unknown category {trx['Category']!r}")
+        if trx["Account"] and not snapshot.contains(ACCOUNT, trx["Account"]):
+            raise ImportRowError(f"unknown account {trx['Account']!r}")
+        return trx.to_row()
+
+    def parse_date(self, value: str) -> str:
+        if not value:
+            raise ImportRowError("no date")
+        if not self.date_format:
+            return value
+        try:
+            date = datetime.strptime(value, self.date_format)
+        except ValueError:
+            raise ImportRowError(f"date {value!r} does not match {self.date_format}")
+        return date.strftime("%m/%d/%Y")
+
+
+def parse_amount(value: str):
+    if value == "":
+        return ""
+    try:
+        return float(value.replace(",", "").replace(" ", ""))
+    except ValueError:
+        raise ImportRowError(f"invalid amount {value!r}")
+
+
+class ImportJob:
+    """
+    One CSV import. Records are read one at a time so memory does not grow
+    with the file, invalid ones are counted and skipped.
+    """
+
+    def __init__(self, mapping: ImportMapping, snapshot: CatalogSnapshot):
+        self.mapping = mapping
+        self.snapshot = snapshot
+        self.read = 0
+        self.written = 0
+        self.skipped = 0
+        self.errors: list[str] = []
+
+    def rows(self, lines):
+        reader = csv.reader(lines)
+        positions = self.mapping.bind(next(reader, []))
+        for record in reader:
+            if not any(field.strip() for field in record):
+                continue
+            self.read += 1
+            try:
+                yield self.mapping.to_row(record, positions, self.snapshot)
+            except ImportRowError as e:
+                self.skipped += 1
+                if len(self.errors) < MAX_REPORTED_ERRORS:
+                    self.errors.append(f"Line {reader.line_num}: {e}")
+
+    def summary(self) -> str:
+        text = f"Imported {self.written} of {self.read} transactions."
+        if self.skipped:
+            text += f"\nSkipped {self.skipped}:\n" + "\n".join(self.errors)
+        return text
+
+    def progress(self) -> str:
+        return f"Importing... {self.read} read, {self.written} written."
+
+
+def open_csv(file) -> io.TextIOWrapper:
+    file.seek(0)
+    return io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+
+
+def download(url: str, timeout: float = 30):
+    """
+    Download a file in chunks into a spooled temporary file
+    """
+    file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    with requests.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(DOWNLOAD_CHUNK):
+            file.write(chunk)
+    return file
+
+
+async def async_download(url: str, timeout: float = 30):
+    file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    async with aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=timeout)
+    ) as session:
+        async with session.get(url) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK):
+                file.write(chunk)
+    return file
+
+
+class CsvImporter:
+    """
+    Streams CSV lines into the Transactions sheet, chunk_size rows per
+    range write. progress is called with the job every progress_every
+    records read.
+    """
+
+    def __init__(
+        self,
+        mapping: ImportMapping,
+        write,
+        chunk_size: int = 500,
+        progress_every: int = 200,
+    ):
+        self.mapping = mapping
+        self._write = write
+        self._chunk_size = chunk_size
+        self._progress_every = progress_every
+        self._seen = OrderedDict()
+        self._seen_lock = threading.Lock()
+
+    def claim(self, file_id: str) -> bool:
+        """
+        Whether the file with this unique id was not sent for import yet.
+        Telegram redelivers an update it did not get an answer for, and the
+        same rows must not be written twice.
+        """
+        with self._seen_lock:
+            if file_id in self._seen:
+                return False
+            self._seen[file_id] = None
+            if len(self._seen) > MAX_SEEN_FILES:
+                self._seen.popitem(last=False)
+            return True
+
+    def release(self, file_id: str):
+        """
+        Forget a file whose import wrote nothing, so it can be sent again
+        """
+        with self._seen_lock:
+            self._seen.pop(file_id, None)
+
+    def job(self, snapshot: CatalogSnapshot) -> ImportJob:
+        return ImportJob(self.mapping, snapshot)
+
+    def run(self, job: ImportJob, lines, progress=None) -> ImportJob:
+        chunk = []
+        reported = 0
+        for row in job.rows(lines):
+            chunk.append(row)
+            if len(chunk) >= self._chunk_size:
+                self._write(chunk)
+                job.written += len(chunk)
+                chunk = []
+            if progress and job.read - reported >= self._progress_every:
+                reported = job.read
+                progress(job)
+        if chunk:
+            self._write(chunk)
+            job.written += len(chunk)
+        return job
+
+
+class AsyncCsvImporter(CsvImporter):
+    """
+    CsvImporter awaiting write and progress coroutines
+    """
+
+    async def run(self, job: ImportJob, lines, progress=None) -> ImportJob:
+        chunk = []
+        reported = 0
+        for row in job.rows(lines):
+            chunk.append(row)
+            if len(chunk) >= self._chunk_size:
+                await self._write(chunk)
+                job.written += len(chunk)
+                chunk = []
+            if progress and job.read - reported >= self._progress_every:
+                reported = job.read
+                await progress(job)
+        if chunk:
+            await self._write(chunk)
+            job.written += len(chunk)
+        return job
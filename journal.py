@@ -0,0 +1,199 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+CREATE_JOURNAL = """
+CREATE TABLE IF NOT EXISTS journal (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    row TEXT NOT NULL,
+    created REAL NOT NULL,
+    committed REAL,
+    target TEXT,
+    owner TEXT,
+    claimed_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS journal_pending ON journal (id) WHERE committed IS NULL;
+CREATE INDEX IF NOT EXISTS journal_committed ON journal (committed);
+"""
+INSERT_ROW = "INSERT INTO journal (row, created) VALUES (?, ?)"
+SELECT_CLAIMABLE = (
+    "SELECT id, row, target FROM journal WHERE committed IS NULL "
+    "AND (claimed_until IS NULL OR claimed_until < ?) ORDER BY id LIMIT ?"
+)
+CLAIM = "UPDATE journal SET owner = ?, claimed_until = ? WHERE id = ?"
+SET_TARGET = "UPDATE journal SET target = ? WHERE id = ?"
+COMMIT = (
+    "UPDATE journal SET committed = ?, owner = NULL, claimed_until = NULL "
+    "WHERE id = ?"
+)
+RELEASE = (
+    "UPDATE journal SET owner = NULL, claimed_until = NULL, "
+    "attempts = attempts + 1, error = ? WHERE id = ?"
+)
+COUNT_PENDING = "SELECT COUNT(*) FROM journal WHERE committed IS NULL"
+PURGE = "DELETE FROM journal WHERE committed < ?"
+
+
+class MemoryQueue:
+    """
+    In-process stand-in for TransactionJournal, rows are lost when the
+    process exits
+    """
+
+    def __init__(self):
+        self._entries: list[list] = []
+        self._claimed: dict[int, list] = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def append(self, rows: list[list]):
+        with self._lock:
+            for row in rows:
+                self._entries.append([self._next_id, row, None])
+                self._next_id += 1
+
+    def claim(self, limit: int) -> list[tuple]:
+        with self._lock:
+            batch = take_batch(self._entries, limit)
+            del self._entries[: len(batch)]
+            for entry in batch:
+                self._claimed[entry[0]] = entry
+            return [tuple(entry) for entry in batch]
+
+    def set_target(self, ids: list[int], target: str):
+        with self._lock:
+            for i in ids:
+                self._claimed[i][2] = target
+
+    def commit(self, ids: list[int]):
+        with self._lock:
+            for i in ids:
+                del self._claimed[i]
+
+    def release(self, ids: list[int], error: str):
+        with self._lock:
+            self._entries[:0] = [self._claimed.pop(i) for i in ids]
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._entries) + len(self._claimed)
+
+    def close(self):
+        pass
+
+
+def take_batch(entries, limit: int) -> list:
+    """
+    Leading entries to write together. Entries that were already sent to a
+    range go back as the same group, so that range can be checked first.
+    """
+    if not entries:
+        return []
+    target = entries[0][2]
+    if target is None:
+        batch = []
+        for entry in entries[:limit]:
+            if entry[2] is not None:
+                break
+            batch.append(entry)
+        return batch
+    return [entry for entry in entries[:limit] if entry[2] == target]
+
+
+class TransactionJournal:
+    """
+    Append-only SQLite log of confirmed transactions. Rows are on disk
+    before the user is told they are saved and stay pending until the
+    uploader marks them committed. Claims expire after lease seconds, so
+    rows claimed by a process that died are picked up again, and several
+    processes can share one file.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        lease: float = 120.0,
+        retention: float = 7 * 24 * 3600,
+        purge_interval: float = 3600,
+    ):
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, timeout=5, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.executescript(CREATE_JOURNAL)
+        self._owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._lease = lease
+        self._retention = retention
+        self._purge_interval = purge_interval
+        self._next_purge = 0.0
+        self._lock = threading.Lock()
+
+    def append(self, rows: list[list]):
+        """
+        Durably add rows, returns once they are committed to disk
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany(INSERT_ROW, [(json.dumps(row), now) for row in rows])
+
+    def claim(self, limit: int) -> list[tuple]:
+        """
+        Oldest pending rows that no other uploader holds, as (id, row,
+        target) tuples
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            entries = [
+                (i, json.loads(row), target)
+                for i, row, target in self._conn.execute(SELECT_CLAIMABLE, (now, limit))
+            ]
+            batch = take_batch(entries, limit)
+            self._conn.executemany(
+                CLAIM, [(self._owner, now + self._lease, i) for i, _, _ in batch]
+            )
+        return batch
+
+    def set_target(self, ids: list[int], target: str):
+        """
+        Remember the range rows are about to be written to, before the
+        request is sent
+        """
+        self._executemany(SET_TARGET, [(target, i) for i in ids])
+
+    def commit(self, ids: list[int]):
+        now = time.time()
+        self._executemany(COMMIT, [(now, i) for i in ids])
+        if now >= self._next_purge:
+            self._next_purge = now + self._purge_interval
+            self.purge(now - self._retention)
+
+    def release(self, ids: list[int], error: str):
+        self._executemany(RELEASE, [(error, i) for i in ids])
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._conn.execute(COUNT_PENDING).fetchone()[0]
+
+    def purge(self, before: float) -> int:
+        """
+        Drop rows committed before the given time
+        """
+        with self._lock, self._conn:
+            return self._conn.execute(PURGE, (before,)).rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _executemany(self, sql: str, params: list[tuple]):
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany(sql, params)
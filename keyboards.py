@@ -0,0 +1,100 @@
+import datetime
+import threading
+import aspire_util
+from collections import OrderedDict
+from services import KeyboardUtil
+from catalog import GROUP, CATEGORY, ACCOUNT
+
+
+class KeyboardCache:
+    """
+    Inline keyboards that do not depend on the draft, kept as the JSON
+    string sent to Telegram. Keys are (kind, group, year, month, catalog
+    version) so a new catalog snapshot never reuses keyboards of the old one.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self._entries: OrderedDict[tuple, str] = OrderedDict()
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: tuple, build, *args) -> str:
+        with self._lock:
+            markup = self._entries.get(key)
+            if markup is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return markup
+            self.misses += 1
+        markup = build(*args).to_json()
+        with self._lock:
+            self._entries[key] = markup
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        return markup
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def calendar(self, year: int = None, month: int = None) -> str:
+        now = datetime.datetime.now()
+        year = year or now.year
+        month = month or now.month
+        return self.get(
+            ("calendar", None, year, month, None),
+            aspire_util.create_calendar,
+            year,
+            month,
+        )
+
+    def groups(self, snapshot) -> str:
+        return self.get(
+            ("groups", None, None, None, snapshot.version),
+            aspire_util.create_category_inline,
+            snapshot.names[GROUP],
+            GROUP,
+            lambda name: snapshot.encode(GROUP, name),
+        )
+
+    def categories(self, snapshot, group: str) -> str:
+        return self.get(
+            ("categories", group, None, None, snapshot.version),
+            aspire_util.create_category_inline,
+            snapshot.trx_categories.get(group, []),
+            "save",
+            lambda name: snapshot.encode(CATEGORY, name),
+        )
+
+    def accounts(self, snapshot) -> str:
+        return self.get(
+            ("accounts", None, None, None, snapshot.version),
+            aspire_util.create_account_inline,
+            snapshot.trx_accounts,
+            ACCOUNT,
+            lambda name: snapshot.encode(ACCOUNT, name),
+        )
+
+    def default_options(self) -> str:
+        return self.get(
+            ("default_options", None, None, None, None),
+            KeyboardUtil.create_default_options_keyboard,
+        )
+
+    def save(self, callback_data: str) -> str:
+        return self.get(
+            ("save", callback_data, None, None, None),
+            KeyboardUtil.create_save_keyboard,
+            callback_data,
+        )
+
+    def batch(self) -> str:
+        return self.get(
+            ("batch", None, None, None, None),
+            KeyboardUtil.create_batch_keyboard,
+        )
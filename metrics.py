@@ -0,0 +1,365 @@
+import bisect
+import contextvars
+import functools
+import hmac
+import inspect
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from telebot import apihelper, asyncio_helper
+from profiling import HandlerProfiler
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_span = contextvars.ContextVar("handler_span", default=None)
+
+
+def authorized(header, token: str) -> bool:
+    """
+    Whether an Authorization header carries the bearer token, always false
+    without a token so metrics are never public
+    """
+    if isinstance(header, bytes):
+        header = header.decode("latin-1")
+    return bool(token) and hmac.compare_digest(header or "", "Bearer " + token)
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [
+        '%s="%s"'
+        % (n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for n, v in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Monotonic counter, one child per combination of label values
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield self.name + "_total", format_labels(self.labels, labels), value
+
+
+class Histogram:
+    """
+    Cumulative histogram of durations in seconds. Observing is a bisect and
+    a few additions under an uncontended lock, cheap enough for every call.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, labels: tuple = (), buckets=LATENCY_BUCKETS
+    ):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._buckets = tuple(sorted(buckets))
+        # Per child: bucket counts, then the sum and the count of observations
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float, *labels):
+        i = bisect.bisect_left(self._buckets, seconds)
+        with self._lock:
+            child = self._values.get(labels)
+            if child is None:
+                child = self._values[labels] = [0] * (len(self._buckets) + 3)
+            child[i] += 1
+            child[-2] += seconds
+            child[-1] += 1
+
+    @contextmanager
+    def timer(self, *labels):
+        """
+        Observe the duration of the block, labelled ok or error after the
+        given label values
+        """
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            yield
+            outcome = "ok"
+        finally:
+            self.observe(time.perf_counter() - start, *labels, outcome)
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(child)) for labels, child in self._values.items()]
+        for labels, child in values:
+            cumulative = 0
+            for bound, count in zip(self._buckets + (float("inf"),), child):
+                cumulative += count
+                yield self.name + "_bucket", format_labels(
+                    self.labels, labels, 'le="%s"' % format_value(bound)
+                ), cumulative
+            yield self.name + "_sum", format_labels(self.labels, labels), child[-2]
+            yield self.name + "_count", format_labels(self.labels, labels), child[-1]
+
+
+class Collector:
+    """
+    Series read from a callback at scrape time, for counters and sizes that
+    components already keep. fn returns a number, or a dict from tuples of
+    label values to numbers.
+    """
+
+    def __init__(self, name: str, help: str, fn, kind: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = tuple(labels)
+        self._fn = fn
+
+    def samples(self):
+        name = self.name + "_total" if self.kind == "counter" else self.name
+        values = self._fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            yield name, format_labels(self.labels, labels), value
+
+
+class MetricsRegistry:
+    """
+    Metrics rendered in the Prometheus text format. Asking twice for the
+    same name returns the metric created the first time.
+    """
+
+    def __init__(self):
+        self._metrics: dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _add(self, name: str, create):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = create()
+            return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self._add(name, lambda: Counter(name, help, labels))
+
+    def histogram(
+        self, name: str, help: str, labels: tuple = (), buckets=LATENCY_BUCKETS
+    ) -> Histogram:
+        return self._add(name, lambda: Histogram(name, help, labels, buckets))
+
+    def register(
+        self, name: str, help: str, fn, kind: str = "gauge", labels: tuple = ()
+    ):
+        """
+        Add a series read from fn at scrape time, replacing any previous one
+        """
+        with self._lock:
+            self._metrics[name] = Collector(name, help, fn, kind, labels)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append("%s%s %s" % (name, labels, format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+def handler_name(fn) -> str:
+    """
+    Name of a handler, the same in both bot modes
+    """
+    return fn.__name__.removeprefix("async_")
+
+
+class HandlerSpan:
+    """
+    Time a running handler spent waiting on outside services, by service
+    """
+
+    __slots__ = ("parent", "waits")
+
+    def __init__(self, parent: "HandlerSpan"):
+        self.parent = parent
+        self.waits: dict[str, float] = {}
+
+
+def add_wait(service: str, seconds: float):
+    """
+    Charge a wait to the handler running in this context and its callers
+    """
+    span = _span.get()
+    while span is not None:
+        span.waits[service] = span.waits.get(service, 0.0) + seconds
+        span = span.parent
+
+
+@contextmanager
+def waiting(service: str, histogram: Histogram = None, *labels):
+    """
+    Time a request to an outside service for its histogram, labelled ok or
+    error after the given label values, and for the running handler
+    """
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        seconds = time.perf_counter() - start
+        add_wait(service, seconds)
+        if histogram is not None:
+            histogram.observe(seconds, *labels, outcome)
+
+
+class HandlerInstrumentation:
+    """
+    Wraps handlers to record their wall time and the part of it spent
+    waiting on Telegram and Sheets. The outermost handler of an update is
+    also offered to the profiler.
+    """
+
+    def __init__(self, registry: MetricsRegistry, profiler: HandlerProfiler = None):
+        self._seconds = registry.histogram(
+            "bot_handler_seconds",
+            "Time spent in update handlers",
+            ("handler", "outcome"),
+        )
+        self._waits = registry.counter(
+            "bot_handler_wait_seconds",
+            "Time handlers spent waiting on Telegram or Sheets",
+            ("handler", "service"),
+        )
+        self._profiler = profiler
+
+    def _enter(self, name: str, coroutine: bool):
+        parent = _span.get()
+        span = HandlerSpan(parent)
+        token = _span.set(span)
+        if parent is None and self._profiler is not None:
+            profile = self._profiler.sample(name, coroutine)
+        else:
+            profile = nullcontext()
+        return span, token, profile
+
+    def _exit(self, name: str, span: HandlerSpan, token):
+        _span.reset(token)
+        for service, seconds in span.waits.items():
+            self._waits.inc(name, service, amount=seconds)
+
+    def wrap(self, fn):
+        """
+        Instrumented fn, coroutine functions stay coroutine functions
+        """
+        name = handler_name(fn)
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                span, token, profile = self._enter(name, True)
+                try:
+                    with profile, self._seconds.timer(name):
+                        return await fn(*args, **kwargs)
+                finally:
+                    self._exit(name, span, token)
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            span, token, profile = self._enter(name, False)
+            try:
+                with profile, self._seconds.timer(name):
+                    return fn(*args, **kwargs)
+            finally:
+                self._exit(name, span, token)
+
+        return wrapper
+
+
+def instrument_handlers(
+    registry: MetricsRegistry,
+    bot_instance,
+    router=None,
+    profiler: HandlerProfiler = None,
+):
+    """
+    Instrument every handler registered on the bot and every callback route
+    """
+    instrumentation = HandlerInstrumentation(registry, profiler)
+    for name, handlers in vars(bot_instance).items():
+        if not name.endswith("_handlers") or not isinstance(handlers, list):
+            continue
+        for handler in handlers:
+            if isinstance(handler, dict) and "function" in handler:
+                handler["function"] = instrumentation.wrap(handler["function"])
+    if router is not None:
+        router.wrap(instrumentation.wrap)
+
+
+def instrument_telegram(registry: MetricsRegistry):
+    """
+    Time the Bot API requests of both telebot helpers by method. Safe to
+    call more than once.
+    """
+    seconds = registry.histogram(
+        "telegram_request_seconds",
+        "Time spent in Telegram Bot API requests",
+        ("method", "outcome"),
+    )
+    if not hasattr(apihelper._make_request, "__wrapped__"):
+        make_request = apihelper._make_request
+
+        @functools.wraps(make_request)
+        def _make_request(token, method_name, *args, **kwargs):
+            with waiting("telegram", seconds, method_name):
+                return make_request(token, method_name, *args, **kwargs)
+
+        apihelper._make_request = _make_request
+    if not hasattr(asyncio_helper._process_request, "__wrapped__"):
+        process_request = asyncio_helper._process_request
+
+        @functools.wraps(process_request)
+        async def _process_request(token, url, *args, **kwargs):
+            with waiting("telegram", seconds, url):
+                return await process_request(token, url, *args, **kwargs)
+
+        asyncio_helper._process_request = _process_request
+
+
+def state_count(storage) -> int:
+    """
+    Users with a state in a telebot state storage
+    """
+    try:
+        return len(storage)
+    except TypeError:
+        return len(getattr(storage, "data", ()))
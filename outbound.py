@@ -0,0 +1,197 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from telebot import apihelper, asyncio_helper
+
+# Returned instead of sending an edit that a newer edit of the same message
+# replaced while it was waiting
+SUPERSEDED = object()
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """
+        Seconds until a token is available, 0 when one is available now
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, until: float):
+        self.blocked_until = max(self.blocked_until, until)
+
+
+def retry_after(e: Exception) -> float:
+    """
+    Seconds Telegram asked to wait in a 429 response, None for other errors
+    """
+    if not isinstance(
+        e, (apihelper.ApiTelegramException, asyncio_helper.ApiTelegramException)
+    ):
+        return None
+    if e.error_code != 429:
+        return None
+    return float(e.result_json.get("parameters", {}).get("retry_after", 1))
+
+
+class OutboundScheduler:
+    """
+    Paces Telegram API calls with a global and a per-chat token bucket.
+    Calls answered with 429 block their chat for retry_after seconds and
+    are retried. Above max_chats, the least recently used chat buckets that
+    are not blocked are dropped. Edits waiting for the same message are
+    coalesced, only the newest one is sent.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 30,
+        chat_rate: float = 1,
+        chat_burst: float = 5,
+        max_retries: int = 3,
+        max_chats: int = 10000,
+    ):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: OrderedDict[int, TokenBucket] = OrderedDict()
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._max_retries = max_retries
+        self._max_chats = max_chats
+        self._latest: dict[tuple, int] = {}
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.coalesced = 0
+        self.throttled = 0
+        self.retried = 0
+
+    def _chat(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(
+                self._chat_rate, self._chat_burst
+            )
+            if len(self._chats) > self._max_chats:
+                self._evict(chat_id)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    def _evict(self, keep):
+        """
+        Drop the least recently used bucket other than keep. Buckets still
+        blocked by a retry_after are kept, a new one would forget the wait.
+        """
+        now = time.monotonic()
+        for chat_id, bucket in self._chats.items():
+            if chat_id != keep and bucket.blocked_until <= now:
+                del self._chats[chat_id]
+                return
+
+    def _register(self, coalesce_key) -> int:
+        if coalesce_key is None:
+            return 0
+        self._sequence += 1
+        self._latest[coalesce_key] = self._sequence
+        return self._sequence
+
+    def _superseded(self, coalesce_key, sequence: int) -> bool:
+        if coalesce_key is None or self._latest.get(coalesce_key) == sequence:
+            return False
+        self.coalesced += 1
+        return True
+
+    def _done(self, coalesce_key, sequence: int):
+        if coalesce_key is not None and self._latest.get(coalesce_key) == sequence:
+            del self._latest[coalesce_key]
+
+    def _try_take(self, chat_id) -> float:
+        """
+        Take a token from both buckets, or return how long to wait
+        """
+        now = time.monotonic()
+        chat = self._chat(chat_id)
+        delay = max(self._global.delay(now), chat.delay(now))
+        if delay > 0:
+            return delay
+        self._global.take()
+        chat.take()
+        self.sent += 1
+        return 0.0
+
+    def _block(self, chat_id, seconds: float):
+        self.retried += 1
+        self._chat(chat_id).block(time.monotonic() + seconds)
+
+    def call(self, chat_id, fn, *args, coalesce_key=None, **kwargs):
+        with self._lock:
+            sequence = self._register(coalesce_key)
+        try:
+            for attempt in range(self._max_retries + 1):
+                while True:
+                    with self._lock:
+                        if self._superseded(coalesce_key, sequence):
+                            return SUPERSEDED
+                        delay = self._try_take(chat_id)
+                        if delay > 0:
+                            self.throttled += 1
+                    if delay <= 0:
+                        break
+                    time.sleep(delay)
+                try:
+                    return fn(*args, **kwargs)
+                except Exception as e:
+                    wait = retry_after(e)
+                    if wait is None or attempt == self._max_retries:
+                        raise
+                    with self._lock:
+                        self._block(chat_id, wait)
+        finally:
+            with self._lock:
+                self._done(coalesce_key, sequence)
+
+
+class AsyncOutboundScheduler(OutboundScheduler):
+    """
+    OutboundScheduler for coroutines, waits with asyncio.sleep. All calls
+    have to come from the same event loop.
+    """
+
+    async def call(self, chat_id, fn, *args, coalesce_key=None, **kwargs):
+        sequence = self._register(coalesce_key)
+        try:
+            for attempt in range(self._max_retries + 1):
+                while True:
+                    if self._superseded(coalesce_key, sequence):
+                        return SUPERSEDED
+                    delay = self._try_take(chat_id)
+                    if delay <= 0:
+                        break
+                    self.throttled += 1
+                    await asyncio.sleep(delay)
+                try:
+                    return await fn(*args, **kwargs)
+                except Exception as e:
+                    wait = retry_after(e)
+                    if wait is None or attempt == self._max_retries:
+                        raise
+                    self._block(chat_id, wait)
+        finally:
+            self._done(coalesce_key, sequence)
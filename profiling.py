@@ -0,0 +1,83 @@
+import cProfile
+import contextvars
+import itertools
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import yappi
+except ImportError:
+    yappi = None
+
+_tag = contextvars.ContextVar("profile_tag", default=0)
+_tags = itertools.count(1)
+
+
+class HandlerProfiler:
+    """
+    Profiles a sample of updates, one at a time, and saves each profile to
+    directory as a pstats file named after its handler. Coroutine handlers
+    are profiled with yappi when it is installed, so other tasks of the loop
+    stay out of the profile. cProfile is used otherwise.
+    """
+
+    def __init__(self, directory: str = "profiles", sample_rate: float = 0.0):
+        self._directory = directory
+        self._sample_rate = sample_rate
+        self._busy = threading.Lock()
+        self.saved = 0
+        if sample_rate > 0:
+            os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def sample(self, name: str, coroutine: bool = False):
+        """
+        Profile the block for sample_rate of the calls
+        """
+        if (
+            self._sample_rate <= 0
+            or random.random() >= self._sample_rate
+            or not self._busy.acquire(blocking=False)
+        ):
+            yield
+            return
+        try:
+            profile = self._yappi if coroutine and yappi is not None else self._cprofile
+            with profile(self._path(name)):
+                yield
+            self.saved += 1
+        finally:
+            self._busy.release()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(
+            self._directory, "%s-%d-%d.prof" % (name, time.time() * 1000, os.getpid())
+        )
+
+    @contextmanager
+    def _cprofile(self, path: str):
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(path)
+
+    @contextmanager
+    def _yappi(self, path: str):
+        tag = next(_tags)
+        token = _tag.set(tag)
+        yappi.set_clock_type("wall")
+        yappi.set_tag_callback(_tag.get)
+        yappi.start()
+        try:
+            yield
+        finally:
+            yappi.stop()
+            _tag.reset(token)
+            yappi.get_func_stats(filter={"tag": tag}).save(path, type="pstat")
+            yappi.clear_stats()
@@ -0,0 +1,64 @@
+from typing import Callable
+from telebot import types
+from services import access_allowed, state_name
+
+
+def callback_prefix(data: str) -> str:
+    """
+    Leading word of callback data, e.g. group_sel for group_sel;Living and
+    Action for Action:3
+    """
+    return data.partition(";")[0].partition(":")[0]
+
+
+class CallbackRouter:
+    """
+    Callback query routes indexed by (state, callback data prefix). The
+    user's state is looked up once per update and finding the handler is a
+    dict lookup, whatever the number of routes or catalog entries.
+    """
+
+    def __init__(self):
+        self._routes: dict[tuple[str, str], list[tuple]] = {}
+
+    def route(
+        self,
+        state,
+        prefix: str,
+        check: Callable[[types.CallbackQuery], bool] = None,
+        restrict: bool = False,
+    ):
+        states = state if isinstance(state, list) else [state]
+
+        def decorator(handler):
+            for s in states:
+                self._routes.setdefault((state_name(s), prefix), []).append(
+                    (check, restrict, handler)
+                )
+            return handler
+
+        return decorator
+
+    def wrap(self, wrapper: Callable):
+        """
+        Replace the handler of every route with wrapper(handler)
+        """
+        for routes in self._routes.values():
+            routes[:] = [
+                (check, restrict, wrapper(handler))
+                for check, restrict, handler in routes
+            ]
+
+    def resolve(self, state, call: types.CallbackQuery):
+        """
+        Handler of the first route matching the call, None when no route does
+        """
+        for check, restrict, handler in self._routes.get(
+            (state_name(state), callback_prefix(call.data)), ()
+        ):
+            if check is not None and not check(call):
+                continue
+            if restrict and not access_allowed(call.from_user.id):
+                continue
+            return handler
+        return None
@@ -1,4 +1,7 @@
+import asyncio
 import platform
+import threading
+import time
 import telebot
 import shlex
 from app_config import Configuration
@@ -6,17 +9,18 @@ from datetime import datetime
 from telebot import TeleBot
 from telebot.async_telebot import AsyncTeleBot
 from telebot.custom_filters import SimpleCustomFilter
-from telebot.custom_filters import StateFilter
+from telebot.custom_filters import StateFilter as BaseStateFilter
 from telebot.custom_filters import IsDigitFilter
 from telebot.custom_filters import AdvancedCustomFilter
 from telebot.asyncio_filters import SimpleCustomFilter as AsyncSimpleCustomFilter
-from telebot.asyncio_filters import StateFilter as AsyncStateFilter
+from telebot.asyncio_filters import StateFilter as AsyncBaseStateFilter
 from telebot.asyncio_filters import IsDigitFilter as AsyncIsDigitFilter
 from telebot.asyncio_filters import AdvancedCustomFilter as AsyncAdvancedCustomFilter
 from telebot.callback_data import CallbackData, CallbackDataFilter
 from telebot import types
 from kink import di
 from enum import IntEnum
+from collections import OrderedDict
 from zoneinfo import ZoneInfo
 from typing import Any, Dict
 from logging import Logger
@@ -29,14 +33,48 @@ class ExceptionHandler(telebot.ExceptionHandler):
         di[Logger].error(exception)
 
 
+def access_allowed(user_id: int) -> bool:
+    return (
+        di[Configuration]["restrict_access"]
+        and user_id in di[Configuration]["list_of_users"]
+    )
+
+
+def state_name(state) -> str:
+    """
+    Name of a state, storages of newer pyTelegramBotAPI versions keep only
+    the name of the Action that was set
+    """
+    return getattr(state, "name", state)
+
+
+class AsyncStateFilter(AsyncBaseStateFilter):
+    """
+    Matches the stored state name against Action states
+    """
+
+    async def check(self, message, text):
+        if isinstance(text, list):
+            return await super().check(message, [state_name(s) for s in text])
+        return await super().check(message, state_name(text))
+
+
+class StateFilter(BaseStateFilter):
+    """
+    Matches the stored state name against Action states
+    """
+
+    def check(self, message, text):
+        if isinstance(text, list):
+            return super().check(message, [state_name(s) for s in text])
+        return super().check(message, state_name(text))
+
+
 class AsyncRestrictAccessFilter(AsyncSimpleCustomFilter):
     key = "restrict"
 
     async def check(self, message: types.Message):
-        return (
-            di[Configuration]["restrict_access"]
-            and message.from_user.id in di[Configuration]["list_of_users"]
-        )
+        return access_allowed(message.from_user.id)
 
 
 class AsyncActionsCallbackFilter(AsyncAdvancedCustomFilter):
@@ -57,10 +95,7 @@ class RestrictAccessFilter(SimpleCustomFilter):
     key = "restrict"
 
     def check(self, message: types.Message):
-        return (
-            di[Configuration]["restrict_access"]
-            and message.from_user.id in di[Configuration]["list_of_users"]
-        )
+        return access_allowed(message.from_user.id)
 
 
 class BotFactory:
@@ -95,6 +130,12 @@ class Action(IntEnum):
     quick_end = 200
     category_list = 300
     category_end = 301
+    import_file = 400
+    batch_end = 500
+
+
+# Column filled by the amount of each quick add command
+QUICK_ADD = {"addexp": "Outflow", "addinc": "Inflow"}
 
 
 class TextUtil:
@@ -117,6 +158,50 @@ class TextUtil:
         lex.commenters = ""
         return list(lex)
 
+    def is_quick_add_batch(text: str) -> bool:
+        """Several lines starting with an AddExp/AddInc command"""
+        lines = (text or "").strip().splitlines()
+        return len(lines) > 1 and lines[0][:6].lower() in QUICK_ADD
+
+    def parse_quick_add(line: str) -> list:
+        """
+        Transaction row of one AddExp/AddInc line, raises ValueError with a
+        message for the user when the line is invalid
+        """
+        result = TextUtil.text_splitter(line)
+        command = result.pop(0).lower() if result else ""
+        if command not in QUICK_ADD:
+            raise ValueError(f"Expected AddExp or AddInc, received {command}")
+        if len(result) != 2:
+            raise ValueError(
+                f"Expected 2 parameters, received {len(result)}: [{result}]"
+            )
+        amount, memo = result
+        try:
+            amount = float(amount)
+        except ValueError:
+            raise ValueError(f"{amount} is not a number")
+        trx = TransactionData()
+        trx["Date"] = DateUtil.date_today()
+        trx[QUICK_ADD[command]] = amount
+        trx["Memo"] = memo
+        return trx.to_row()
+
+    def format_batch(rows: list[list]) -> str:
+        currency = di[Configuration]["currency"]
+        lines = []
+        total = {"Outflow": 0.0, "Inflow": 0.0}
+        for row in rows:
+            trx = TransactionData.from_row(row)
+            column = "Outflow" if trx["Outflow"] != "" else "Inflow"
+            total[column] += trx[column]
+            lines.append(f"{column} {currency} {trx[column]:,} {trx['Memo']}")
+        lines.append(
+            f"Total: {len(rows)} transactions, outflow {currency} "
+            + f"{total['Outflow']:,}, inflow {currency} {total['Inflow']:,}"
+        )
+        return "\n".join(lines)
+
 
 class DateUtil:
     def date_today() -> str:
@@ -125,14 +210,127 @@ class DateUtil:
         return today
 
 
-class TransactionData(dict[str, Any]):
+class TransactionData:
+    """
+    Draft transaction, fields are accessed by their sheet column name
+    """
+
+    __slots__ = ("date", "outflow", "inflow", "category", "account", "memo")
+    columns = {
+        "Date": "date",
+        "Outflow": "outflow",
+        "Inflow": "inflow",
+        "Category": "category",
+        "Account": "account",
+        "Memo": "memo",
+    }
+
+    def __init__(self):
+        self.reset()
+
+    def __getitem__(self, key: str) -> Any:
+        return getattr(self, self.columns[key])
+
+    def __setitem__(self, key: str, value: Any):
+        setattr(self, self.columns[key], value)
+
+    def items(self):
+        return ((key, getattr(self, name)) for key, name in self.columns.items())
+
     def reset(self):
-        self["Date"] = ""
-        self["Outflow"] = ""
-        self["Inflow"] = ""
-        self["Category"] = ""
-        self["Account"] = ""
-        self["Memo"] = ""
+        for name in self.__slots__:
+            setattr(self, name, "")
+
+    def to_row(self) -> list:
+        return [getattr(self, name) for name in self.__slots__]
+
+    @classmethod
+    def from_row(cls, row: list) -> "TransactionData":
+        trx = cls()
+        for name, value in zip(cls.__slots__, row):
+            setattr(trx, name, value)
+        return trx
+
+
+class Session:
+    """
+    Conversation of one user in one chat: the draft transaction, the rows
+    of a quick add batch waiting to be saved and the message showing them
+    """
+
+    __slots__ = (
+        "chat_id",
+        "user_id",
+        "trx",
+        "batch",
+        "message_id",
+        "last_seen",
+        "version",
+    )
+
+    def __init__(self, chat_id: int, user_id: int):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.trx = TransactionData()
+        self.batch: list[list] = []
+        self.message_id = None
+        self.last_seen = 0.0
+        # Stored copy the session was read from or written to, if any
+        self.version = None
+
+
+class SessionStore:
+    """
+    Sessions keyed by (chat id, user id). The least recently used ones are
+    dropped once idle for idle_timeout seconds or above max_sessions.
+    """
+
+    def __init__(self, max_sessions: int = 1000, idle_timeout: float = 3600):
+        self._sessions: OrderedDict[tuple[int, int], Session] = OrderedDict()
+        self._max_sessions = max_sessions
+        self._idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, chat_id: int, user_id: int) -> Session:
+        now = time.monotonic()
+        key = (chat_id, user_id)
+        with self._lock:
+            session = self._sessions.pop(key, None)
+            if session is None or not self.is_current(session):
+                session = self.load(chat_id, user_id)
+            session.last_seen = now
+            self._sessions[key] = session
+            self._evict(now)
+        return session
+
+    def for_message(self, message: types.Message) -> Session:
+        return self.get(message.chat.id, message.from_user.id)
+
+    def for_call(self, call: types.CallbackQuery) -> Session:
+        return self.get(call.message.chat.id, call.from_user.id)
+
+    def load(self, chat_id: int, user_id: int) -> Session:
+        return Session(chat_id, user_id)
+
+    def is_current(self, session: Session) -> bool:
+        """Whether a cached session is still the latest, always in memory"""
+        return True
+
+    def save(self, session: Session):
+        """Persist a changed session, nothing to do when kept in memory"""
+
+    def _evict(self, now: float):
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if (
+                len(self._sessions) <= self._max_sessions
+                and now - oldest.last_seen < self._idle_timeout
+            ):
+                return
+            self._sessions.popitem(last=False)
 
 
 class KeyboardUtil:
@@ -143,6 +341,23 @@ class KeyboardUtil:
             ]
         )
 
+    def create_batch_keyboard():
+        return types.InlineKeyboardMarkup(
+            keyboard=[
+                [
+                    types.InlineKeyboardButton(
+                        text="💾 Save all", callback_data="batch_save"
+                    ),
+                    types.InlineKeyboardButton(
+                        text="Cancel",
+                        callback_data=di[CallbackData].new(
+                            action_id=int(Action.cancel)
+                        ),
+                    ),
+                ]
+            ]
+        )
+
     def create_default_options_keyboard():
         """
         Menu keyboard for start command
@@ -159,7 +374,7 @@ class KeyboardUtil:
                 )
         return types.InlineKeyboardMarkup(keyboard)
 
-    def create_options_keyboard():
+    def create_options_keyboard(trx: TransactionData):
         """
         Menu keyboard for updating transaction data
         """
@@ -173,7 +388,7 @@ class KeyboardUtil:
                     )
                 ]
             else:
-                data = di[TransactionData][action.name.capitalize()]
+                data = trx[action.name.capitalize()]
                 if action == Action.outflow or action == Action.inflow:
                     displayData = (
                         f"{action.name.capitalize()}: "
@@ -197,6 +412,46 @@ class KeyboardUtil:
         return types.InlineKeyboardMarkup(keyboard)
 
 
+class BackgroundLoop:
+    """
+    Event loop running forever in a daemon thread, coroutines can be
+    handed to it from any thread
+    """
+
+    def __init__(self, name: str = "background-loop"):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self):
+        if not self._thread.is_alive():
+            self._thread.start()
+
+    def stop(self):
+        if self._thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout: float = None):
+        """Run a coroutine on the loop and wait for it from another thread"""
+        return self.submit(coro).result(timeout)
+
+    async def call(self, coro):
+        """Await a coroutine on the loop from any other event loop"""
+        if asyncio.get_running_loop() is self.loop:
+            return await coro
+        return await asyncio.wrap_future(self.submit(coro))
+
+    def call_soon(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+
 def silence_event_loop_closed(func):
     @wraps(func)
     def wrapper(self, *args, **kwargs):
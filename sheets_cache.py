@@ -0,0 +1,108 @@
+import threading
+import time
+from functools import wraps
+from gspread import Client, Spreadsheet, Worksheet
+from gspread.exceptions import APIError, WorksheetNotFound
+
+
+def is_missing_sheet_error(e: Exception) -> bool:
+    """
+    Errors returned when a worksheet was deleted or renamed
+    """
+    if isinstance(e, WorksheetNotFound):
+        return True
+    if isinstance(e, APIError):
+        return e.code == 404 or (
+            e.code == 400 and "Unable to parse range" in str(e.error.get("message"))
+        )
+    return False
+
+
+class CachedWorksheet:
+    """
+    Worksheet handle that drops itself from the cache when the sheet is gone
+    """
+
+    def __init__(self, worksheet: Worksheet, owner: "CachedSpreadsheet"):
+        self._worksheet = worksheet
+        self._owner = owner
+
+    def __getattr__(self, name):
+        attr = getattr(self._worksheet, name)
+        if not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def wrapper(*args, **kwargs):
+            try:
+                return attr(*args, **kwargs)
+            except Exception as e:
+                if is_missing_sheet_error(e):
+                    self._owner.invalidate(self._worksheet.title)
+                raise
+
+        return wrapper
+
+
+class CachedSpreadsheet:
+    """
+    Wraps a Spreadsheet and memoizes its Worksheet handles by title so that
+    each lookup does not fetch the whole spreadsheet metadata again. The
+    spreadsheet itself is only opened on first use, values and modified time
+    are read by key without opening it.
+    """
+
+    def __init__(self, client: Client, key: str, ttl: float = 300):
+        self.id = key
+        self._client = client
+        self._opened: Spreadsheet = None
+        self._ttl = ttl
+        self._worksheets: dict[str, tuple[float, CachedWorksheet]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        return getattr(self._spreadsheet, name)
+
+    @property
+    def _spreadsheet(self) -> Spreadsheet:
+        if self._opened is None:
+            with self._lock:
+                if self._opened is None:
+                    self._opened = self._client.open_by_key(self.id)
+        return self._opened
+
+    def values_batch_get(self, ranges: list[str], params: dict = None) -> dict:
+        return self._client.http_client.values_batch_get(self.id, ranges, params)
+
+    def get_lastUpdateTime(self) -> str:
+        return self._client.http_client.get_file_drive_metadata(self.id)["modifiedTime"]
+
+    def worksheet(self, title: str) -> CachedWorksheet:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._worksheets.get(title)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        try:
+            worksheet = CachedWorksheet(self._spreadsheet.worksheet(title), self)
+        except Exception as e:
+            if is_missing_sheet_error(e):
+                self.invalidate(title)
+            raise
+        with self._lock:
+            self._worksheets[title] = (now + self._ttl, worksheet)
+        return worksheet
+
+    def invalidate(self, title: str = None):
+        """
+        Forget one cached worksheet, or all of them when no title is given
+        """
+        with self._lock:
+            if title is None:
+                self._worksheets.clear()
+            else:
+                self._worksheets.pop(title, None)
@@ -0,0 +1,45 @@
+import contextvars
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class SheetsBusyError(Exception):
+    """Raised when too many spreadsheet calls are already waiting"""
+
+
+class SheetsExecutor:
+    """
+    Dedicated, bounded thread pool for blocking gspread calls so that
+    they never run on the bot's event loop
+    """
+
+    def __init__(self, max_workers: int = 4, queue_limit: int = 32, timeout=30.0):
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="sheets"
+        )
+        self._slots = threading.BoundedSemaphore(max_workers + queue_limit)
+        self._timeout = timeout
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        if not self._slots.acquire(blocking=False):
+            raise SheetsBusyError("Too many spreadsheet calls are pending")
+        try:
+            # Run in the caller's context, so the handler waiting for the
+            # call is charged for its Sheets time
+            future = self._pool.submit(
+                contextvars.copy_context().run, fn, *args, **kwargs
+            )
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def call(self, fn, *args, timeout: float = None, **kwargs):
+        """
+        Run fn in the pool and wait for its result from a regular thread
+        """
+        return self.submit(fn, *args, **kwargs).result(timeout or self._timeout)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
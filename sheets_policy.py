@@ -0,0 +1,300 @@
+import asyncio
+import contextvars
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import unquote, urlsplit
+import requests
+from gspread.exceptions import APIError
+from gspread.http_client import HTTPClient
+from metrics import MetricsRegistry, waiting
+
+# Statuses worth retrying, None stands for a connection error or timeout
+RETRY_STATUSES = {None, 408, 429, 500, 502, 503, 504}
+QUOTA_WINDOW = 60.0
+# Custom methods of the Sheets API, the part of a URL after its last colon
+SHEETS_VERBS = {"append", "batchClear", "batchGet", "batchUpdate", "clear", "copyTo"}
+
+_background = contextvars.ContextVar("sheets_background", default=False)
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling Sheets while the circuit breaker is open"""
+
+
+@contextmanager
+def background(enabled: bool = True):
+    """
+    Mark the Sheets calls made inside as background work, they leave part
+    of the quota to user facing calls
+    """
+    token = _background.set(enabled)
+    try:
+        yield
+    finally:
+        _background.reset(token)
+
+
+def parse_retry_after(value) -> float:
+    """Seconds of a Retry-After header, given in seconds or as a date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class SheetsPolicy:
+    """
+    Retry, quota and circuit breaker policy shared by every Sheets call.
+    Retries use exponential backoff with full jitter, or the Retry-After the
+    API sent when it is longer. Requests are counted over a sliding minute,
+    background calls wait once fewer than background_reserve requests are
+    left. After failure_threshold failures in a row the circuit opens and
+    calls fail at once for reset_timeout seconds, then one trial call
+    decides whether it closes again. A failed call is not retried once the
+    delay would take it past timeout seconds, its caller stops waiting then.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 5,
+        base_delay: float = 0.5,
+        max_delay: float = 32.0,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        quota_per_minute: int = 60,
+        background_reserve: int = 10,
+        metrics: MetricsRegistry = None,
+        timeout: float = None,
+    ):
+        if background_reserve >= quota_per_minute:
+            raise ValueError("background_reserve must be lower than quota_per_minute")
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._quota = quota_per_minute
+        self._background_reserve = background_reserve
+        self._timeout = timeout
+        self._requests: deque[float] = deque()
+        self._paused_until = 0.0
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.rejected = 0
+        self._seconds = None
+        if metrics is not None:
+            self._seconds = metrics.histogram(
+                "sheets_request_seconds",
+                "Time spent in Sheets requests, retries included",
+                ("operation", "outcome"),
+            )
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if self._trial or time.monotonic() >= self._opened_at + self._reset_timeout:
+                return "half-open"
+            return "open"
+
+    def remaining(self) -> int:
+        """Requests left in the current minute"""
+        with self._lock:
+            self._expire(time.monotonic())
+            return self._quota - len(self._requests)
+
+    def _expire(self, now: float):
+        while self._requests and self._requests[0] <= now - QUOTA_WINDOW:
+            self._requests.popleft()
+
+    def _acquire(self) -> float:
+        """
+        Take a request slot, or return how long to wait for one. Raises
+        CircuitOpenError while the circuit is open.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._opened_at is not None and (
+                self._trial or now < self._opened_at + self._reset_timeout
+            ):
+                self.rejected += 1
+                raise CircuitOpenError("Google Sheets is unavailable")
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._expire(now)
+            reserve = self._background_reserve if _background.get() else 0
+            if len(self._requests) >= self._quota - reserve:
+                # Wait for the oldest request to leave the window
+                return self._requests[0] + QUOTA_WINDOW - now
+            if self._opened_at is not None:
+                self._trial = True
+            self._requests.append(now)
+            return 0.0
+
+    def _succeeded(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def _failed(self, info: tuple, attempt: int, started: float = None) -> float:
+        """
+        Record a failed call from its (status, retry_after), None for errors
+        that are not Sheets failures. Returns the delay before retrying it
+        or None when it should not be retried.
+        """
+        with self._lock:
+            trial = self._trial
+            self._trial = False
+            if info is None:
+                return None
+            status, retry_after = info
+            now = time.monotonic()
+            if status is not None and status != 408 and status < 500:
+                # Sheets answered, so it is up even if the call failed
+                self._failures = 0
+                self._opened_at = None
+            if status not in RETRY_STATUSES:
+                return None
+            if status == 429:
+                # Quota is exhausted for everyone, not only this call
+                self._paused_until = max(
+                    self._paused_until, now + (retry_after or self._base_delay)
+                )
+            else:
+                self._failures += 1
+                if trial or self._failures >= self._failure_threshold:
+                    self._opened_at = now
+                    return None
+            if attempt + 1 >= self._max_attempts:
+                return None
+            delay = random.uniform(
+                0, min(self._max_delay, self._base_delay * 2**attempt)
+            )
+            delay = max(delay, retry_after or 0.0)
+            if (
+                self._timeout is not None
+                and started is not None
+                and now + delay - started >= self._timeout
+            ):
+                return None
+            self.retries += 1
+            return delay
+
+    def _timer(self, operation: str):
+        return waiting("sheets", self._seconds, operation)
+
+    def call(self, fn, classify, operation: str = "request"):
+        """
+        Run fn under the policy, classify turns an exception into its
+        (status, retry_after) or None when it is not a Sheets failure
+        """
+        with self._timer(operation):
+            started = time.monotonic()
+            attempt = 0
+            while True:
+                delay = self._acquire()
+                if delay > 0:
+                    time.sleep(delay)
+                    continue
+                try:
+                    result = fn()
+                except Exception as e:
+                    delay = self._failed(classify(e), attempt, started)
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    time.sleep(delay)
+                    continue
+                except BaseException:
+                    self._failed(None, attempt)
+                    raise
+                self._succeeded()
+                return result
+
+    async def async_call(self, fn, classify, operation: str = "request"):
+        """
+        Same as call for a coroutine function, waits with asyncio.sleep
+        """
+        with self._timer(operation):
+            started = time.monotonic()
+            attempt = 0
+            while True:
+                delay = self._acquire()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                try:
+                    result = await fn()
+                except Exception as e:
+                    delay = self._failed(classify(e), attempt, started)
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    await asyncio.sleep(delay)
+                    continue
+                except BaseException:
+                    self._failed(None, attempt)
+                    raise
+                self._succeeded()
+                return result
+
+
+def sheets_operation(method: str, url: str) -> str:
+    """
+    Metric label of a Sheets or Drive request without the ids and ranges of
+    its URL, e.g. values.append or spreadsheets.get
+    """
+    path = unquote(urlsplit(url).path).rstrip("/")
+    if "/drive/" in path:
+        return "drive." + method.lower()
+    resource = "values" if "/values" in path else "spreadsheets"
+    verb = path.rpartition(":")[2]
+    if verb not in SHEETS_VERBS:
+        verb = method.lower()
+    return f"{resource}.{verb}"
+
+
+def gspread_error(e: Exception):
+    """(status, retry_after) of a failed gspread request"""
+    if isinstance(e, APIError):
+        return e.response.status_code, parse_retry_after(
+            e.response.headers.get("Retry-After")
+        )
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return None, None
+    return None
+
+
+class PolicyHTTPClient(HTTPClient):
+    """
+    gspread HTTP client sending every request through a SheetsPolicy, pass
+    functools.partial(PolicyHTTPClient, policy=policy) as http_client
+    """
+
+    def __init__(self, *args, policy: SheetsPolicy, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.policy = policy
+
+    def request(self, method: str, endpoint: str, *args, **kwargs):
+        return self.policy.call(
+            lambda: super(PolicyHTTPClient, self).request(
+                method, endpoint, *args, **kwargs
+            ),
+            gspread_error,
+            sheets_operation(method, endpoint),
+        )
@@ -0,0 +1,189 @@
+"""
+Local stand-in for the Google OAuth token endpoint, the Sheets v4 values
+API and the Drive modified time, enough to run the aiohttp Sheets backend
+offline:
+
+    python sheets_stub.py --port 8085 --credentials stub_credentials.json
+
+Then set sheets_backend = "aiohttp", sheets_api_url and drive_api_url to
+"http://localhost:8085" and use the base64 encoded stub_credentials.json as
+credentials_json.
+"""
+
+import argparse
+import asyncio
+import json
+from datetime import datetime, timezone
+from aiohttp import web
+from gspread import utils
+
+STUB_TOKEN = "stub-token"
+
+
+class StubSpreadsheet:
+    """
+    In-memory grid per sheet plus the named ranges the bot reads
+    """
+
+    def __init__(self):
+        self.modified_time = ""
+        self.sheets: dict[str, dict[tuple[int, int], str]] = {
+            "Configuration": {},
+            "Transactions": {},
+        }
+        self.named_ranges = {
+            "r_ConfigurationData": "Configuration!B10:C60",
+            "TransactionCategories": "Configuration!F10:F60",
+            "cfg_Accounts": "Configuration!H10:H30",
+            "trx_Dates": "Transactions!B9:B5000",
+        }
+        self.write(
+            "Configuration!B10:C15",
+            [
+                ["✦", "Living"],
+                ["", "Rent"],
+                ["", "Groceries"],
+                ["✦", "Fun"],
+                ["", "Dining Out"],
+                ["◘", "Credit Card Payments"],
+            ],
+        )
+        self.write(
+            "Configuration!F10:F13",
+            [["Rent"], ["Groceries"], ["Dining Out"], ["Available to budget"]],
+        )
+        self.write("Configuration!H10:H11", [["Cash"], ["Checking"]])
+
+    def resolve(self, range_name: str) -> tuple[str, int, int, int, int]:
+        range_name = self.named_ranges.get(range_name, range_name)
+        sheet, _, cells = range_name.rpartition("!")
+        first, _, last = cells.partition(":")
+        row1, col1 = utils.a1_to_rowcol(first)
+        row2, col2 = utils.a1_to_rowcol(last or first)
+        return sheet.strip("'"), row1, col1, row2, col2
+
+    def read(self, range_name: str) -> dict:
+        sheet, row1, col1, row2, col2 = self.resolve(range_name)
+        grid = self.sheets[sheet]
+        values = []
+        for row in range(row1, row2 + 1):
+            cells = [grid.get((row, col), "") for col in range(col1, col2 + 1)]
+            while cells and cells[-1] == "":
+                cells.pop()
+            values.append(cells)
+        while values and not values[-1]:
+            values.pop()
+        a1 = utils.rowcol_to_a1(row1, col1) + ":" + utils.rowcol_to_a1(row2, col2)
+        result = {"range": f"{sheet}!{a1}", "majorDimension": "ROWS"}
+        if values:
+            result["values"] = values
+        return result
+
+    def write(self, range_name: str, values: list[list]) -> dict:
+        sheet, row1, col1, _, _ = self.resolve(range_name)
+        grid = self.sheets.setdefault(sheet, {})
+        for i, row in enumerate(values):
+            for j, value in enumerate(row):
+                grid[(row1 + i, col1 + j)] = str(value)
+        self.modified_time = datetime.now(timezone.utc).isoformat()
+        return {
+            "updatedRange": range_name,
+            "updatedRows": len(values),
+            "updatedCells": sum(len(row) for row in values),
+        }
+
+
+def create_app(latency: float = 0.0) -> web.Application:
+    spreadsheet = StubSpreadsheet()
+    routes = web.RouteTableDef()
+
+    @web.middleware
+    async def stub_middleware(request: web.Request, handler):
+        if latency:
+            await asyncio.sleep(latency)
+        if request.path != "/token" and (
+            request.headers.get("Authorization") != "Bearer " + STUB_TOKEN
+        ):
+            return web.json_response(
+                {"error": {"code": 401, "message": "Invalid credentials"}}, status=401
+            )
+        return await handler(request)
+
+    @routes.post("/token")
+    async def token(request: web.Request):
+        return web.json_response(
+            {"access_token": STUB_TOKEN, "expires_in": 3600, "token_type": "Bearer"}
+        )
+
+    @routes.get("/v4/spreadsheets/{id}/values:batchGet")
+    async def values_batch_get(request: web.Request):
+        return web.json_response(
+            {
+                "spreadsheetId": request.match_info["id"],
+                "valueRanges": [
+                    spreadsheet.read(r) for r in request.query.getall("ranges", [])
+                ],
+            }
+        )
+
+    @routes.get("/v4/spreadsheets/{id}/values/{range}")
+    async def values_get(request: web.Request):
+        return web.json_response(spreadsheet.read(request.match_info["range"]))
+
+    @routes.put("/v4/spreadsheets/{id}/values/{range}")
+    async def values_update(request: web.Request):
+        body = await request.json()
+        result = spreadsheet.write(request.match_info["range"], body["values"])
+        result["spreadsheetId"] = request.match_info["id"]
+        return web.json_response(result)
+
+    @routes.get("/drive/v3/files/{id}")
+    async def file_get(request: web.Request):
+        return web.json_response(
+            {"id": request.match_info["id"], "modifiedTime": spreadsheet.modified_time}
+        )
+
+    app = web.Application(middlewares=[stub_middleware])
+    app.add_routes(routes)
+    app["spreadsheet"] = spreadsheet
+    return app
+
+
+def write_credentials(path: str, token_uri: str):
+    """
+    Throwaway service account whose token requests go to the stub
+    """
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode()
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "type": "service_account",
+                "client_email": "stub@localhost",
+                "private_key_id": "stub",
+                "private_key": pem,
+                "token_uri": token_uri,
+            },
+            f,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline Google Sheets stub")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8085)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--credentials", help="write matching credentials here")
+    args = parser.parse_args()
+    if args.credentials:
+        write_credentials(
+            args.credentials, "http://%s:%d/token" % (args.host, args.port)
+        )
+    web.run_app(create_app(args.latency), host=args.host, port=args.port)
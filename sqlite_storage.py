@@ -0,0 +1,370 @@
+import json
+import pickle
+import sqlite3
+import threading
+import time
+from telebot.storage import StateStorageBase
+from telebot.storage.base_storage import StateDataContext
+from telebot.asyncio_storage import StateStorageBase as AsyncStateStorageBase
+from telebot.asyncio_storage.base_storage import (
+    StateDataContext as AsyncStateDataContext,
+)
+from services import Session, SessionStore, state_name
+
+CREATE_TABLES = """
+CREATE TABLE IF NOT EXISTS states (
+    key TEXT PRIMARY KEY,
+    state BLOB,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    message_id INTEGER,
+    trx TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (chat_id, user_id)
+);
+"""
+SELECT_STATE = "SELECT state, data FROM states WHERE key = ?"
+UPSERT_STATE = (
+    "INSERT INTO states (key, state, data) VALUES (?, ?, ?) "
+    "ON CONFLICT (key) DO UPDATE SET state = excluded.state"
+)
+UPDATE_DATA = "UPDATE states SET data = ? WHERE key = ?"
+DELETE_STATE = "DELETE FROM states WHERE key = ?"
+COUNT_STATES = "SELECT COUNT(*) FROM states"
+SELECT_SESSION = (
+    "SELECT message_id, trx, updated FROM sessions WHERE chat_id = ? AND user_id = ?"
+)
+SELECT_SESSION_UPDATED = (
+    "SELECT updated FROM sessions WHERE chat_id = ? AND user_id = ?"
+)
+UPSERT_SESSION = (
+    "INSERT INTO sessions (chat_id, user_id, message_id, trx, updated) "
+    "VALUES (?, ?, ?, ?, ?) ON CONFLICT (chat_id, user_id) DO UPDATE SET "
+    "message_id = excluded.message_id, trx = excluded.trx, updated = excluded.updated"
+)
+PURGE_SESSIONS = "DELETE FROM sessions WHERE updated < ?"
+# Seconds between deletions of idle sessions
+SESSION_PURGE_INTERVAL = 60.0
+# Quick add batch rows are kept next to the draft columns in the trx JSON
+BATCH_KEY = "_batch"
+
+
+class SQLiteDatabase:
+    """
+    WAL mode SQLite connection shared by the state and session stores.
+    Several processes on one host can use the same file. Writes are
+    committed in batches, after commit_every statements or commit_interval
+    seconds, whichever comes first.
+    """
+
+    def __init__(self, path: str, commit_every: int = 32, commit_interval=0.1):
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, timeout=5, cached_statements=64
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(CREATE_TABLES)
+        self._commit_every = commit_every
+        self._commit_interval = commit_interval
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(
+            target=self._run, name="sqlite-commit", daemon=True
+        )
+        self._flusher.start()
+
+    def write(self, sql: str, params: tuple):
+        with self._lock:
+            self._conn.execute(sql, params)
+            self._pending += 1
+            if self._pending >= self._commit_every:
+                self._commit()
+
+    def read(self, sql: str, params: tuple):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        self._closed.set()
+        self._flusher.join()
+        with self._lock:
+            self._commit()
+            self._conn.close()
+
+    def _commit(self):
+        if self._pending:
+            self._conn.commit()
+            self._pending = 0
+
+    def _run(self):
+        while not self._closed.wait(self._commit_interval):
+            self.flush()
+
+
+def state_key(chat_id, user_id, business_connection_id, message_thread_id, bot_id):
+    return ":".join(
+        str(i)
+        for i in (bot_id, business_connection_id, message_thread_id, chat_id, user_id)
+        if i
+    )
+
+
+class StateSQLiteStorage(StateStorageBase):
+    """
+    Bot state storage kept in SQLite so that it survives restarts.
+    States are pickled to come back as the same objects, like the default
+    in-memory storage returns them.
+    """
+
+    def __init__(self, db: SQLiteDatabase):
+        super().__init__()
+        self._db = db
+
+    def __len__(self):
+        return self._db.read(COUNT_STATES, ())[0]
+
+    def set_state(
+        self,
+        chat_id,
+        user_id,
+        state,
+        business_connection_id=None,
+        message_thread_id=None,
+        bot_id=None,
+    ):
+        key = state_key(
+            chat_id, user_id, business_connection_id, message_thread_id, bot_id
+        )
+        # Only the name, like the memory storage, so filters and routes see
+        # the same value whichever storage is configured
+        self._db.write(
+            UPSERT_STATE, (key, pickle.dumps(state_name(state)), pickle.dumps({}))
+        )
+        return True
+
+    def get_state(
+        self,
+        chat_id,
+        user_id,
+        business_connection_id=None,
+        message_thread_id=None,
+        bot_id=None,
+    ):
+        row = self._db.read(
+            SELECT_STATE,
+            (
+                state_key(
+                    chat_id, user_id, business_connection_id, message_thread_id, bot_id
+                ),
+            ),
+        )
+        # Rows written before states were stored by name hold the Action
+        return state_name(pickle.loads(row[0])) if row else None
+
+    def delete_state(
+        self,
+        chat_id,
+        user_id,
+        business_connection_id=None,
+        message_thread_id=None,
+        bot_id=None,
+    ):
+        key = state_key(
+            chat_id, user_id, business_connection_id, message_thread_id, bot_id
+        )
+        if self._db.read(SELECT_STATE, (key,)) is None:
+            return False
+        self._db.write(DELETE_STATE, (key,))
+        return True
+
+    def get_data(
+        self,
+        chat_id,
+        user_id,
+        business_connection_id=None,
+        message_thread_id=None,
+        bot_id=None,
+    ):
+        row = self._db.read(
+            SELECT_STATE,
+            (
+                state_key(
+                    chat_id, user_id, business_connection_id, message_thread_id, bot_id
+                ),
+            ),
+        )
+        return pickle.loads(row[1]) if row else {}
+
+    def set_data(
+        self,
+        chat_id,
+        user_id,
+        key,
+        value,
+        business_connection_id=None,
+        message_thread_id=None,
+        bot_id=None,
+    ):
+        data = self.get_data(
+            chat_id, user_id, business_connection_id, message_thread_id, bot_id
+        )
+        data[key] = value
+        return self.save(
+            chat_id, user_id, data, business_connection_id, message_thread_id, bot_id
+        )
+
+    def reset_data(
+        self,
+        chat_id,
+        user_id,
+        business_connection_id=None,
+        message_thread_id=None,
+        bot_id=None,
+    ):
+        return self.save(
+            chat_id, user_id, {}, business_connection_id, message_thread_id, bot_id
+        )
+
+    def save(
+        self,
+        chat_id,
+        user_id,
+        data,
+        business_connection_id=None,
+        message_thread_id=None,
+        bot_id=None,
+    ):
+        key = state_key(
+            chat_id, user_id, business_connection_id, message_thread_id, bot_id
+        )
+        if self._db.read(SELECT_STATE, (key,)) is None:
+            return False
+        self._db.write(UPDATE_DATA, (pickle.dumps(data), key))
+        return True
+
+    def get_interactive_data(
+        self,
+        chat_id,
+        user_id,
+        business_connection_id=None,
+        message_thread_id=None,
+        bot_id=None,
+    ):
+        return StateDataContext(
+            self,
+            chat_id=chat_id,
+            user_id=user_id,
+            business_connection_id=business_connection_id,
+            message_thread_id=message_thread_id,
+            bot_id=bot_id,
+        )
+
+
+class AsyncStateSQLiteStorage(AsyncStateStorageBase):
+    """
+    Async wrapper of StateSQLiteStorage. Statements are short local disk
+    operations, so they run inline on the event loop.
+    """
+
+    def __init__(self, db: SQLiteDatabase):
+        super().__init__()
+        self._storage = StateSQLiteStorage(db)
+
+    def __len__(self):
+        return len(self._storage)
+
+    async def set_state(self, chat_id, user_id, state, *args, **kwargs):
+        return self._storage.set_state(chat_id, user_id, state, *args, **kwargs)
+
+    async def get_state(self, chat_id, user_id, *args, **kwargs):
+        return self._storage.get_state(chat_id, user_id, *args, **kwargs)
+
+    async def delete_state(self, chat_id, user_id, *args, **kwargs):
+        return self._storage.delete_state(chat_id, user_id, *args, **kwargs)
+
+    async def get_data(self, chat_id, user_id, *args, **kwargs):
+        return self._storage.get_data(chat_id, user_id, *args, **kwargs)
+
+    async def set_data(self, chat_id, user_id, key, value, *args, **kwargs):
+        return self._storage.set_data(chat_id, user_id, key, value, *args, **kwargs)
+
+    async def reset_data(self, chat_id, user_id, *args, **kwargs):
+        return self._storage.reset_data(chat_id, user_id, *args, **kwargs)
+
+    async def save(self, chat_id, user_id, data, *args, **kwargs):
+        return self._storage.save(chat_id, user_id, data, *args, **kwargs)
+
+    def get_interactive_data(
+        self,
+        chat_id,
+        user_id,
+        business_connection_id=None,
+        message_thread_id=None,
+        bot_id=None,
+    ):
+        return AsyncStateDataContext(
+            self,
+            chat_id=chat_id,
+            user_id=user_id,
+            business_connection_id=business_connection_id,
+            message_thread_id=message_thread_id,
+            bot_id=bot_id,
+        )
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Session store that writes drafts and the current transaction message
+    through to SQLite and reads them back after a restart or from another
+    worker process. A cached session is only used while its row was not
+    written by another process. Rows idle for idle_timeout are deleted.
+    """
+
+    def __init__(self, db: SQLiteDatabase, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._db = db
+        self._purged = 0.0
+
+    def load(self, chat_id: int, user_id: int) -> Session:
+        session = Session(chat_id, user_id)
+        row = self._db.read(SELECT_SESSION, (chat_id, user_id))
+        if row is not None:
+            session.message_id = row[0]
+            draft = json.loads(row[1])
+            session.batch = draft.pop(BATCH_KEY, [])
+            for key, value in draft.items():
+                session.trx[key] = value
+            session.version = row[2]
+        return session
+
+    def is_current(self, session: Session) -> bool:
+        row = self._db.read(SELECT_SESSION_UPDATED, (session.chat_id, session.user_id))
+        return (row[0] if row else None) == session.version
+
+    def save(self, session: Session):
+        now = time.time()
+        self._db.write(
+            UPSERT_SESSION,
+            (
+                session.chat_id,
+                session.user_id,
+                session.message_id,
+                json.dumps(dict(session.trx.items(), **{BATCH_KEY: session.batch})),
+                now,
+            ),
+        )
+        session.version = now
+        if now - self._purged >= SESSION_PURGE_INTERVAL:
+            self._purged = now
+            self._db.write(PURGE_SESSIONS, (now - self._idle_timeout,))
+        # Committed right away, the next update of this user may be handled
+        # by another process
+        self._db.flush()
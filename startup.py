@@ -1,14 +1,17 @@
+import asyncio
+import atexit
+import functools
 import telebot
-import aspire_util
 from kink import di
 from app_config import Configuration
-from telebot import TeleBot
-from telebot.async_telebot import AsyncTeleBot
+from telebot import apihelper, asyncio_helper
 from telebot.callback_data import CallbackData
+from telebot.storage import StateMemoryStorage
+from telebot.asyncio_storage import StateMemoryStorage as AsyncStateMemoryStorage
 from logging import Logger
 from services import (
     BotFactory,
-    TransactionData,
+    SessionStore,
     KeyboardUtil,
     RestrictAccessFilter,
     ExceptionHandler,
@@ -19,23 +22,37 @@ from services import (
     AsyncStateFilter,
     AsyncIsDigitFilter,
     AsyncActionsCallbackFilter,
+    BackgroundLoop,
+)
+from catalog import Catalog, AsyncCatalog
+from keyboards import KeyboardCache
+from edits import EditTracker, TrackedTeleBot, AsyncTrackedTeleBot
+from outbound import OutboundScheduler, AsyncOutboundScheduler
+from uploader import TransactionUploader, AsyncTransactionUploader
+from importer import ImportMapping, CsvImporter, AsyncCsvImporter
+from journal import TransactionJournal
+from file_lock import FileLock
+from metrics import MetricsRegistry, instrument_telegram, state_count
+from profiling import HandlerProfiler
+from sheets_policy import SheetsPolicy, PolicyHTTPClient
+from async_sheets import AsyncSheetsClient
+from sheets_cache import CachedSpreadsheet
+from sheets_executor import SheetsExecutor
+from sqlite_storage import (
+    SQLiteDatabase,
+    SQLiteSessionStore,
+    StateSQLiteStorage,
+    AsyncStateSQLiteStorage,
 )
 from gspread import auth, Client, Spreadsheet
 
 
-def configure_services() -> None:
+def configure_services(shard: int = 0, shards: int = 1) -> None:
     """
-    Setup services into the container for dependency injection
+    Setup services into the container for dependency injection. The shard
+    processes of dispatcher.py each take their part of the Sheets quota,
+    and only the first one polls the catalog.
     """
-    trx_data = {
-        "Date": "",
-        "Outflow": "",
-        "Inflow": "",
-        "Category": "",
-        "Account": "",
-        "Memo": "",
-    }
-
     scope = [
         "https://spreadsheets.google.com/feeds",
         "https://www.googleapis.com/auth/spreadsheets",
@@ -45,12 +62,44 @@ def configure_services() -> None:
 
     di[Logger] = telebot.logger
     di[Configuration] = Configuration().values
+    if di[Configuration]["telegram_api_url"]:
+        # A local Bot API server such as telegram_stub.py
+        api_url = di[Configuration]["telegram_api_url"].rstrip("/") + "/bot{0}/{1}"
+        apihelper.API_URL = asyncio_helper.API_URL = api_url
+    di[MetricsRegistry] = MetricsRegistry()
+    instrument_telegram(di[MetricsRegistry])
+    di[HandlerProfiler] = HandlerProfiler(
+        di[Configuration]["profile_dir"], di[Configuration]["profile_sample_rate"]
+    )
+
+    di[EditTracker] = EditTracker()
+    outbound_limits = dict(
+        global_rate=di[Configuration]["outbound_global_rate"],
+        chat_rate=di[Configuration]["outbound_chat_rate"],
+        chat_burst=di[Configuration]["outbound_chat_burst"],
+    )
+    use_sqlite = di[Configuration]["state_storage"] == "sqlite"
+    if use_sqlite:
+        di[SQLiteDatabase] = SQLiteDatabase(di[Configuration]["state_db_path"])
+        atexit.register(di[SQLiteDatabase].close)
 
     if di[Configuration]["run_async"]:
-        bot_instance = AsyncTeleBot(
+        # Every coroutine of the bot and the async Sheets client runs on this
+        # loop so sessions and connection pools survive between updates
+        di[BackgroundLoop] = BackgroundLoop("bot-loop")
+        di[BackgroundLoop].start()
+        atexit.register(di[BackgroundLoop].stop)
+        bot_instance = AsyncTrackedTeleBot(
             token=di[Configuration]["token"],
             parse_mode="MARKDOWN",
             exception_handler=ExceptionHandler(),
+            edit_tracker=di[EditTracker],
+            outbound=AsyncOutboundScheduler(**outbound_limits),
+            state_storage=(
+                AsyncStateSQLiteStorage(di[SQLiteDatabase])
+                if use_sqlite
+                else AsyncStateMemoryStorage()
+            ),
         )
         di["bot_instance"] = BotFactory(
             bot_instance=bot_instance,
@@ -60,11 +109,18 @@ def configure_services() -> None:
             actions_callback_filter=AsyncActionsCallbackFilter(),
         ).create_bot()
     else:
-        bot_instance = TeleBot(
+        bot_instance = TrackedTeleBot(
             token=di[Configuration]["token"],
             parse_mode="MARKDOWN",
             exception_handler=ExceptionHandler(),
+            edit_tracker=di[EditTracker],
+            outbound=OutboundScheduler(**outbound_limits),
             threaded=False,
+            state_storage=(
+                StateSQLiteStorage(di[SQLiteDatabase])
+                if use_sqlite
+                else StateMemoryStorage()
+            ),
         )
         di["bot_instance"] = BotFactory(
             bot_instance=bot_instance,
@@ -74,20 +130,223 @@ def configure_services() -> None:
             actions_callback_filter=ActionsCallbackFilter(),
         ).create_bot()
 
-    di[TransactionData] = TransactionData(trx_data)
+    if use_sqlite:
+        di[SessionStore] = SQLiteSessionStore(
+            di[SQLiteDatabase],
+            max_sessions=di[Configuration]["session_max_count"],
+            idle_timeout=di[Configuration]["session_idle_timeout"],
+        )
+    else:
+        di[SessionStore] = SessionStore(
+            max_sessions=di[Configuration]["session_max_count"],
+            idle_timeout=di[Configuration]["session_idle_timeout"],
+        )
     di[CallbackData] = CallbackData("action_id", prefix="Action")
     di[KeyboardUtil] = KeyboardUtil()
-    di[Client] = auth.service_account_from_dict(
-        di[Configuration]["credentials_json"], scopes=scope
-    )
+    di[KeyboardCache] = KeyboardCache()
 
     di["WEBHOOK_URL_BASE"] = di[Configuration]["webhook_base_url"]
-    spreadsheet = di[Client].open_by_key(di[Configuration]["worksheet_id"])
-    di[Spreadsheet] = spreadsheet
-    trx_categories = aspire_util.get_all_categories(spreadsheet)
-    di["trx_categories"] = trx_categories
-    trx_accounts = [i for s in aspire_util.get_accounts(spreadsheet) for i in s]
-    di["trx_accounts"] = trx_accounts
-    di["groups"] = ["group_sel;" + s for s in trx_categories.keys()]
-    di["categories"] = ["save;" + s for l in trx_categories.values() for s in l]
-    di["accounts"] = ["acc_sel;" + s for s in trx_accounts]
+    di[SheetsExecutor] = SheetsExecutor(
+        max_workers=di[Configuration]["sheets_pool_size"],
+        queue_limit=di[Configuration]["sheets_queue_limit"],
+        timeout=di[Configuration]["sheets_timeout"],
+    )
+    atexit.register(di[SheetsExecutor].shutdown)
+    quota = di[Configuration]["sheets_quota_per_minute"]
+    shard_quota = max(1, quota // shards)
+    di[SheetsPolicy] = SheetsPolicy(
+        max_attempts=di[Configuration]["sheets_max_attempts"],
+        base_delay=di[Configuration]["sheets_backoff_base"],
+        max_delay=di[Configuration]["sheets_backoff_max"],
+        failure_threshold=di[Configuration]["sheets_breaker_threshold"],
+        reset_timeout=di[Configuration]["sheets_breaker_reset"],
+        quota_per_minute=shard_quota,
+        background_reserve=(
+            di[Configuration]["sheets_background_reserve"] * shard_quota // quota
+        ),
+        metrics=di[MetricsRegistry],
+        timeout=di[Configuration]["sheets_timeout"],
+    )
+
+    journal = None
+    if di[Configuration]["journal_path"]:
+        journal = TransactionJournal(
+            di[Configuration]["journal_path"],
+            lease=di[Configuration]["journal_lease"],
+            retention=di[Configuration]["journal_retention"],
+        )
+        atexit.register(journal.close)
+    sheet_lock = None
+    if di[Configuration]["sheets_write_lock"]:
+        sheet_lock = FileLock(di[Configuration]["sheets_write_lock"])
+    # The other shards load the snapshot the first one saves, without a
+    # snapshot file they all poll, less often
+    catalog_options = dict(
+        refresh_interval=di[Configuration]["catalog_refresh_interval"]
+        * (1 if di[Configuration]["catalog_snapshot_path"] else shards),
+        snapshot_path=di[Configuration]["catalog_snapshot_path"],
+        follow=shard > 0,
+    )
+
+    if di[Configuration]["run_async"] and (
+        di[Configuration]["sheets_backend"] == "aiohttp"
+    ):
+        client = AsyncSheetsClient(
+            di[Configuration]["credentials_json"],
+            di[Configuration]["worksheet_id"],
+            scopes=scope,
+            base_url=di[Configuration]["sheets_api_url"],
+            timeout=di[Configuration]["sheets_timeout"],
+            pool_size=di[Configuration]["sheets_pool_size"],
+            drive_url=di[Configuration]["drive_api_url"],
+            policy=di[SheetsPolicy],
+        )
+        di[AsyncSheetsClient] = client
+        atexit.register(lambda: di[BackgroundLoop].run(client.close()))
+        catalog = AsyncCatalog(
+            client,
+            di[BackgroundLoop],
+            **catalog_options,
+        )
+        if not catalog.load_snapshot():
+            di[BackgroundLoop].run(catalog.refresh(force=True))
+        uploader = AsyncTransactionUploader(
+            client,
+            di[BackgroundLoop],
+            flush_interval=di[Configuration]["upload_flush_interval"],
+            max_batch_size=di[Configuration]["upload_max_batch_size"],
+            journal=journal,
+            sheet_lock=sheet_lock,
+        )
+    else:
+        di[Client] = auth.service_account_from_dict(
+            di[Configuration]["credentials_json"],
+            scopes=scope,
+            http_client=functools.partial(PolicyHTTPClient, policy=di[SheetsPolicy]),
+        )
+        di[Client].set_timeout(di[Configuration]["sheets_timeout"])
+        spreadsheet = CachedSpreadsheet(
+            di[Client],
+            di[Configuration]["worksheet_id"],
+            ttl=di[Configuration]["worksheet_cache_ttl"],
+        )
+        di[Spreadsheet] = spreadsheet
+        catalog = Catalog(
+            spreadsheet,
+            executor=di[SheetsExecutor],
+            **catalog_options,
+        )
+        if not catalog.load_snapshot():
+            catalog.refresh(force=True)
+        uploader = TransactionUploader(
+            spreadsheet,
+            flush_interval=di[Configuration]["upload_flush_interval"],
+            max_batch_size=di[Configuration]["upload_max_batch_size"],
+            executor=di[SheetsExecutor],
+            journal=journal,
+            sheet_lock=sheet_lock,
+        )
+
+    catalog.start()
+    atexit.register(catalog.stop)
+    di[Catalog] = catalog
+
+    uploader.start()
+    atexit.register(uploader.stop)
+    di[TransactionUploader] = uploader
+
+    mapping = ImportMapping(
+        di[Configuration]["import_columns"], di[Configuration]["import_date_format"]
+    )
+    import_options = dict(
+        chunk_size=di[Configuration]["import_chunk_size"],
+        progress_every=di[Configuration]["import_progress_every"],
+    )
+    if isinstance(uploader, AsyncTransactionUploader):
+        di[CsvImporter] = AsyncCsvImporter(mapping, uploader.write, **import_options)
+    elif di[Configuration]["run_async"]:
+        di[CsvImporter] = AsyncCsvImporter(
+            mapping,
+            lambda rows: asyncio.to_thread(uploader.write, rows),
+            **import_options,
+        )
+    else:
+        di[CsvImporter] = CsvImporter(mapping, uploader.write, **import_options)
+
+    register_metrics(di[MetricsRegistry], bot_instance)
+
+
+def register_metrics(registry: MetricsRegistry, bot_instance) -> None:
+    """
+    Expose the counters and sizes the services already keep
+    """
+    edits, keyboards = di[EditTracker], di[KeyboardCache]
+    outbound, policy = bot_instance.outbound, di[SheetsPolicy]
+    registry.register(
+        "telegram_edits",
+        "Message edits sent or skipped as unchanged",
+        lambda: {("sent",): edits.sent, ("skipped",): edits.skipped},
+        "counter",
+        ("result",),
+    )
+    registry.register(
+        "telegram_outbound",
+        "Outbound scheduler events",
+        lambda: {
+            ("sent",): outbound.sent,
+            ("coalesced",): outbound.coalesced,
+            ("throttled",): outbound.throttled,
+            ("retried",): outbound.retried,
+        },
+        "counter",
+        ("event",),
+    )
+    caches = {"keyboards": keyboards}
+    if Spreadsheet in di:
+        caches["worksheets"] = di[Spreadsheet]
+    registry.register(
+        "cache_requests",
+        "Cache lookups by cache and result",
+        lambda: {
+            key: value
+            for name, cache in caches.items()
+            for key, value in (
+                ((name, "hit"), cache.hits),
+                ((name, "miss"), cache.misses),
+            )
+        },
+        "counter",
+        ("cache", "result"),
+    )
+    registry.register(
+        "bot_states",
+        "Users with a bot state",
+        lambda: state_count(bot_instance.current_states),
+    )
+    registry.register(
+        "bot_sessions", "Sessions in memory", lambda: len(di[SessionStore])
+    )
+    registry.register(
+        "sheets_retries", "Sheets requests retried", lambda: policy.retries, "counter"
+    )
+    registry.register(
+        "sheets_rejected",
+        "Sheets calls failed fast by the open circuit",
+        lambda: policy.rejected,
+        "counter",
+    )
+    registry.register(
+        "sheets_circuit_open",
+        "1 while the Sheets circuit breaker is open or half-open",
+        lambda: int(policy.state != "closed"),
+    )
+    registry.register(
+        "sheets_quota_remaining",
+        "Sheets requests left in the current minute",
+        policy.remaining,
+    )
+    registry.register(
+        "transactions_pending",
+        "Transactions not written to the sheet yet",
+        di[TransactionUploader].pending,
+    )
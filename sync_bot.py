@@ -1,45 +1,73 @@
+import threading
 import aspire_util
-from kink.errors.service_error import ServiceError
 from kink import di
+from logging import Logger
 from app_config import Configuration
 from telebot.callback_data import CallbackData
-from telebot import TeleBot, types
-from services import Action, TextUtil, TransactionData, DateUtil, KeyboardUtil
-from gspread import Spreadsheet
+from telebot import TeleBot, apihelper, types
+from services import Action, TextUtil, DateUtil, KeyboardUtil, Session, SessionStore
+from uploader import TransactionUploader
+from keyboards import KeyboardCache
+from router import CallbackRouter, state_name
+from catalog import GROUP, CATEGORY, ACCOUNT, StaleCallbackError, Catalog
+from importer import CsvImporter, ImportRowError, download, open_csv
+from metrics import MetricsRegistry, instrument_handlers
+from profiling import HandlerProfiler
 
 
 def sync_bot_functions(bot_instance: TeleBot):
-    trx_categories = di["trx_categories"]
-    trx_accounts = di["trx_accounts"]
-    groups = di["groups"]
-    categories = di["categories"]
-    accounts = di["accounts"]
+    catalog = di[Catalog]
+    keyboards = di[KeyboardCache]
+    actions_filter = di[CallbackData].filter()
+    router = CallbackRouter()
+    sessions = di[SessionStore]
+    importer = di[CsvImporter]
 
-    @bot_instance.message_handler(state="*", commands=["cancel", "q"])
-    def cancel_trx(message: types.Message):
+    def cancel_session(session: Session):
         """
-        Clears state and cancel current transaction
+        Clears state and cancel current transaction of a session
         """
-        di[TransactionData].reset()
-        message = di["current_trx_message"]
-        if bot_instance.get_state(di["state"]):
-            bot_instance.delete_state(di["state"])
+        session.trx.reset()
+        session.batch = []
+        sessions.save(session)
+        if bot_instance.get_state(session.user_id, session.chat_id):
+            bot_instance.delete_state(session.user_id, session.chat_id)
+        if session.message_id is None:
+            di[Logger].debug("No current transaction.")
+            return
         bot_instance.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=message.id,
+            chat_id=session.chat_id,
+            message_id=session.message_id,
             text="Transaction cancelled.",
         )
 
+    def restart_session(session: Session):
+        """
+        Cancel whatever transaction the session had before starting a new one
+        """
+        try:
+            cancel_session(session)
+        except apihelper.ApiTelegramException as e:
+            # e.g. the previous message was deleted or is too old to edit
+            di[Logger].error(e)
+
+    @bot_instance.message_handler(state="*", commands=["cancel", "q"])
+    def cancel_trx(message: types.Message):
+        """
+        Clears state and cancel current transaction
+        """
+        cancel_session(sessions.for_message(message))
+
     @bot_instance.message_handler(state=[Action.outflow, Action.inflow], is_digit=False)
     def invalid_amt(message: types.Message):
         bot_instance.reply_to(message, "Please enter a number")
 
-    def upload_trx(message: types.Message):
+    def upload_trx(session: Session, message: types.Message):
         """
         Clears state and upload transaction to sheets
         """
-        bot_instance.delete_state(di["state"])
-        upload(message)
+        bot_instance.delete_state(session.user_id, session.chat_id)
+        upload(session, message)
 
     @bot_instance.message_handler(
         state=[Action.outflow, Action.inflow, Action.memo], restrict=True
@@ -48,32 +76,30 @@ def sync_bot_functions(bot_instance: TeleBot):
         """
         Saves user input to selected option
         """
-        current_action = bot_instance.get_state(di["state"])
-        di[TransactionData][current_action.name.capitalize()] = message.text
-        item_selected(current_action, di["current_trx_message"])
+        session = sessions.for_message(message)
+        state = bot_instance.get_state(session.user_id, session.chat_id)
+        current_action = Action[state_name(state)]
+        session.trx[current_action.name.capitalize()] = message.text
+        sessions.save(session)
+        item_selected(session, current_action)
 
-    def quick_save(message: types.Message):
-        bot_instance.set_state(di["state"], Action.quick_end)
-        di["current_trx_message"] = bot_instance.send_message(
+    def quick_save(session: Session, message: types.Message):
+        bot_instance.set_state(session.user_id, Action.quick_end, session.chat_id)
+        trx_message = bot_instance.send_message(
             chat_id=message.chat.id,
             text="Current Transaction:",
-            reply_markup=KeyboardUtil.create_options_keyboard(),
+            reply_markup=KeyboardUtil.create_options_keyboard(session.trx),
         )
+        session.message_id = trx_message.message_id
+        sessions.save(session)
 
-    def upload(message: types.Message):
+    def upload(session: Session, message: types.Message):
         """
         Upload info to aspire google sheet
         """
-        upload_data = [
-            di[TransactionData]["Date"],
-            di[TransactionData]["Outflow"],
-            di[TransactionData]["Inflow"],
-            di[TransactionData]["Category"],
-            di[TransactionData]["Account"],
-            di[TransactionData]["Memo"],
-        ]
-        aspire_util.append_trx(di[Spreadsheet], upload_data)
-        di[TransactionData].reset()
+        di[TransactionUploader].enqueue(session.trx.to_row())
+        session.trx.reset()
+        sessions.save(session)
         bot_instance.reply_to(message, "✅ Transaction Saved\n")
 
     @bot_instance.message_handler(regexp="^(A|a)dd(I|i)nc.+$", restrict=True)
@@ -81,16 +107,8 @@ def sync_bot_functions(bot_instance: TeleBot):
         """
         Add income transaction using Today's date, Inflow Amount and Memo
         """
-        try:
-            cancel_trx(di["current_trx_message"])
-        except ServiceError as e:
-            print("No current transaction.")
-        except Exception as e:
-            error_msg = getattr(e, "message", repr(e))
-            if "Bad Request: message is not modified" in error_msg:
-                print("Previous transaction was already cancelled.")
-        di["state"] = message.from_user.id
-        di[TransactionData].reset()
+        session = sessions.for_message(message)
+        restart_session(session)
 
         result = TextUtil.text_splitter(message.text)
         del result[0]
@@ -107,27 +125,18 @@ def sync_bot_functions(bot_instance: TeleBot):
             except ValueError:
                 invalid_amt(message)
             else:
-                di[TransactionData]["Date"] = DateUtil.date_today()
-                di[TransactionData]["Inflow"] = inflow
-                di[TransactionData]["Memo"] = memo
-                quick_save(message)
+                session.trx["Date"] = DateUtil.date_today()
+                session.trx["Inflow"] = inflow
+                session.trx["Memo"] = memo
+                quick_save(session, message)
 
     @bot_instance.message_handler(regexp="^(A|a)dd(E|e)xp.+$", restrict=True)
     def expense_trx(message: types.Message):
         """
         Add expense transaction using Today's date, Outflow Amount and Memo
         """
-        try:
-            cancel_trx(di["current_trx_message"])
-        except ServiceError as e:
-            print("No current transaction.")
-        except Exception as e:
-            error_msg = getattr(e, "message", repr(e))
-            if "Bad Request: message is not modified" in error_msg:
-                print("Previous transaction was already cancelled.")
-
-        di["state"] = message.from_user.id
-        di[TransactionData].reset()
+        session = sessions.for_message(message)
+        restart_session(session)
 
         result = TextUtil.text_splitter(message.text)
         del result[0]
@@ -144,54 +153,105 @@ def sync_bot_functions(bot_instance: TeleBot):
             except ValueError:
                 invalid_amt(message)
             else:
-                di[TransactionData]["Date"] = DateUtil.date_today()
-                di[TransactionData]["Outflow"] = outflow
-                di[TransactionData]["Memo"] = memo
-                quick_save(message)
+                session.trx["Date"] = DateUtil.date_today()
+                session.trx["Outflow"] = outflow
+                session.trx["Memo"] = memo
+                quick_save(session, message)
 
-    @bot_instance.callback_query_handler(
-        func=lambda c: c.data == "back;category", state=Action.category_list
+    @bot_instance.message_handler(
+        func=lambda m: TextUtil.is_quick_add_batch(m.text), restrict=True
+    )
+    def batch_trx(message: types.Message):
+        """
+        Add every AddExp/AddInc line of one message as a single batch,
+        confirmed once and saved in one write
+        """
+        session = sessions.for_message(message)
+        restart_session(session)
+
+        rows, errors = [], []
+        for number, line in enumerate(message.text.strip().splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                rows.append(TextUtil.parse_quick_add(line))
+            except ValueError as e:
+                errors.append(f"Line {number}: {e}")
+        if errors:
+            bot_instance.reply_to(message, "\n".join(errors), parse_mode="")
+            return
+        session.batch = rows
+        bot_instance.set_state(session.user_id, Action.batch_end, session.chat_id)
+        batch_message = bot_instance.send_message(
+            message.chat.id,
+            TextUtil.format_batch(rows),
+            reply_markup=keyboards.batch(),
+            parse_mode="",
+        )
+        session.message_id = batch_message.message_id
+        sessions.save(session)
+
+    @router.route(Action.batch_end, "batch_save", restrict=True)
+    def save_batch(call: types.CallbackQuery):
+        """
+        Clears state and queue the whole batch for one write to sheets
+        """
+        session = sessions.for_call(call)
+        bot_instance.delete_state(session.user_id, session.chat_id)
+        di[TransactionUploader].enqueue_batch(session.batch)
+        count = len(session.batch)
+        session.batch = []
+        # The confirmation stays, a later cancel must not edit this message
+        session.message_id = None
+        sessions.save(session)
+        bot_instance.edit_message_text(
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            text=f"✅ {count} Transactions Saved",
+        )
+
+    @router.route(
+        Action.category_list, "back", check=lambda c: c.data == "back;category"
     )
     def back_to_category_groups_menu(call: types.CallbackQuery):
         """
         Return to category groups selection menu
         """
-        bot_instance.set_state(di["state"], Action.category)
-        category_select_start(call.message)
+        session = sessions.for_call(call)
+        bot_instance.set_state(session.user_id, Action.category, session.chat_id)
+        category_select_start(call.message.chat.id, call.message.id)
 
-    def category_select_start(message: types.Message):
+    def category_select_start(chat_id: int, message_id: int):
         # Creates a keyboard, each key has a callback_data : group_sel;"group name" e.g. group_sel:"Expenses"
         bot_instance.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=message.id,
+            chat_id=chat_id,
+            message_id=message_id,
             text="Select Group:",
-            reply_markup=aspire_util.create_category_inline(
-                trx_categories.keys(), "group_sel"
-            ),
+            reply_markup=keyboards.groups(catalog.snapshot),
         )
 
-    def account_sel_start(message: types.Message):
+    def account_sel_start(chat_id: int, message_id: int):
         bot_instance.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=message.id,
+            chat_id=chat_id,
+            message_id=message_id,
             text="Select Account:",
-            reply_markup=aspire_util.create_account_inline(trx_accounts, "acc_sel"),
+            reply_markup=keyboards.accounts(catalog.snapshot),
         )
 
-    def date_sel_start(message: types.Message):
+    def date_sel_start(chat_id: int, message_id: int):
         bot_instance.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=message.id,
+            chat_id=chat_id,
+            message_id=message_id,
             text="Select Date:",
-            reply_markup=aspire_util.create_calendar(),
+            reply_markup=keyboards.calendar(),
         )
 
-    def item_selected(action: Action, message: types.Message):
+    def item_selected(session: Session, action: Action):
         """
         Process item selected through /start command
         """
-        bot_instance.set_state(di["state"], action)
-        data = di[TransactionData][action.name.capitalize()]
+        bot_instance.set_state(session.user_id, action, session.chat_id)
+        data = session.trx[action.name.capitalize()]
 
         if action == Action.outflow or action == Action.inflow:
             displayData = (
@@ -201,11 +261,11 @@ def sync_bot_functions(bot_instance: TeleBot):
             displayData = data if data != "" else "''"
 
         if action == Action.category:
-            category_select_start(message)
+            category_select_start(session.chat_id, session.message_id)
         elif action == Action.account:
-            account_sel_start(message)
+            account_sel_start(session.chat_id, session.message_id)
         elif action == Action.date:
-            date_sel_start(message)
+            date_sel_start(session.chat_id, session.message_id)
         else:
             text = (
                 f"\[Current Value: "
@@ -214,86 +274,81 @@ def sync_bot_functions(bot_instance: TeleBot):
                 + f"Enter {action.name.capitalize()} : "
             )
             bot_instance.edit_message_text(
-                chat_id=message.chat.id,
-                message_id=message.id,
+                chat_id=session.chat_id,
+                message_id=session.message_id,
                 text=text,
-                reply_markup=KeyboardUtil.create_save_keyboard("save"),
+                reply_markup=keyboards.save("save"),
             )
 
-    @bot_instance.callback_query_handler(
-        func=None,
-        config=di[CallbackData].filter(),
-        state=[Action.start, Action.quick_end],
+    @router.route(
+        [Action.start, Action.quick_end, Action.batch_end],
+        "Action",
+        check=lambda c: actions_filter.check(query=c),
         restrict=True,
     )
     def actions_callback(call: types.CallbackQuery):
         """
         Read and save state of bot depending on item selected from /start command
         """
+        session = sessions.for_call(call)
         callback_data: dict = di[CallbackData].parse(callback_data=call.data)
         actionId = int(callback_data["action_id"])
         action = Action(actionId)
 
         if action == Action.cancel:
-            cancel_trx(di["current_trx_message"])
+            cancel_session(session)
         elif action == Action.done:
-            upload_trx(call.message)
+            upload_trx(session, call.message)
         else:
-            item_selected(action, call.message)
+            item_selected(session, action)
 
-    @bot_instance.callback_query_handler(
-        func=lambda c: c.data in categories, state=Action.category_list, restrict=True
-    )
+    @router.route(Action.category_list, CATEGORY, restrict=True)
     def get_category(call: types.CallbackQuery):
         """
         Get user selection and store to Category
         """
-        action, choice = aspire_util.separate_callback_data(call.data)
-        di[TransactionData]["Category"] = choice
+        choice = catalog.snapshot.decode(call.data)
+        sessions.for_call(call).trx["Category"] = choice
         save_callback(call)
 
-    @bot_instance.callback_query_handler(
-        func=lambda c: c.data in accounts, state=Action.account, restrict=True
-    )
+    @router.route(Action.account, ACCOUNT, restrict=True)
     def get_account(call: types.CallbackQuery):
         """
         Read user input and store to Account
         """
-        action, choice = aspire_util.separate_callback_data(call.data)
-        di[TransactionData]["Account"] = choice
+        choice = catalog.snapshot.decode(call.data)
+        sessions.for_call(call).trx["Account"] = choice
         save_callback(call)
 
-    @bot_instance.callback_query_handler(func=None, state=Action.date)
+    @router.route(Action.date, "cal")
     def get_date(call: types.CallbackQuery):
         """
         Read user selection from calendar and store to Date
         """
-        selected, date = aspire_util.process_calendar_selection(call, bot_instance)
+        selected, date = aspire_util.process_calendar_selection(
+            call, bot_instance, keyboards
+        )
         if selected:
-            di[TransactionData]["Date"] = date.strftime("%m/%d/%Y")
+            sessions.for_call(call).trx["Date"] = date.strftime("%m/%d/%Y")
             save_callback(call)
 
-    @bot_instance.callback_query_handler(
-        func=lambda c: c.data in groups, state=Action.category
-    )
+    @router.route(Action.category, GROUP)
     def list_categories(call: types.CallbackQuery):
         """
         Show categories as InlineKeyboard
         """
-        bot_instance.set_state(di["state"], Action.category_list)
-        action, choice = aspire_util.separate_callback_data(call.data)
+        session = sessions.for_call(call)
+        bot_instance.set_state(session.user_id, Action.category_list, session.chat_id)
+        choice = catalog.snapshot.decode(call.data)
         bot_instance.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text="Select Category:",
-            reply_markup=aspire_util.create_category_inline(
-                trx_categories[choice], "save"
-            ),
+            reply_markup=keyboards.categories(catalog.snapshot, choice),
         )
 
-    @bot_instance.callback_query_handler(
-        func=lambda c: c.data == "save",
-        state=[
+    @router.route(
+        [
             Action.outflow,
             Action.inflow,
             Action.category,
@@ -301,28 +356,31 @@ def sync_bot_functions(bot_instance: TeleBot):
             Action.memo,
             Action.date,
         ],
+        "save",
+        check=lambda c: c.data == "save",
     )
     def save_callback(call: types.CallbackQuery):
         """
         Return to main menu of /start command showing new saved values
         """
-        bot_instance.set_state(di["state"], Action.start)
+        session = sessions.for_call(call)
+        sessions.save(session)
+        bot_instance.set_state(session.user_id, Action.start, session.chat_id)
         bot_instance.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text="Current Transaction:",
-            reply_markup=KeyboardUtil.create_options_keyboard(),
+            reply_markup=KeyboardUtil.create_options_keyboard(session.trx),
         )
 
-    @bot_instance.callback_query_handler(
-        func=lambda c: c.data == "quick_save", state=Action.quick_end
-    )
+    @router.route(Action.quick_end, "quick_save")
     def savequick_callback(call: types.CallbackQuery):
         """
         Clears state and upload to sheets for quick add functions
         """
-        bot_instance.delete_state(di["state"])
-        upload(call.message)
+        session = sessions.for_call(call)
+        bot_instance.delete_state(session.user_id, session.chat_id)
+        upload(session, call.message)
 
     @bot_instance.message_handler(commands=["start", "s"], restrict=True)
     def command_start(message: types.Message):
@@ -330,19 +388,119 @@ def sync_bot_functions(bot_instance: TeleBot):
         Start the conversation and ask user for input.
         Initialize with options to fill in.
         """
-        try:
-            cancel_trx(di["current_trx_message"])
-        except ServiceError as e:
-            print("No current transaction.")
-        except Exception as e:
-            error_msg = getattr(e, "message", repr(e))
-            if "Bad Request: message is not modified" in error_msg:
-                print("Previous transaction was already cancelled.")
-        di["state"] = message.from_user.id
-        bot_instance.set_state(di["state"], Action.start)
-        di[TransactionData]["Date"] = DateUtil.date_today()
-        di["current_trx_message"] = bot_instance.send_message(
+        session = sessions.for_message(message)
+        restart_session(session)
+        bot_instance.set_state(session.user_id, Action.start, session.chat_id)
+        session.trx["Date"] = DateUtil.date_today()
+        trx_message = bot_instance.send_message(
             message.chat.id,
             "Select Option:",
-            reply_markup=KeyboardUtil.create_default_options_keyboard(),
+            reply_markup=keyboards.default_options(),
+        )
+        session.message_id = trx_message.message_id
+        sessions.save(session)
+
+    @bot_instance.callback_query_handler(func=lambda c: True)
+    def route_callback(call: types.CallbackQuery):
+        """
+        Look up the user's state once and hand the callback to its route
+        """
+        state = bot_instance.get_state(call.from_user.id, call.message.chat.id)
+        handler = router.resolve(state, call)
+        if handler is None:
+            return
+        try:
+            handler(call)
+        except StaleCallbackError:
+            bot_instance.answer_callback_query(
+                call.id, text="This menu is out of date, please start again."
+            )
+
+    @bot_instance.message_handler(commands=["reload"], restrict=True)
+    def reload_catalog(message: types.Message):
+        """
+        Download categories and accounts again without waiting for the
+        next background refresh
+        """
+        catalog.refresh(force=True)
+        snapshot = catalog.snapshot
+        bot_instance.reply_to(
+            message,
+            f"Reloaded {len(snapshot.names[CATEGORY])} categories"
+            + f" and {len(snapshot.names[ACCOUNT])} accounts.",
+        )
+
+    @bot_instance.message_handler(commands=["import"], restrict=True)
+    def import_start(message: types.Message):
+        """
+        Wait for a CSV file to import into the Transactions sheet
+        """
+        session = sessions.for_message(message)
+        restart_session(session)
+        bot_instance.set_state(session.user_id, Action.import_file, session.chat_id)
+        bot_instance.reply_to(
+            message,
+            "Send the CSV file to import, columns: "
+            + ", ".join(importer.mapping.columns.values()),
+            parse_mode="",
+        )
+
+    @bot_instance.message_handler(
+        content_types=["document"], state=Action.import_file, restrict=True
+    )
+    def import_file(message: types.Message):
+        bot_instance.delete_state(message.from_user.id, message.chat.id)
+        import_document(message)
+
+    @bot_instance.message_handler(
+        content_types=["document"],
+        func=lambda m: (m.caption or "").split("@")[0].strip() == "/import",
+        restrict=True,
+    )
+    def import_captioned_file(message: types.Message):
+        import_document(message)
+
+    def import_document(message: types.Message):
+        """
+        Start importing the uploaded CSV in a thread of its own and return,
+        so that the update is answered before the import ends
+        """
+        if not importer.claim(message.document.file_unique_id):
+            bot_instance.reply_to(
+                message, "This file was already sent for import.", parse_mode=""
+            )
+            return
+        status = bot_instance.reply_to(message, "Importing...")
+        threading.Thread(
+            target=run_import, args=(message, status), name="import", daemon=True
+        ).start()
+
+    def run_import(message: types.Message, status: types.Message):
+        """
+        Stream the uploaded CSV into the sheet, editing a status message
+        with the progress
+        """
+
+        def progress(job):
+            bot_instance.edit_message_text(
+                job.progress(), message.chat.id, status.message_id, parse_mode=""
+            )
+
+        job = importer.job(catalog.snapshot)
+        try:
+            url = bot_instance.get_file_url(message.document.file_id)
+            with download(url) as file:
+                importer.run(job, open_csv(file), progress)
+            text = job.summary()
+        except ImportRowError as e:
+            text = f"Import failed: {e}"
+        except Exception as e:
+            di[Logger].error(e)
+            text = f"Import stopped after {job.written} transactions: {e}"
+        if not job.written:
+            importer.release(message.document.file_unique_id)
+        bot_instance.edit_message_text(
+            text, message.chat.id, status.message_id, parse_mode=""
         )
+
+    instrument_handlers(di[MetricsRegistry], bot_instance, router, di[HandlerProfiler])
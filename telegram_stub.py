@@ -0,0 +1,496 @@
+"""
+Local stand-in for the Telegram Bot API methods the bot uses, plus a crowd
+of simulated users tapping through the /start keyboards, to load test
+polling and webhook mode without touching Telegram:
+
+    python telegram_stub.py --port 8086 --users 1000 --latency 0.05 --error-rate 0.02
+
+Set telegram_api_url to "http://localhost:8086" and start app.py. The users
+start once the bot polls or sets its webhook, and the stub prints how long
+the bot took to answer their updates when they are done. Webhook URLs
+without a host, as app.py sets them when webhook_base_url is empty, are
+posted to --webhook-base. --users 0 only serves the API.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import statistics
+import time
+from collections import Counter
+from urllib.parse import parse_qsl
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
+
+# Methods that send to a chat, the ones Telegram answers 429 under flood
+CHAT_METHODS = ("sendMessage", "editMessageText", "answerCallbackQuery")
+
+
+class StubChat:
+    """
+    Messages of one private chat and the bot's latest inline keyboard
+    """
+
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+        self.messages: dict[int, dict] = {}
+        self.message_ids = itertools.count(1)
+        # Bumped on every answer of the bot, sends, edits and callback answers
+        self.answers = 0
+        self.keyboard = None
+        self.keyboard_message = None
+        self.keyboard_version = 0
+        self.changed = asyncio.Condition()
+
+    async def answered(self, message: dict = None):
+        async with self.changed:
+            self.answers += 1
+            if message is not None and "reply_markup" in message:
+                self.keyboard = message["reply_markup"]
+                self.keyboard_message = message
+                self.keyboard_version += 1
+            self.changed.notify_all()
+
+
+class StubBotAPI:
+    """
+    In-memory Bot API: updates waiting for getUpdates or posted to the
+    webhook, and the chats the bot writes to. Every request takes latency
+    seconds and error_rate of the chat methods are answered with a 429.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        retry_after: int = 1,
+        webhook_base: str = "http://localhost:8084",
+    ):
+        # The bot's own user, named after the token of its first request
+        self.bot: dict = None
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.webhook_base = webhook_base.rstrip("/")
+        self.webhook_url = ""
+        self.chats: dict[int, StubChat] = {}
+        self.requests = Counter()
+        self.throttled = 0
+        self.delivery_errors = 0
+        # Set once the bot polls or sets its webhook
+        self.ready = asyncio.Event()
+        self._updates: list[dict] = []
+        self._update_ids = itertools.count(1)
+        self._pending = asyncio.Condition()
+        self._callback_chats: dict[str, int] = {}
+        self._deliveries = asyncio.Semaphore(40)
+        self._session: ClientSession = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def chat(self, chat_id) -> StubChat:
+        chat_id = int(chat_id)
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = StubChat(chat_id)
+        return chat
+
+    async def push(self, update: dict):
+        """
+        Hand an update to the bot, the way Telegram would
+        """
+        update["update_id"] = next(self._update_ids)
+        if "callback_query" in update:
+            query = update["callback_query"]
+            self._callback_chats[query["id"]] = query["message"]["chat"]["id"]
+        if self.webhook_url:
+            await self._deliver(update)
+            return
+        async with self._pending:
+            self._updates.append(update)
+            self._pending.notify_all()
+
+    async def _deliver(self, update: dict, attempts: int = 5):
+        url = self.webhook_url
+        if "://" not in url:
+            url = self.webhook_base + url
+        if self._session is None:
+            self._session = ClientSession(timeout=ClientTimeout(total=60))
+        async with self._deliveries:
+            # Telegram keeps retrying an update the webhook failed to take
+            for attempt in range(attempts):
+                if attempt:
+                    await asyncio.sleep(attempt)
+                try:
+                    async with self._session.post(url, json=update) as resp:
+                        if resp.status < 300:
+                            return
+                except (ClientError, asyncio.TimeoutError):
+                    pass
+            self.delivery_errors += 1
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    def _message(self, chat: StubChat, message_id: int, params: dict) -> dict:
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat.id, "type": "private"},
+            "from": self.bot,
+            "text": params.get("text", ""),
+        }
+        if params.get("reply_markup"):
+            message["reply_markup"] = json.loads(params["reply_markup"])
+        return message
+
+    async def get_updates(self, params: dict):
+        if self.webhook_url:
+            raise BotAPIError(
+                409,
+                "Conflict: can't use getUpdates method while webhook is active; "
+                "use deleteWebhook to delete the webhook first",
+            )
+        self.ready.set()
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", 100))
+        timeout = float(params.get("timeout", 0))
+        async with self._pending:
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            if not self._updates and timeout > 0:
+                try:
+                    await asyncio.wait_for(self._pending.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self._updates[:limit]
+
+    async def set_webhook(self, params: dict):
+        self.webhook_url = params.get("url", "")
+        self._deliveries = asyncio.Semaphore(int(params.get("max_connections", 40)))
+        async with self._pending:
+            pending, self._updates = self._updates, []
+        self.ready.set()
+        for update in pending:
+            task = asyncio.create_task(self._deliver(update))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def delete_webhook(self, params: dict):
+        self.webhook_url = ""
+        if params.get("drop_pending_updates") in ("True", "true", True):
+            async with self._pending:
+                self._updates = []
+        return True
+
+    async def get_me(self, params: dict):
+        return self.bot
+
+    async def send_message(self, params: dict):
+        chat = self.chat(params["chat_id"])
+        message_id = next(chat.message_ids)
+        message = chat.messages[message_id] = self._message(chat, message_id, params)
+        await chat.answered(message)
+        return message
+
+    async def edit_message_text(self, params: dict):
+        chat = self.chat(params["chat_id"])
+        message_id = int(params["message_id"])
+        old = chat.messages.get(message_id)
+        if old is None:
+            raise BotAPIError(400, "Bad Request: message to edit not found")
+        message = self._message(chat, message_id, params)
+        if message["text"] == old["text"] and message.get("reply_markup") == old.get(
+            "reply_markup"
+        ):
+            raise BotAPIError(
+                400,
+                "Bad Request: message is not modified: specified new message "
+                "content and reply markup are exactly the same as a current "
+                "content and reply markup of the message",
+            )
+        chat.messages[message_id] = message
+        await chat.answered(message)
+        return message
+
+    async def answer_callback_query(self, params: dict):
+        chat_id = self._callback_chats.pop(params.get("callback_query_id"), None)
+        if chat_id is None:
+            raise BotAPIError(
+                400, "Bad Request: query is too old or query ID is invalid"
+            )
+        await self.chat(chat_id).answered()
+        return True
+
+
+class BotAPIError(Exception):
+    def __init__(self, error_code: int, description: str, parameters: dict = None):
+        super().__init__(description)
+        self.error_code = error_code
+        self.description = description
+        self.parameters = parameters
+
+
+def create_app(api: StubBotAPI) -> web.Application:
+    methods = {
+        "getUpdates": api.get_updates,
+        "setWebhook": api.set_webhook,
+        "deleteWebhook": api.delete_webhook,
+        "getMe": api.get_me,
+        "sendMessage": api.send_message,
+        "editMessageText": api.edit_message_text,
+        "answerCallbackQuery": api.answer_callback_query,
+    }
+
+    async def call(request: web.Request):
+        name = request.match_info["method"]
+        if api.bot is None:
+            bot_id = request.match_info["token"].partition(":")[0]
+            api.bot = {
+                "id": int(bot_id) if bot_id.isdigit() else 1,
+                "is_bot": True,
+                "first_name": "Stub",
+                "username": "stub_bot",
+            }
+        params = dict(request.query)
+        # The async helper sends form fields in the body of GET requests too
+        if request.content_type == "application/json":
+            params.update(await request.json())
+        elif request.content_type == "application/x-www-form-urlencoded":
+            params.update(parse_qsl(await request.text()))
+        elif request.method == "POST":
+            params.update(await request.post())
+        api.requests[name] += 1
+        if api.latency:
+            await asyncio.sleep(api.latency)
+        try:
+            method = methods.get(name)
+            if method is None:
+                raise BotAPIError(404, "Not Found: method not found")
+            if name in CHAT_METHODS and random.random() < api.error_rate:
+                api.throttled += 1
+                raise BotAPIError(
+                    429,
+                    "Too Many Requests: retry after %d" % api.retry_after,
+                    {"retry_after": api.retry_after},
+                )
+            result = await method(params)
+        except BotAPIError as e:
+            body = {
+                "ok": False,
+                "error_code": e.error_code,
+                "description": e.description,
+            }
+            if e.parameters:
+                body["parameters"] = e.parameters
+            return web.json_response(body, status=e.error_code)
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.router.add_route("*", "/bot{token}/{method}", call)
+    app["api"] = api
+    return app
+
+
+class Tap:
+    """
+    Step of a user script: tap the first button starting with text on the
+    bot's newest keyboard, or its first button when text is None
+    """
+
+    def __init__(self, text: str = None):
+        self.text = text
+
+    def button(self, keyboard: dict) -> dict:
+        buttons = [b for row in keyboard.get("inline_keyboard", []) for b in row]
+        for button in buttons:
+            if self.text is None or button.get("text", "").startswith(self.text):
+                return button
+        return None
+
+
+# Fills a transaction through /start, browsing the category, account and
+# calendar keyboards, then saves a quick add
+START_SCRIPT = (
+    "/start",
+    Tap("Outflow"),
+    "12",
+    Tap("💾 Save"),
+    Tap("Category"),
+    Tap(),
+    Tap(),
+    Tap("Account"),
+    Tap(),
+    Tap("Date"),
+    Tap("<"),
+    Tap("15"),
+    Tap("Done"),
+    "AddExp 4.50 Coffee",
+    Tap("Done"),
+)
+
+
+class SimulatedUser:
+    """
+    Private chat user running a script of texts and taps. Each step waits
+    for the bot to answer the previous one, and a tap waits for a keyboard
+    newer than the one tapped before.
+    """
+
+    def __init__(self, api: StubBotAPI, user_id: int, timeout: float = 30.0):
+        self.api = api
+        self.chat = api.chat(user_id)
+        self.user = {"id": user_id, "is_bot": False, "first_name": "User%d" % user_id}
+        self.timeout = timeout
+        self.latencies: list[float] = []
+        self.timeouts = 0
+        self._tapped_version = 0
+
+    async def run(self, script, rounds: int = 1, think_time: float = 0.0):
+        for _ in range(rounds):
+            for step in script:
+                if think_time:
+                    await asyncio.sleep(random.uniform(0, 2 * think_time))
+                try:
+                    await self.step(step)
+                except asyncio.TimeoutError:
+                    # The rest of the round depends on this answer
+                    self.timeouts += 1
+                    break
+
+    async def step(self, step):
+        if isinstance(step, Tap):
+            update = await self._callback_query(step)
+        else:
+            update = self._message(step)
+        async with self.chat.changed:
+            answers = self.chat.answers
+        start = time.perf_counter()
+        await self.api.push(update)
+        async with self.chat.changed:
+            await asyncio.wait_for(
+                self.chat.changed.wait_for(lambda: self.chat.answers > answers),
+                self.timeout,
+            )
+        self.latencies.append(time.perf_counter() - start)
+
+    def _message(self, text: str) -> dict:
+        message = {
+            "message_id": next(self.chat.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": self.chat.id, "type": "private"},
+            "from": self.user,
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [
+                {"type": "bot_command", "offset": 0, "length": len(command)}
+            ]
+        return {"message": message}
+
+    async def _callback_query(self, tap: Tap) -> dict:
+        chat = self.chat
+
+        def ready():
+            return (
+                chat.keyboard_version > self._tapped_version
+                and tap.button(chat.keyboard) is not None
+            )
+
+        async with chat.changed:
+            await asyncio.wait_for(chat.changed.wait_for(ready), self.timeout)
+            self._tapped_version = chat.keyboard_version
+            button = tap.button(chat.keyboard)
+            message = chat.keyboard_message
+        return {
+            "callback_query": {
+                "id": "%d-%d" % (chat.id, time.monotonic_ns()),
+                "from": self.user,
+                "message": message,
+                "chat_instance": str(chat.id),
+                "data": button["callback_data"],
+            }
+        }
+
+
+def percentile(values: list[float], p: float) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[int(p) - 1]
+
+
+async def run_crowd(api: StubBotAPI, args) -> dict:
+    """
+    Start args.users users over args.ramp seconds once the bot is ready and
+    summarize how fast the bot answered them
+    """
+    await api.ready.wait()
+    users = [
+        SimulatedUser(api, args.first_user_id + i, args.step_timeout)
+        for i in range(args.users)
+    ]
+
+    async def run_user(user: SimulatedUser):
+        await asyncio.sleep(random.uniform(0, args.ramp))
+        await user.run(START_SCRIPT, args.rounds, args.think_time)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_user(user) for user in users))
+    elapsed = time.perf_counter() - start
+    latencies = [s for user in users for s in user.latencies]
+    return {
+        "users": args.users,
+        "mode": "webhook" if api.webhook_url else "polling",
+        "steps": len(latencies),
+        "timeouts": sum(user.timeouts for user in users),
+        "seconds": elapsed,
+        "steps_per_second": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "throttled": api.throttled,
+        "delivery_errors": api.delivery_errors,
+        "requests": dict(api.requests),
+    }
+
+
+async def main(args):
+    api = StubBotAPI(args.latency, args.error_rate, args.retry_after, args.webhook_base)
+    runner = web.AppRunner(create_app(api))
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    print("Bot API stub on http://%s:%d" % (args.host, args.port))
+    try:
+        if not args.users:
+            await asyncio.Event().wait()
+        summary = await run_crowd(api, args)
+        print(json.dumps(summary, indent=2))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(summary, f, indent=2)
+    finally:
+        await api.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline Telegram Bot API stub")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8086)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="share of sends answered 429"
+    )
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--webhook-base", default="http://localhost:8084")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--first-user-id", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=1)
+    parser.add_argument(
+        "--ramp", type=float, default=5.0, help="seconds to start all users"
+    )
+    parser.add_argument("--think-time", type=float, default=0.5)
+    parser.add_argument("--step-timeout", type=float, default=30.0)
+    parser.add_argument("--output", help="write the summary as JSON here")
+    asyncio.run(main(parser.parse_args()))
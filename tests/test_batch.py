@@ -0,0 +1,96 @@
+import argparse
+import pytest
+import telebot
+from kink import di
+from logging import Logger
+from app_config import Configuration
+from telebot import apihelper, asyncio_helper, types
+from bench_replay import BenchServices, StubTelegram
+
+USER_ID = 10000
+
+
+class RecordingTelegram(StubTelegram):
+    """StubTelegram keeping the last text of every message"""
+
+    def __init__(self):
+        super().__init__(latency=0)
+        self.texts: dict[int, str] = {}
+
+    def _result(self, method_name: str, params: dict):
+        result = super()._result(method_name, params)
+        if isinstance(result, dict):
+            self.texts[int(result["message_id"])] = result["text"]
+        return result
+
+
+def message(update_id: int, text: str) -> types.Update:
+    entities = (
+        [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        if text.startswith("/")
+        else []
+    )
+    return types.Update.de_json(
+        {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": 1700000000,
+                "from": {"id": USER_ID, "is_bot": False, "first_name": "test"},
+                "chat": {"id": USER_ID, "type": "private"},
+                "text": text,
+                "entities": entities,
+            },
+        }
+    )
+
+
+def callback(update_id: int, data: str, message_id: int) -> types.Update:
+    return types.Update.de_json(
+        {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": {"id": USER_ID, "is_bot": False, "first_name": "test"},
+                "chat_instance": str(USER_ID),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": 1700000000,
+                    "chat": {"id": USER_ID, "type": "private"},
+                    "text": "",
+                },
+            },
+        }
+    )
+
+
+@pytest.fixture(params=["sync", "async"])
+def bot(request, monkeypatch):
+    di[Logger] = telebot.logger
+    telegram = RecordingTelegram()
+    monkeypatch.setattr(apihelper, "_make_request", telegram.make_request)
+    monkeypatch.setattr(asyncio_helper, "_process_request", telegram.process_request)
+    args = argparse.Namespace(
+        users=1,
+        sheets_latency=0,
+        outbound_global_rate=1e9,
+        outbound_chat_rate=1e9,
+        outbound_chat_burst=1_000_000,
+    )
+    services = BenchServices(request.param, args)
+    di[Configuration]["list_of_users"] = {USER_ID}
+    yield services, telegram
+    services.close()
+
+
+def test_saved_batch_is_not_cancelled_by_start(bot):
+    services, telegram = bot
+    services.process(message(1, "AddExp 4.50 Coffee\nAddExp 12 Lunch"))
+    (batch_id,) = telegram.texts
+    services.process(callback(2, "batch_save", batch_id))
+    assert telegram.texts[batch_id] == "✅ 2 Transactions Saved"
+
+    services.process(message(3, "/start"))
+    assert telegram.texts[batch_id] == "✅ 2 Transactions Saved"
+    assert services.errors.errors == 0
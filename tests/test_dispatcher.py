@@ -0,0 +1,91 @@
+import json
+import logging
+import os
+import time
+from kink import di
+from logging import Logger
+from dispatcher import UpdateDispatcher
+
+USER_ID = 42
+HANDLE_TIME = 0.2
+
+
+def recording_shard(index: int, updates, ready, taken, handled, shards: int):
+    """Shard that slowly appends the shard index and update id to a log"""
+    ready.set()
+    while True:
+        body = updates.get()
+        if body is None:
+            return
+        taken.value += 1
+        time.sleep(HANDLE_TIME)
+        with open(os.environ["SHARD_TEST_LOG"], "a") as log:
+            log.write("%d %d\n" % (index, json.loads(body)["update_id"]))
+        handled.value += 1
+
+
+def update(update_id: int) -> str:
+    return json.dumps(
+        {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": 1700000000,
+                "from": {"id": USER_ID, "is_bot": False, "first_name": "test"},
+                "chat": {"id": USER_ID, "type": "private"},
+                "text": "/start",
+            },
+        }
+    )
+
+
+def handled(path) -> list[tuple[int, int]]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as log:
+        return [tuple(map(int, line.split())) for line in log]
+
+
+def wait_for(condition, timeout: float = 20):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+def test_moved_user_updates_stay_in_order(tmp_path, monkeypatch):
+    log = tmp_path / "handled.log"
+    monkeypatch.setenv("SHARD_TEST_LOG", str(log))
+    di[Logger] = logging.getLogger("test")
+    dispatcher = UpdateDispatcher(2, 100, check_interval=0.02, target=recording_shard)
+    dispatcher.start()
+    try:
+        wait_for(lambda: all(m["ready"] for m in dispatcher.metrics()))
+        first = dispatcher.dispatch(update(1))
+        for update_id in range(2, 11):
+            dispatcher.dispatch(update(update_id))
+        # Killed with most of the user's updates still queued
+        dispatcher._shards[first].process.kill()
+
+        update_id = 11
+        replaced = lambda: any(
+            m["shard"] == first and m["restarts"] == 1 and m["ready"]
+            for m in dispatcher.metrics()
+        )
+        while not replaced() or update_id < 31:
+            dispatcher.dispatch(update(update_id))
+            update_id += 1
+            time.sleep(0.05)
+        last = update_id - 1
+        wait_for(lambda: any(i == last for _, i in handled(log)))
+
+        # Once the other shard is done, the user goes back to their shard
+        assert dispatcher.dispatch(update(last + 1)) == first
+        wait_for(lambda: any(i == last + 1 for _, i in handled(log)))
+    finally:
+        dispatcher.stop(timeout=1)
+
+    ids = [i for _, i in handled(log)]
+    assert ids == sorted(ids)
+    # At most the update being handled when the shard was killed is lost
+    assert len(ids) >= last
@@ -0,0 +1,219 @@
+import asyncio
+import threading
+import aspire_util
+from contextlib import nullcontext
+from kink import di
+from logging import Logger
+from services import BackgroundLoop
+from sheets_executor import SheetsExecutor
+from journal import MemoryQueue, TransactionJournal
+from file_lock import FileLock
+
+
+class TransactionUploader:
+    """
+    Write-behind queue for transactions. Rows are added to the journal and
+    acknowledged right away, a background thread then replays them to the
+    sheet. Without a TransactionJournal the rows are only kept in memory.
+    Each range write holds sheet_lock from picking the free rows until they
+    are written, so bot processes sharing the sheet never pick the same.
+    Rows are only looked for in the sheet after a failed write, committed
+    rows are never checked again since the user may edit, sort or delete
+    them.
+    """
+
+    def __init__(
+        self,
+        spreadsheet,
+        flush_interval: float = 2.0,
+        max_batch_size: int = 50,
+        executor: SheetsExecutor = None,
+        journal: TransactionJournal = None,
+        sheet_lock: FileLock = None,
+    ):
+        self._spreadsheet = spreadsheet
+        self._sheet_lock = sheet_lock or nullcontext()
+        self._executor = executor
+        self._flush_interval = flush_interval
+        self._max_batch_size = max_batch_size
+        self._queue = journal or MemoryQueue()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="trx-uploader", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background flusher and write whatever is still pending
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def enqueue(self, row: list[str]):
+        self._queue.append([row])
+        if self._queue.pending() >= self._max_batch_size:
+            self._wake()
+
+    def enqueue_batch(self, rows: list[list[str]]):
+        """
+        Queue rows together and flush them right away, so they land in the
+        same range write as long as they fit in max_batch_size
+        """
+        self._queue.append(rows)
+        self._wake()
+
+    def pending(self) -> int:
+        return self._queue.pending()
+
+    def write(self, rows: list[list[str]]):
+        """
+        Write rows right away instead of queueing them, for bulk imports.
+        Runs between flushes so both never pick the same free rows.
+        """
+        with self._flush_lock:
+            self._write(rows)
+
+    def flush(self):
+        """
+        Write pending rows in batches of at most max_batch_size rows.
+        Rows of a failed batch stay pending in front of the queue. A batch
+        whose request failed is first looked for in the range it was sent
+        to, so a write that landed anyway is not made twice.
+        """
+        with self._flush_lock:
+            while True:
+                entries = self._queue.claim(self._max_batch_size)
+                if not entries:
+                    return
+                ids = [i for i, _, _ in entries]
+                rows = [row for _, row, _ in entries]
+                target = entries[0][2]
+                try:
+                    if target is None or not self._call(
+                        aspire_util.trx_written, self._spreadsheet, target, rows
+                    ):
+                        self._write(rows, lambda t: self._queue.set_target(ids, t))
+                except Exception as e:
+                    di[Logger].error(e)
+                    self._queue.release(ids, str(e))
+                    return
+                self._queue.commit(ids)
+
+    def _wake(self):
+        self._wakeup.set()
+
+    def _call(self, fn, *args, **kwargs):
+        if self._executor is None:
+            return fn(*args, **kwargs)
+        # No timeout here, the request may still land after we give up on
+        # it. The HTTP timeout of the client bounds it instead.
+        return self._executor.submit(fn, *args, **kwargs).result()
+
+    def _write(self, batch: list[list[str]], on_attempt=None):
+        with self._sheet_lock:
+            self._call(
+                aspire_util.append_trx_batch,
+                self._spreadsheet,
+                batch,
+                on_attempt=on_attempt,
+            )
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+class AsyncTransactionUploader(TransactionUploader):
+    """
+    Write-behind queue flushed by a task on a background event loop
+    through the aiohttp Sheets client
+    """
+
+    def __init__(
+        self,
+        client,
+        loop: BackgroundLoop,
+        flush_interval: float = 2.0,
+        max_batch_size: int = 50,
+        journal: TransactionJournal = None,
+        sheet_lock: FileLock = None,
+    ):
+        super().__init__(
+            client,
+            flush_interval,
+            max_batch_size,
+            journal=journal,
+            sheet_lock=sheet_lock,
+        )
+        self._loop = loop
+        self._write_lock = asyncio.Lock()
+        self._wakeup = None
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = self._loop.submit(self._run())
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._wake()
+            self._task.result()
+            self._task = None
+        self._loop.run(self.flush())
+
+    async def write(self, rows: list[list[str]]):
+        async with self._write_lock, self._sheet_lock:
+            await aspire_util.async_append_trx_batch(self._spreadsheet, rows)
+
+    async def flush(self):
+        async with self._write_lock:
+            while True:
+                entries = self._queue.claim(self._max_batch_size)
+                if not entries:
+                    return
+                ids = [i for i, _, _ in entries]
+                rows = [row for _, row, _ in entries]
+                target = entries[0][2]
+                try:
+                    if target is None or not await aspire_util.async_trx_written(
+                        self._spreadsheet, target, rows
+                    ):
+                        async with self._sheet_lock:
+                            await aspire_util.async_append_trx_batch(
+                                self._spreadsheet,
+                                rows,
+                                on_attempt=lambda t: self._queue.set_target(ids, t),
+                            )
+                except Exception as e:
+                    di[Logger].error(e)
+                    self._queue.release(ids, str(e))
+                    return
+                self._queue.commit(ids)
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._loop.call_soon(self._wakeup.set)
+
+    async def _run(self):
+        self._wakeup = asyncio.Event()
+        while not self._stopped.is_set():
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
@@ -0,0 +1,41 @@
+import flask
+from flask import Flask
+from kink import di
+from telebot.async_telebot import AsyncTeleBot
+from telebot import TeleBot, types
+from services import BackgroundLoop
+from metrics import CONTENT_TYPE, MetricsRegistry, authorized
+
+
+def create_app(bot_instance, webhook_url_path: str, metrics_token: str = None) -> Flask:
+    """
+    Flask app handing the updates posted to webhook_url_path to the bot and
+    serving /metrics to requests with metrics_token as bearer token. Setting
+    up the bot and its webhook is left to the caller.
+    """
+    app = Flask(__name__)
+    update_seconds = di[MetricsRegistry].histogram(
+        "bot_update_seconds", "Time to process a webhook update", ("outcome",)
+    )
+
+    @app.route(webhook_url_path, methods=["POST"])
+    def receive_updates():
+        if flask.request.headers.get("content-type") == "application/json":
+            json_string = flask.request.get_data().decode("utf-8")
+            update = types.Update.de_json(json_string)
+            with update_seconds.timer():
+                if isinstance(bot_instance, AsyncTeleBot):
+                    di[BackgroundLoop].run(bot_instance.process_new_updates([update]))
+                elif isinstance(bot_instance, TeleBot):
+                    bot_instance.process_new_updates([update])
+            return ""
+        else:
+            flask.abort(403)
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        if not authorized(flask.request.headers.get("Authorization"), metrics_token):
+            flask.abort(403)
+        return di[MetricsRegistry].render(), 200, {"Content-Type": CONTENT_TYPE}
+
+    return app